@@ -0,0 +1,287 @@
+from .error import BackpressureError, InvalidDataError
+from .stats import STATS
+from threading import Event, Thread
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence
+import logging
+import math
+import os
+import socket
+import struct
+import sys
+
+if TYPE_CHECKING:
+    from .config import GDConfig
+    from .datamanager import DataManager
+
+# Part types from collectd's binary network protocol
+# https://collectd.org/wiki/index.php/Binary_protocol
+PART_HOST = 0x0000
+PART_TIME = 0x0001
+PART_PLUGIN = 0x0002
+PART_PLUGIN_INSTANCE = 0x0003
+PART_TYPE = 0x0004
+PART_TYPE_INSTANCE = 0x0005
+PART_VALUES = 0x0006
+PART_INTERVAL = 0x0007
+PART_TIME_HR = 0x0008
+PART_INTERVAL_HR = 0x0009
+PART_SIGNATURE = 0x0200
+PART_ENCRYPTION = 0x0210
+
+STRING_PARTS = {
+    PART_HOST: 'host',
+    PART_PLUGIN: 'plugin',
+    PART_PLUGIN_INSTANCE: 'plugin_instance',
+    PART_TYPE: 'type',
+    PART_TYPE_INSTANCE: 'type_instance',
+}
+# The data source types, in the protocol's order, and how each value is
+# packed.  Gauges are little endian doubles, the rest are big endian.
+DS_TYPES = ('counter', 'gauge', 'derive', 'absolute')
+DS_FORMATS = ('>Q', '<d', '>q', '>Q')
+
+HEADER = struct.Struct('>HH')
+MAX_PACKET = 65535
+# Linux only: a cumulative count of the packets the kernel dropped because
+# the socket's receive buffer was full, delivered with each packet
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+
+def load_types_db(paths: Sequence[str]) -> Dict[str, List[str]]:
+    """
+    Parse collectd types.db files into a map of type -> dsnames.  Each line
+    looks like "if_octets  rx:DERIVE:0:U, tx:DERIVE:0:U"
+    """
+    types = {}
+    for path in paths:
+        if not path:
+            continue
+        with open(path) as fh:
+            for line in fh:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 1)
+                if len(parts) != 2:
+                    continue
+                types[parts[0]] = [
+                    ds.strip().split(':', 1)[0] for ds in parts[1].split(',')]
+
+    return types
+
+
+def parse_packet(
+        data: bytes,
+        types: Optional[Dict[str, List[str]]]=None,
+        ) -> List[Dict[str, Any]]:
+    """
+    Decode a collectd network packet into a list of dicts in the same shape
+    as the write_http JSON, as DataManager.push expects.  The dsnames aren't
+    part of the protocol, so they're looked up in types (from types.db),
+    falling back to "value" for single value types and the value's index
+    otherwise.
+
+    Signatures aren't verified, as with collectd's "SecurityLevel None",
+    and encrypted packets can't be decoded.
+    """
+    types = types or {}
+    ret = []
+    cur = {k: '' for k in STRING_PARTS.values()}
+    off = 0
+    end = len(data)
+
+    while off < end:
+        if end - off < HEADER.size:
+            raise InvalidDataError('Truncated part header')
+        ptype, plen = HEADER.unpack_from(data, off)
+        if plen < HEADER.size or off + plen > end:
+            raise InvalidDataError(f'Invalid part length: {plen}')
+        body = data[off + HEADER.size:off + plen]
+        off += plen
+
+        if ptype in STRING_PARTS:
+            cur[STRING_PARTS[ptype]] = body.rstrip(b'\0').decode(
+                'utf-8', 'replace')
+        elif ptype == PART_VALUES:
+            ret.append(_parse_values(body, cur, types))
+        elif ptype == PART_ENCRYPTION:
+            raise InvalidDataError('Encrypted packets are not supported')
+        # Everything else (times, intervals, signatures, notifications) is
+        # ignored, as with the write_http data
+
+    return ret
+
+
+def _parse_values(
+        body: bytes,
+        cur: Dict[str, str],
+        types: Dict[str, List[str]],
+        ) -> Dict[str, Any]:
+    if len(body) < 2:
+        raise InvalidDataError('Truncated values part')
+    num = struct.unpack_from('>H', body)[0]
+    if len(body) != 2 + num * 9:
+        raise InvalidDataError(f'Invalid values part for {num} values')
+
+    dstypes = []
+    values = []
+    for i in range(num):
+        ds = body[2 + i]
+        if ds >= len(DS_TYPES):
+            raise InvalidDataError(f'Unknown data source type: {ds}')
+        val = struct.unpack_from(DS_FORMATS[ds], body, 2 + num + i * 8)[0]
+        if ds == 1 and math.isnan(val):
+            # This is what write_http sends for an unknown gauge
+            val = None
+        dstypes.append(DS_TYPES[ds])
+        values.append(val)
+
+    dsnames = types.get(cur['type'])
+    if not dsnames or len(dsnames) != num:
+        dsnames = ['value'] if num == 1 else [str(i) for i in range(num)]
+
+    ret = dict(cur)
+    ret['dsnames'] = dsnames
+    ret['dstypes'] = dstypes
+    ret['values'] = values
+
+    return ret
+
+
+class UDPListener(Thread):
+    """
+    Receives collectd's binary network protocol (the "network" plugin) and
+    pushes the decoded values to the DataManager.
+
+    Packets that can't be decoded are counted as udp.packets_invalid and,
+    on Linux, the packets the kernel dropped because the receive buffer
+    was full are counted as udp.packets_dropped.
+    """
+
+    def __init__(
+            self,
+            dm: 'DataManager',
+            listen: str,
+            types: Optional[Dict[str, List[str]]]=None,
+            rcvbuf: Optional[int]=8 * 1024 * 1024,
+            name: Optional[str]='UDPListener'):
+        super().__init__(name=name)
+        self.dm = dm
+        self.types = types or {}
+        self.daemon = True
+        self._stop_ev = Event()
+        self._drops = 0
+
+        host, port = listen.rsplit(':', 1)
+        host = host.strip('[]')
+        family, stype, proto, _, addr = socket.getaddrinfo(
+            host, int(port), type=socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, stype, proto)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind(addr)
+        # Wake up periodically to check for the stop event
+        self.sock.settimeout(1.0)
+        self.address = self.sock.getsockname()
+
+        self._rxq_ovfl = False
+        if sys.platform.startswith('linux'):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self._rxq_ovfl = True
+            except OSError:
+                logging.warning('Unable to count dropped UDP packets')
+
+        actual = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        logging.info(
+            f'Listening for collectd packets on {self.address} with a '
+            f'{actual} byte receive buffer'
+        )
+        if actual < rcvbuf:
+            logging.warning(
+                f'The UDP receive buffer is smaller than requested ({rcvbuf}), '
+                'raise net.core.rmem_max to allow more'
+            )
+
+    def run(self) -> None:
+        logging.debug('UDP listener thread started')
+        while not self._stop_ev.is_set():
+            try:
+                data = self._recv()
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stop_ev.is_set():
+                    break
+                logging.exception('Error receiving a UDP packet')
+                continue
+
+            self.handle_packet(data)
+
+        self.sock.close()
+        logging.info('UDP listener stopped')
+
+    def stop(self) -> None:
+        logging.info('Setting the stop event in the UDP listener')
+        self._stop_ev.set()
+
+    def handle_packet(self, data: bytes) -> None:
+        STATS.incr('udp.packets')
+        try:
+            vals = parse_packet(data, self.types)
+        except InvalidDataError as e:
+            logging.debug(f'Invalid collectd packet: {e}')
+            STATS.incr('udp.packets_invalid')
+            return
+
+        if vals:
+            STATS.incr('udp.values', len(vals))
+            try:
+                self.dm.push(vals)
+            except BackpressureError:
+                # UDP can't push back, so this is just counted
+                STATS.incr('udp.packets_rejected')
+            except Exception:
+                logging.exception('Error pushing UDP data')
+
+    def _recv(self) -> bytes:
+        if not self._rxq_ovfl:
+            return self.sock.recv(MAX_PACKET)
+
+        data, ancdata, _, _ = self.sock.recvmsg(
+            MAX_PACKET, socket.CMSG_SPACE(4))
+        for level, ctype, cdata in ancdata:
+            if level == socket.SOL_SOCKET and ctype == SO_RXQ_OVFL:
+                drops = struct.unpack('=I', cdata[:4])[0]
+                if drops != self._drops:
+                    STATS.incr('udp.packets_dropped', drops - self._drops)
+                    self._drops = drops
+
+        return data
+
+
+def udp_listener(
+        config: 'GDConfig',
+        dm: 'DataManager',
+        ) -> Optional[UDPListener]:
+    """
+    Returns a UDPListener from the [udp] config section, or None if it's
+    not enabled
+    """
+    if not config.has_section('udp'):
+        return None
+    listen = config.get('udp', 'listen', fallback='')
+    if not listen:
+        return None
+
+    paths = config.getlist('udp', 'types_db') if config.get(
+        'udp', 'types_db', fallback='') else []
+    types = load_types_db([p for p in paths if os.path.exists(p)])
+    if paths and not types:
+        logging.warning(f'No types found in: {paths}')
+
+    return UDPListener(
+        dm,
+        listen,
+        types,
+        config.getint('udp', 'rcvbuf', fallback=8 * 1024 * 1024),
+    )
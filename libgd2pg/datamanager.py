@@ -1,21 +1,37 @@
-from .error import InvalidConfigError, InvalidDataError
+from .error import BackpressureError, InvalidConfigError, InvalidDataError
+from .cache import LRUCache
 from .config import GDConfig
+from .plan import RollupPlan
+from .sketch import DDSketch
+from .stats import STATS
 from collections import defaultdict, namedtuple
+from concurrent.futures import (
+    BrokenExecutor,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from array import array
 from io import StringIO
-from numpy import percentile
-from threading import RLock
+from math import ceil
+from multiprocessing import get_context
+from numpy import frombuffer, ndarray, percentile, vstack
+from threading import Lock, RLock
 from typing import (
     Union,
     Dict,
     Sequence,
     DefaultDict,
+    Iterable,
     List,
     Any,
     Tuple,
     NamedTuple,
+    Optional,
 )
 import logging
-import re
+import sys
+import time
 
 
 class DataTup(NamedTuple):
@@ -27,24 +43,212 @@ class DataTup(NamedTuple):
     value: Union[int, float]
 
 
+class MetricBuf:
+    """
+    Holds the values for a single metric in a compact array with the type
+    stored once.  Derives are kept as int64 and counters as uint64 so large
+    counters don't lose precision.  If a value doesn't fit, e.g. a float,
+    the buffer is converted to doubles.
+    """
+    TYPECODES = {'derive': 'q', 'counter': 'Q', 'absolute': 'Q'}
+    __slots__ = ('type', 'values')
+
+    def __init__(self, mtype: str, values: Optional[Sequence]=None):
+        self.type = mtype
+        self.values = array(self.TYPECODES.get(mtype, 'd'))
+        for val in (values or []):
+            self.add(val)
+
+    @property
+    def count(self) -> int:
+        return len(self.values)
+
+    def add(self, val: Union[int, float]) -> None:
+        try:
+            self.values.append(val)
+        except (TypeError, OverflowError):
+            self.values = array('d', self.values)
+            self.values.append(val)
+
+    def as_ndarray(self) -> ndarray:
+        """
+        Returns a numpy view of the values, without copying them
+        """
+        return frombuffer(self.values, dtype=self.values.typecode)
+
+    def sum(self) -> Union[int, float]:
+        # Python's sum won't overflow on large integers like numpy would
+        return sum(self.values)
+
+    def min(self) -> Union[int, float]:
+        return min(self.values)
+
+    def max(self) -> Union[int, float]:
+        return max(self.values)
+
+    def percentile(self, pct: int) -> float:
+        return percentile(self.as_ndarray(), pct)
+
+
+class SketchAcc:
+    """
+    A fixed memory accumulator for a single metric, used in place of the
+    MetricBuf when the "sketch" percentile engine is selected
+    """
+    __slots__ = ('type', 'sketch')
+
+    def __init__(self, mtype: str, sketch: DDSketch):
+        self.type = mtype
+        self.sketch = sketch
+
+    @property
+    def count(self) -> int:
+        return self.sketch.count
+
+    def add(self, val: Union[int, float]) -> None:
+        self.sketch.add(val)
+
+    def sum(self) -> Union[int, float]:
+        return self.sketch.sum
+
+    def min(self) -> Union[int, float]:
+        return self.sketch.min
+
+    def max(self) -> Union[int, float]:
+        return self.sketch.max
+
+    def percentile(self, pct: int) -> float:
+        return self.sketch.quantile(pct / 100)
+
+
+# The accumulators hold all the values received for a single metric
+Accumulator = Union[MetricBuf, SketchAcc]
+# (percentiles, value count) -> [(MetricBuf, [result keys])]
+PctBatches = Dict[Tuple[Tuple[int], int], List[Tuple[MetricBuf, List[str]]]]
+
+
 class DataManager:
-    PCT_RE = re.compile('pct\((\d+)\)', re.I)
-    LOCK = RLock()
+    AGG_MODES = ('batch', 'incremental')
+    PCT_ENGINES = ('exact', 'sketch')
+    AGG_POOLS = ('process', 'thread')
+    OVERLOAD_POLICIES = ('reject', 'drop')
 
     def __init__(self, config: GDConfig):
         self.config = config
-        self.ent_map = self._init_map()  # Map entities to received data
+        self.agg_mode = self.config['main'].get('agg_mode', 'batch')
+        if self.agg_mode not in self.AGG_MODES:
+            raise InvalidConfigError(
+                f'Invalid agg_mode "{self.agg_mode}", must be one of: '
+                f'{", ".join(self.AGG_MODES)}'
+            )
+        self.pct_engine = self.config['main'].get('pct_engine', 'exact')
+        if self.pct_engine not in self.PCT_ENGINES:
+            raise InvalidConfigError(
+                f'Invalid pct_engine "{self.pct_engine}", must be one of: '
+                f'{", ".join(self.PCT_ENGINES)}'
+            )
+        self.sketch_rel_acc = self.config['main'].getfloat(
+            'sketch_rel_acc', 0.01)
+        self.sketch_max_bins = self.config['main'].getint(
+            'sketch_max_bins', 1024)
+        # Cache of (plugin, plugin_instance, type, type_instance, dsnames)
+        # -> metric names
+        self.name_cache = LRUCache(
+            self.config['main'].getint('name_cache_size', 100000))
+        self._last_name_cache = (0, 0)
+        # The rollups to compute, per metric name
+        self.plan = RollupPlan(
+            self.config,
+            lambda rollup: getattr(self, f'_comp_{rollup}'),
+            self.config['main'].getint('name_cache_size', 100000),
+        )
+        # Optionally split the per entity aggregation over a worker pool
+        self.agg_workers = self.config['main'].getint('agg_workers', 0)
+        self.agg_pool = self.config['main'].get('agg_pool', 'process')
+        if self.agg_pool not in self.AGG_POOLS:
+            raise InvalidConfigError(
+                f'Invalid agg_pool "{self.agg_pool}", must be one of: '
+                f'{", ".join(self.AGG_POOLS)}'
+            )
+        self._pool = None
+        # The entities are split over a number of shards, each with their own
+        # lock, by a hash of the entity (host) name
+        self.num_shards = max(self.config['main'].getint('shards', 16), 1)
+        self._locks = [RLock() for _ in range(self.num_shards)]
+        # Map entities to received data
+        self._shards = [self._init_map() for _ in range(self.num_shards)]
+        # Limit the number of samples buffered until the next flush
+        self.max_buffered = self.config['main'].getint(
+            'max_buffered_samples', 0)
+        self.overload_policy = self.config['main'].get(
+            'overload_policy', 'reject')
+        if self.overload_policy not in self.OVERLOAD_POLICIES:
+            raise InvalidConfigError(
+                f'Invalid overload_policy "{self.overload_policy}", must be '
+                f'one of: {", ".join(self.OVERLOAD_POLICIES)}'
+            )
+        self.buffered = 0
+        self._buffered_lock = Lock()
+
+    @property
+    def incremental(self) -> bool:
+        return self.agg_mode == 'incremental'
+
+    @property
+    def ent_map(self) -> Dict[str, Any]:
+        """
+        A merged view of the entities in all the shards
+        """
+        return self._merge_shards(self._shards)
 
     def push(self, data: Union[Dict, Sequence[Dict]]) -> None:
         """
         This will push data into the ent map.  This takes either a list
-        or a single dict of data
+        or a single dict of data.
+
+        In incremental mode, the metric names are computed here, outside
+        the lock, and the DataTups are appended to the per-entity, per-metric
+        lists instead of storing the raw dicts.
+
+        If this would take the buffer past max_buffered_samples, none of the
+        data is added and, depending on the overload_policy, this either
+        raises a BackpressureError or silently drops the data.
         """
         if isinstance(data, dict):
             data = [data]
 
-        # Loop over all the data dicts, and manage those
-        self.LOCK.acquire()
+        self.push_batches([data])
+
+    def push_batches(self, batches: Iterable[Sequence[Dict]]) -> None:
+        """
+        Like push(), but for all the batches of a request.  Each batch is
+        prepared as it's read, then capacity is reserved once for the total,
+        so either all of the batches are added or none of them are.
+        """
+        prepared = []
+        samples = 0
+        for data in batches:
+            items_by_shard, count = self._prepare(data)
+            prepared.append(items_by_shard)
+            samples += count
+
+        STATS.incr('push.calls')
+        if not self._reserve(samples):
+            return
+
+        for items_by_shard in prepared:
+            self._store(items_by_shard)
+
+    def _prepare(
+            self,
+            data: Sequence[Dict],
+            ) -> Tuple[DefaultDict[int, List], int]:
+        """
+        Group the data by shard, computing the DataTups in incremental mode,
+        and count the samples
+        """
+        items_by_shard = defaultdict(list)
+        samples = 0
         for d in data:
             try:
                 ent = d['host']
@@ -53,22 +257,139 @@ class DataManager:
                 logging.debug('DATA: {}'.format(d))
                 continue
 
-            self.ent_map[ent].append(d)
-        self.LOCK.release()
+            if self.incremental:
+                try:
+                    d = self._get_metrics(d)
+                except InvalidDataError:
+                    continue
+                samples += len(d)
+            else:
+                samples += len(d.get('values') or ())
+
+            items_by_shard[hash(ent) % self.num_shards].append((ent, d))
+
+        return items_by_shard, samples
 
-    def get_metrics(self) -> Dict[str, Dict[str, Any]]:
+    def _store(self, items_by_shard: Dict[int, List]) -> None:
+        # Loop over all the data, and manage those, one shard at a time
+        for idx, items in items_by_shard.items():
+            start = time.perf_counter()
+            self._locks[idx].acquire()
+            wait_ms = (time.perf_counter() - start) * 1000
+            STATS.incr('push.lock_wait_ms', wait_ms)
+            STATS.max('push.lock_wait_ms.max', wait_ms)
+
+            try:
+                ent_map = self._shards[idx]
+                for ent, d in items:
+                    if self.incremental:
+                        ent_metrics = ent_map[ent]
+                        for dtup in d:
+                            self._add_dtup(ent_metrics, dtup)
+                    else:
+                        ent_map[ent].append(d)
+            finally:
+                self._locks[idx].release()
+
+    def get_metrics(
+            self,
+            ent_map: Optional[Dict[str, Any]]=None,
+            ) -> Dict[str, Dict[str, Any]]:
         """
-        This will roll up and return the aggregated metrics
+        This will roll up and return the aggregated metrics.  If an ent_map
+        isn't passed in, the current one is used, holding all the locks while
+        the metrics are computed.
         """
-        ret = {}
+        if ent_map is None:
+            self._acquire_all()
+            try:
+                return self.get_metrics(self.ent_map)
+            finally:
+                self._release_all()
+
         logging.debug('get_metrics() call started')
-        self.LOCK.acquire()
-        for ent, data in self.ent_map.items():
+        if self.agg_workers > 0 and len(ent_map) > 1:
+            ret = self._get_metrics_parallel(ent_map)
+        else:
+            ret = self._get_ent_metrics(list(ent_map.items()))
+        logging.debug('get_metrics() call finished')
+
+        return ret
+
+    def get_metrics_reset(self) -> Dict[str, Dict[str, Any]]:
+        """
+        This will get the metrics and reset the internal ent map.  The
+        shards are all swapped for fresh ones while holding every shard lock,
+        which gives a consistent snapshot, and the metrics are then computed
+        from the detached maps so push() is never blocked by the aggregation.
+        """
+        metrics = None
+        logging.debug('get_metrics_reset() call started')
+        self._acquire_all()
+        try:
+            shards = self._shards
+            self._shards = [self._init_map() for _ in range(self.num_shards)]
+            with self._buffered_lock:
+                STATS.gauge('push.buffered', self.buffered)
+                self.buffered = 0
+        finally:
+            self._release_all()
+        ent_map = self._merge_shards(shards)
+
+        try:
+            start = time.perf_counter()
+            metrics = self.get_metrics(ent_map)
+            STATS.gauge(
+                'agg.time_ms', (time.perf_counter() - start) * 1000)
+            STATS.gauge('agg.entities', len(ent_map))
+        except Exception:
+            logging.exception('Failed to get metrics')
+        else:
+            self._add_stats(metrics)
+        logging.debug('get_metrics_reset() call finished')
+
+        return metrics
+
+    def check_capacity(self) -> None:
+        """
+        Raises a BackpressureError if the buffer is already full and the
+        overload_policy is "reject", so a request can be turned away before
+        reading its body
+        """
+        if self.max_buffered > 0 and self.overload_policy == 'reject' and \
+                self.buffered >= self.max_buffered:
+            STATS.incr('push.rejected_calls')
+            raise BackpressureError(
+                f'{self.buffered} samples are buffered, the limit is '
+                f'{self.max_buffered}'
+            )
+
+    def close(self) -> None:
+        """
+        Shut down the aggregation worker pool, if there is one
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _get_ent_metrics(
+            self,
+            items: List[Tuple[str, Any]],
+            ) -> Dict[str, Dict[str, Any]]:
+        """
+        Compute the metrics for a list of (entity, data) items
+        """
+        ret = {}
+        for ent, data in items:
             try:
                 # First we have the get the "compiled" metric name/type/value
                 # DataTups to create an intermediate dictionary that we can use
-                # to compute the aggregated data points
-                agg_dtups = self._get_agg_dtups(data)
+                # to compute the aggregated data points.  In incremental mode,
+                # this has already been done in push()
+                if self.incremental:
+                    agg_dtups = data
+                else:
+                    agg_dtups = self._get_agg_dtups(data)
 
                 # Now we need to get the computed metrics for the data
                 comp_metrics = self._get_comp_metrics(agg_dtups)
@@ -77,30 +398,139 @@ class DataManager:
                 ret[ent] = comp_metrics
             except Exception as e:
                 logging.error(f'Failure in get_metrics in the datamanager: {e}')
-        self.LOCK.release()
-        logging.debug('get_metrics() call finished')
 
         return ret
 
-    def get_metrics_reset(self) -> Dict[str, Dict[str, Any]]:
+    def _get_metrics_parallel(
+            self,
+            ent_map: Dict[str, Any],
+            ) -> Dict[str, Dict[str, Any]]:
         """
-        This will get the metrics and reset the internal ent map
+        Split the entities into chunks and compute them in the worker pool.
+        The results are merged in the original entity order, so this returns
+        the same dict as the serial path.
         """
-        metrics = None
-        logging.debug('get_metrics_reset() call started')
-        self.LOCK.acquire()
+        items = list(ent_map.items())
+        # A few chunks per worker to even out the differences between hosts
+        chunk_size = ceil(len(items) / (self.agg_workers * 4))
+        chunks = [
+            items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+        if self._pool is None:
+            self._pool = self._get_pool()
+
+        if self.agg_pool == 'process':
+            func = _pool_get_ent_metrics
+        else:
+            func = self._get_ent_metrics
+
+        ret = {}
         try:
-            metrics = self.get_metrics()
-            self.ent_map = self._init_map()
-        except Exception:
-            logging.exception('Failed to get metrics')
-        finally:
-            self.LOCK.release()
-        logging.debug('get_metrics_reset() call finished')
+            for res in self._pool.map(func, chunks):
+                ret.update(res)
+        except BrokenExecutor:
+            # A worker died, e.g. OOM killed.  Start a new pool next time
+            # and keep this minute by computing it here.
+            logging.exception(
+                'The aggregation pool is broken, computing the metrics '
+                'serially'
+            )
+            STATS.incr('agg.pool_broken')
+            self._pool.shutdown(wait=False)
+            self._pool = None
+            return self._get_ent_metrics(items)
 
-        return metrics
+        return ret
+
+    def _get_pool(self) -> Executor:
+        logging.debug(
+            f'Starting a {self.agg_pool} pool with {self.agg_workers} workers')
+        if self.agg_pool == 'process':
+            # The workers build their own DataManager from a copy of the
+            # config.  Use spawn since forking a threaded server isn't safe.
+            conf = StringIO()
+            self.config.write(conf)
+            return ProcessPoolExecutor(
+                self.agg_workers,
+                mp_context=get_context('spawn'),
+                initializer=_pool_init,
+                initargs=(conf.getvalue(),),
+            )
+
+        return ThreadPoolExecutor(self.agg_workers, 'agg_worker')
+
+    def _reserve(self, samples: int) -> bool:
+        """
+        Account for samples about to be added to the buffer.  If that would
+        exceed max_buffered_samples, this returns False for the "drop"
+        overload_policy and raises a BackpressureError for "reject"
+        """
+        with self._buffered_lock:
+            if self.max_buffered <= 0 or \
+                    self.buffered + samples <= self.max_buffered:
+                self.buffered += samples
+                STATS.max('push.buffered.max', self.buffered)
+                return True
+            buffered = self.buffered
+
+        if self.overload_policy == 'drop':
+            STATS.incr('push.dropped', samples)
+            return False
+
+        STATS.incr('push.rejected', samples)
+        STATS.incr('push.rejected_calls')
+        raise BackpressureError(
+            f'Adding {samples} samples to the {buffered} buffered would '
+            f'exceed the limit of {self.max_buffered}'
+        )
+
+    def _acquire_all(self) -> None:
+        # Always acquire in the same order so we can't deadlock
+        for lock in self._locks:
+            lock.acquire()
+
+    def _release_all(self) -> None:
+        for lock in reversed(self._locks):
+            lock.release()
+
+    def _merge_shards(
+            self,
+            shards: List[Dict[str, Any]],
+            ) -> Dict[str, Any]:
+        ret = {}
+        for shard in shards:
+            ret.update(shard)
 
-    def _init_map(self) -> DefaultDict[str, List[Dict[str, Any]]]:
+        return ret
+
+    def _add_stats(self, metrics: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Add our own internal stats to the metrics, if enabled
+        """
+        # Report the name cache hits and misses for the last minute
+        hits, misses = self.name_cache.hits, self.name_cache.misses
+        last_hits, last_misses = self._last_name_cache
+        self._last_name_cache = (hits, misses)
+        hits -= last_hits
+        misses -= last_misses
+        STATS.incr('name_cache.hits', hits)
+        STATS.incr('name_cache.misses', misses)
+        STATS.gauge('name_cache.size', len(self.name_cache))
+        STATS.gauge(
+            'name_cache.hit_rate', hits / (hits + misses) if hits else 0.0)
+
+        stats_ent = self.config['main'].get('stats_entity', '')
+        if stats_ent:
+            metrics[stats_ent] = STATS.get_reset()
+
+    def _init_map(self) -> DefaultDict[str, Any]:
+        """
+        Returns a new, empty ent map.  In batch mode this maps
+        entity -> [raw data dicts] and in incremental mode it maps
+        entity -> metric name -> Accumulator
+        """
+        if self.incremental:
+            return defaultdict(dict)
         return defaultdict(list)
 
     def _get_metrics(self, data: Dict[str, Any]) -> List[DataTup]:
@@ -109,29 +539,25 @@ class DataManager:
         a list of DataTup for each specific metric in this data instance
         """
         ret = []
-        s = StringIO()
         try:
-            s.write(data['plugin'])
-
-            if data['plugin_instance']:
-                s.write('.{}'.format(data['plugin_instance']))
-
-            if data['plugin'] != data['type']:
-                s.write('.{}'.format(data['type']))
-
-            if data['type_instance']:
-                s.write('.{}'.format(data['type_instance']))
-
-            metric_name = s.getvalue()
-            for i, dsn in enumerate(data['dsnames']):
-                if dsn == 'value':
-                    ret.append(DataTup(
-                        metric_name, data['dstypes'][i], data['values'][i]))
-                else:
-                    tmp = '{}.{}'.format(metric_name, dsn)
-                    if data['values'][i] is not None:
-                        ret.append(DataTup(
-                            tmp, data['dstypes'][i], data['values'][i]))
+            key = (
+                data['plugin'],
+                data['plugin_instance'],
+                data['type'],
+                data['type_instance'],
+                tuple(data['dsnames']),
+            )
+            names = self.name_cache.get(key)
+            if names is None:
+                names = self._get_metric_names(*key)
+                self.name_cache.set(key, names)
+
+            for i, name in enumerate(names):
+                val = data['values'][i]
+                if val is not None and not isinstance(val, (int, float)):
+                    raise TypeError(f'Invalid value for {name}: {val!r}')
+                if val is not None or key[4][i] == 'value':
+                    ret.append(DataTup(name, data['dstypes'][i], val))
         except Exception:
             logging.error('Invalid data object for metric name')
             logging.debug('DATA: {}'.format(data))
@@ -140,93 +566,186 @@ class DataManager:
         # If we've made it here, return the metrics
         return ret
 
+    def _get_metric_names(
+            self,
+            plugin: str,
+            plugin_instance: str,
+            mtype: str,
+            type_instance: str,
+            dsnames: Tuple[str],
+            ) -> Tuple[str]:
+        """
+        Builds the metric name for each of the dsnames.  The names are
+        interned since the same ones are used over and over.
+        """
+        s = StringIO()
+        s.write(plugin)
+
+        if plugin_instance:
+            s.write('.{}'.format(plugin_instance))
+
+        if plugin != mtype:
+            s.write('.{}'.format(mtype))
+
+        if type_instance:
+            s.write('.{}'.format(type_instance))
+
+        metric_name = s.getvalue()
+        names = []
+        for dsn in dsnames:
+            if dsn == 'value':
+                names.append(sys.intern(metric_name))
+            else:
+                names.append(sys.intern('{}.{}'.format(metric_name, dsn)))
+
+        return tuple(names)
+
     def _get_agg_dtups(
             self,
             data: List[Dict[str, Any]],
-            ) -> Dict[str, List[DataTup]]:
+            ) -> Dict[str, Accumulator]:
         """
-        This will return a mapping of metric name -> list of DataTups
+        This will return a mapping of metric name -> Accumulator
         """
-        metrics = defaultdict(list)
+        metrics = {}
         for datad in data:
             dtups = self._get_metrics(datad)
             for dtup in dtups:
-                metrics[dtup.name].append(dtup)
+                self._add_dtup(metrics, dtup)
 
         return metrics
 
+    def _add_dtup(
+            self,
+            metrics: Dict[str, Accumulator],
+            dtup: DataTup,
+            ) -> None:
+        """
+        Add the DataTup value to the accumulator for its metric name
+        """
+        acc = metrics.get(dtup.name)
+        if acc is None:
+            acc = metrics[dtup.name] = self._new_acc(dtup.type)
+
+        if dtup.value is not None:
+            acc.add(dtup.value)
+        else:
+            logging.error(f'Invalid None in dtup: {dtup}')
+
+    def _new_acc(self, mtype: str) -> Accumulator:
+        if self.pct_engine == 'sketch':
+            return SketchAcc(
+                mtype, DDSketch(self.sketch_rel_acc, self.sketch_max_bins))
+        return MetricBuf(mtype)
+
+    def _as_acc(
+            self,
+            data: Union[Accumulator, List[DataTup]],
+            ) -> Accumulator:
+        """
+        Returns the data as an Accumulator, converting a list of DataTups
+        """
+        if isinstance(data, list):
+            metrics = {}
+            for dtup in data:
+                self._add_dtup(metrics, dtup)
+            return metrics[data[0].name]
+        return data
+
     def _get_comp_metrics(
             self,
-            agg_dtups: Dict[str, List[DataTup]],
+            agg_dtups: Dict[str, Accumulator],
             ) -> Dict[str, Any]:
         """
-        Given the dictionary including the list of aggregated DataTups,
-        return a final dict of computed metric_name -> value
+        Given the dictionary of metric name -> Accumulator, return a final
+        dict of computed metric_name -> value
         """
         ret = {}
+        # The percentiles for the MetricBufs are computed together at the end
+        pct_batches = defaultdict(list)
         for metric_name, data in agg_dtups.items():
-            # TODO: Add rollup overrides on metric name
-            rollups = self.config['main'].getlist(
-                'rollups_{}'.format(data[0].type))
+            data = self._as_acc(data)
+            rollups = self.plan.get(metric_name, data.type)
+            if rollups is None:
+                logging.error(
+                    f'No rollups defined for type "{data.type}" of metric: '
+                    f'{metric_name}'
+                )
+                continue
+
+            pcts = []
+            keys = []
             for rollup in rollups:
                 # Get the computed result for the rollup
-                suffix = rollup
-                m = self.PCT_RE.match(rollup)
-                if m:
-                    # We have a percentile to manage here
-                    rollup = 'pct'
-                    pct = int(m.group(1))
-                    res = getattr(self, '_comp_{}'.format(rollup))(data, pct)
-                    suffix = 'p{}'.format(pct)
+                key = '{}.{}'.format(metric_name, rollup.suffix)
+                if rollup.pct is None:
+                    ret[key] = rollup.func(data)
+                elif isinstance(data, MetricBuf) and data.count:
+                    # Hold the place in the results, this is filled in below
+                    ret[key] = None
+                    pcts.append(rollup.pct)
+                    keys.append(key)
                 else:
-                    res = getattr(self, '_comp_{}'.format(rollup))(data)
-                ret['{}.{}'.format(metric_name, suffix)] = res
+                    ret[key] = rollup.func(data, rollup.pct)
 
-        return ret
+            if pcts:
+                pct_batches[(tuple(pcts), data.count)].append((data, keys))
 
-    def _comp_sum(self, data: List[DataTup]) -> Union[float, int]:
-        total = 0
-        for dtup in data:
-            if dtup.value is not None:
-                total += dtup.value
-            else:
-                logging.error(f'Invalid None in dtup: {dtup}')
+        self._comp_pct_batches(pct_batches, ret)
 
-        return total
+        return ret
 
-    def _comp_sumb(self, data: List[DataTup]) -> Union[float, int]:
+    def _comp_pct_batches(
+            self,
+            pct_batches: PctBatches,
+            ret: Dict[str, Any],
+            ) -> None:
+        """
+        Compute all the percentiles for the batched MetricBufs, updating
+        ret with the results.  Each batch has the same percentiles and the
+        same number of values, so it's stacked into a single 2d array and all
+        its percentiles are computed in a single numpy call.
+        """
+        for (pcts, _), items in pct_batches.items():
+            vals = vstack([buf.as_ndarray() for buf, _ in items])
+            # This is indexed as res[pct][metric]
+            res = percentile(vals, pcts, axis=1)
+            for i, (_, keys) in enumerate(items):
+                for j, key in enumerate(keys):
+                    ret[key] = res[j, i]
+
+    def _comp_sum(self, data: Accumulator) -> Union[float, int]:
+        return self._as_acc(data).sum()
+
+    def _comp_sumb(self, data: Accumulator) -> Union[float, int]:
         """
         Sum from the base, aka, use the first metric as the base and
         compute the sum from that
         """
-        min_val = data[0].value
-        max_val = min_val
-        # Find the smallest and largest values to get the difference between
-        # them
-        for dtup in data:
-            if dtup.value < min_val:
-                min_val = dtup.value
-            if dtup.value > max_val:
-                max_val = dtup.value
-
-        return max_val - min_val
+        data = self._as_acc(data)
+        if not data.count:
+            return None
+        # The difference between the smallest and largest values
+        return data.max() - data.min()
 
-    def _comp_avg(self, data: List[DataTup]) -> Union[float, int]:
-        total = self._comp_sum(data)
-        return total / len(data)
+    def _comp_avg(self, data: Accumulator) -> Union[float, int]:
+        data = self._as_acc(data)
+        if not data.count:
+            return None
+        return data.sum() / data.count
 
     def _comp_pct(
             self,
-            data: List[DataTup],
+            data: Accumulator,
             pct: int,
             ) -> Union[float, int]:
         """
         Compute the percentile specified and return it
         """
-        vals = [i.value for i in data if i.value is not None]
-        if not vals:
+        data = self._as_acc(data)
+        if not data.count:
             return None
-        return percentile(vals, pct)
+        return data.percentile(pct)
 
 
 #
@@ -253,6 +772,28 @@ def get_datamanager(config: GDConfig=None) -> DataManager:
 # Shortcut name for get_datamanager
 dm = get_datamanager
 
+
+#
+# Aggregation process pool worker functions
+#
+
+# The DataManager instance in a pool worker process
+POOL_DM = None
+
+
+def _pool_init(conf_str: str) -> None:
+    global POOL_DM
+
+    config = GDConfig()
+    config.read_string(conf_str)
+    POOL_DM = DataManager(config)
+
+
+def _pool_get_ent_metrics(
+        items: List[Tuple[str, Any]],
+        ) -> Dict[str, Dict[str, Any]]:
+    return POOL_DM._get_ent_metrics(items)
+
 # Sample data - TODO: delete later
 """
     {
@@ -1,9 +1,26 @@
+import numpy as np
 import psycopg2
 import logging
 import time
+from calendar import timegm
+from .cache import LRUCache
+from .error import InvalidConfigError
+from .pool import CONN_ERRORS, ConnPool, is_conn_lost
 from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from psycopg2.extras import execute_values
 from textwrap import dedent
-from typing import Sequence, Dict, TYPE_CHECKING, Optional, Any, List, Tuple
+from typing import (
+    Sequence,
+    Dict,
+    TYPE_CHECKING,
+    Optional,
+    Any,
+    List,
+    Tuple,
+    Iterator,
+    Callable,
+)
 
 
 if TYPE_CHECKING:
@@ -12,19 +29,83 @@ if TYPE_CHECKING:
 
 class DB:
     DT_TF = '%Y-%m-%d %H:%M:%S'
+    INSERT_MODES = ('row', 'copy', 'multi')
+    ROLLUP_MODES = ('python', 'sql')
+    # A tsd row in the binary COPY output read by _copy_rollup_rows.  Each
+    # field is preceded by its length, and every one is fixed width.
+    ROLLUP_ROW = np.dtype([
+        ('num_fields', '>i2'),
+        ('id_len', '>i4'),
+        ('id', '>i8'),
+        ('added_len', '>i4'),
+        ('added', '>i8'),
+        ('value_len', '>i4'),
+        ('value', '>f8'),
+    ])
+    COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\0'
 
     def __init__(self, config: 'GDConfig'):
         self.config = config
-        self.conn = self._get_conn()
-        self.conn.autocommit = False
+        self.insert_mode = self.config['main'].get('insert_mode', 'row')
+        if self.insert_mode not in self.INSERT_MODES:
+            raise InvalidConfigError(
+                f'Invalid insert_mode "{self.insert_mode}", must be one of: '
+                f'{", ".join(self.INSERT_MODES)}'
+            )
+        # Every method borrows a connection from the pool, so the DB can be
+        # shared by threads
+        self.pool = ConnPool(
+            self._get_conn,
+            self.config['main'].getint('db_pool_size', 4),
+            self.config['main'].getfloat('db_check_interval', 30.0),
+            self.config['main'].getfloat('db_pool_timeout', 30.0),
+        )
+        # How many times to retry, on a new connection, if the connection
+        # is lost
+        self.retries = self.config['main'].getint('db_retries', 2)
+        self.retry_backoff = self.config['main'].getfloat(
+            'db_retry_backoff', 1.0)
+
+        # Client side caches of entity/key name -> id, warmed on the first
+        # insert so the DBs that never insert (e.g. for rollups) don't pay
+        # for it
+        cache_size = self.config['main'].getint('id_cache_size', 100000)
+        self.ent_cache = LRUCache(cache_size)
+        self.key_cache = LRUCache(cache_size)
+        self._caches_warmed = False
 
     def __del__(self):
-        if hasattr(self, 'conn') and self.conn:
+        if hasattr(self, 'pool'):
             try:
-                self.conn.close()
+                self.pool.close()
             except Exception:
                 pass
 
+    def run(self, func: Callable[[Any], Any]) -> Any:
+        """
+        Calls func(conn) with a connection from the pool and returns the
+        result.  If the connection is lost (e.g. AdminShutdown when the
+        server restarts), func is retried on a new connection, up to
+        "db_retries" times, backing off exponentially.  func is responsible
+        for committing, anything left uncommitted is rolled back.
+        """
+        attempt = 0
+        while True:
+            conn = None
+            try:
+                with self.pool.connection() as conn:
+                    return func(conn)
+            except CONN_ERRORS as e:
+                # Anything else, e.g. a statement timeout or a deadlock, is
+                # up to the caller
+                if not is_conn_lost(e, conn) or attempt >= self.retries:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                attempt += 1
+                logging.error(
+                    f'The db connection failed, retrying in {delay:.1f}s: {e}')
+                time.sleep(delay)
+
     def query(
             self,
             query: str,
@@ -39,23 +120,17 @@ class DB:
             return True
 
 
+        def _query(conn):
+            with conn.cursor() as curs:
+                curs.execute(query, args)
+            conn.commit()
+
         logging.debug(f'Running arbitrary query: {query}')
         try:
-            with self.conn.cursor() as curs:
-                curs.execute(query, args)
-        except psycopg2.errors.AdminShutdown:
-            logging.error('The connection has been terminated, reconnecting')
-            self.conn = self._get_conn()
-            return self.query(query)
+            self.run(_query)
         except Exception as e:
-            # Log the exception and roll back
-            logging.exception('Failed to insert metrics into the db')
-            try:
-                self.conn.rollback()
-            except Exception:
-                logging.exception('Failure on rollback')
+            logging.exception(f'Failed to run the query: {e}')
         else:
-            self.conn.commit()
             ret = True
 
         logging.debug('Arbitrary query finished')
@@ -66,15 +141,28 @@ class DB:
             self,
             metrics: Dict[str, Dict[str, Any]],
             dt: Optional[datetime]=None,
-            minute_mark: Optional[bool]=True) -> bool:
+            minute_mark: Optional[bool]=True,
+            retry: Optional[bool]=True) -> bool:
         """
         This will insert the metrics for the specified timestamp.  If
         timestamp is not specified, the current timestamp will be used.
+
+        The write path is selected by the "insert_mode" config option:
+
+            row   - one INSERT per metric
+            copy  - stream the whole batch into tsd with COPY
+            multi - a single multi-row INSERT for the whole batch
+
+        In all modes, the entity and key ids are looked up in the id caches
+        and any unknown names are resolved in one batch per table.
         """
         if not metrics:
             # If we receive an empty set of metrics, return True
             return True
 
+        if not self._caches_warmed:
+            self._warm_id_caches()
+
         ret = False
         dt = datetime.utcnow() if dt is None else dt
         if minute_mark:
@@ -83,46 +171,228 @@ class DB:
         else:
             dt_str = dt.strftime('%Y-%m-%d %H:%M:%S')
 
-        query = dedent(
-            '''
-            INSERT INTO tsd (entity_id, key_id, added, value) VALUES
-            (ent_id(%s), key_id(%s), %s, %s);
-            ''').strip()
+        def _insert(conn):
+            with conn.cursor() as curs:
+                if self.insert_mode == 'copy':
+                    count = self._insert_copy(curs, metrics, dt_str)
+                elif self.insert_mode == 'multi':
+                    count = self._insert_multi(curs, metrics, dt_str)
+                else:
+                    count = self._insert_rows(curs, metrics, dt_str)
+            conn.commit()
+            return count
 
-        logging.debug('Starting INSERT query')
+        count = 0
+        logging.debug(f'Starting INSERT query in {self.insert_mode} mode')
         start = time.time()
         try:
-            with self.conn.cursor() as curs:
-                for entity, keys in metrics.items():
-                    for key, val in keys.items():
-                        if val is not None:
-                            logging.debug(f'Running insert with {entity} '
-                                f'{key} {dt_str} {val}')
-                            curs.execute(query, (entity, key, dt_str, val))
-                        else:
-                            logging.warn(
-                                f'Found an invalid value for {entity}::{key}, '
-                                'not inserting into db'
-                            )
-        except psycopg2.errors.AdminShutdown:
-            logging.error('The connection has been terminated, reconnecting')
-            self.conn = self._get_conn()
-        except psycopg2.InterfaceError as e:
-            logging.error(f'Interface error, reconnecting: {e}')
-            self.conn = self._get_conn()
+            count = self.run(_insert)
+        except psycopg2.errors.ForeignKeyViolation as e:
+            # A cached id has been deleted out from under us (see
+            # pod-cleanup.sh), so drop the caches and try again
+            logging.warning(f'Stale id cache, clearing it: {e}')
+            self.ent_cache.clear()
+            self.key_cache.clear()
+            if retry:
+                return self.insert_metrics(metrics, dt, minute_mark, False)
         except Exception as e:
-            # Log the exception and roll back
             logging.exception(f'Failed to insert metrics into the db: {e}')
-            self.conn.rollback()
         else:
-            self.conn.commit()
             ret = True
 
         itime = time.time() - start
-        logging.debug(f'INSERT query finished in {itime:.02f}')
+        logging.debug(
+            f'INSERT of {count} rows in {self.insert_mode} mode finished in '
+            f'{itime:.02f}s'
+        )
+        logging.debug(
+            f'Id cache stats: entities: {self.ent_cache.stats()}, '
+            f'keys: {self.key_cache.stats()}'
+        )
+
+        return ret
+
+    def _insert_rows(
+            self,
+            curs: psycopg2.extensions.cursor,
+            metrics: Dict[str, Dict[str, Any]],
+            dt_str: str) -> int:
+        """
+        Insert the metrics one row at a time
+        """
+        query = dedent(
+            '''
+            INSERT INTO tsd (entity_id, key_id, added, value) VALUES
+            (%s, %s, %s, %s);
+            ''').strip()
+
+        rows = self._get_id_rows(curs, metrics)
+        for eid, kid, val in rows:
+            logging.debug(f'Running insert with {eid} {kid} {dt_str} {val}')
+            curs.execute(query, (eid, kid, dt_str, val))
+
+        return len(rows)
+
+    def _insert_copy(
+            self,
+            curs: psycopg2.extensions.cursor,
+            metrics: Dict[str, Dict[str, Any]],
+            dt_str: str) -> int:
+        """
+        Stream the entire batch into tsd using COPY ... FROM STDIN
+        """
+        rows = self._get_id_rows(curs, metrics)
+        buf = StringIO()
+        for eid, kid, val in rows:
+            buf.write(f'{eid}\t{kid}\t{dt_str}\t{float(val)!r}\n')
+        buf.seek(0)
+
+        curs.copy_expert(
+            'COPY tsd (entity_id, key_id, added, value) FROM STDIN', buf)
+
+        return len(rows)
+
+    def _insert_multi(
+            self,
+            curs: psycopg2.extensions.cursor,
+            metrics: Dict[str, Dict[str, Any]],
+            dt_str: str) -> int:
+        """
+        Insert the entire batch with a single multi-row INSERT
+        """
+        rows = self._get_id_rows(curs, metrics)
+        if rows:
+            execute_values(
+                curs,
+                'INSERT INTO tsd (entity_id, key_id, added, value) VALUES %s',
+                [(eid, kid, dt_str, val) for eid, kid, val in rows],
+                page_size=len(rows),
+            )
+
+        return len(rows)
+
+    def _get_id_rows(
+            self,
+            curs: psycopg2.extensions.cursor,
+            metrics: Dict[str, Dict[str, Any]],
+            ) -> List[Tuple[int, int, Any]]:
+        """
+        Resolves the entity and key ids for the batch and returns a list of
+        (entity_id, key_id, value)
+        """
+        vals = list(self._iter_vals(metrics))
+        ent_ids = self._resolve_ids(
+            curs,
+            'entities',
+            'entity',
+            {e for e, _, _ in vals},
+            self.ent_cache,
+        )
+        key_ids = self._resolve_ids(
+            curs,
+            'keys',
+            'key',
+            {k for _, k, _ in vals},
+            self.key_cache,
+        )
+
+        return [(ent_ids[e], key_ids[k], v) for e, k, v in vals]
+
+    def _resolve_ids(
+            self,
+            curs: psycopg2.extensions.cursor,
+            table: str,
+            col: str,
+            names: Sequence[str],
+            cache: LRUCache,
+            ) -> Dict[str, int]:
+        """
+        Returns a map of name -> id for the given names.  Names that aren't
+        in the cache are created/fetched with a single INSERT ... RETURNING
+        which is committed right away so that we never cache an id from
+        a transaction that gets rolled back.
+        """
+        ret = {}
+        misses = []
+        for name in names:
+            nid = cache.get(name)
+            if nid is None:
+                misses.append((name,))
+            else:
+                ret[name] = nid
+
+        if misses:
+            logging.debug(f'Resolving {len(misses)} unknown names in {table}')
+            # The no-op update is needed so that existing rows are returned
+            res = execute_values(
+                curs,
+                dedent(
+                    f'''
+                    INSERT INTO {table} ({col}) VALUES %s
+                    ON CONFLICT ({col}) DO UPDATE SET {col} = EXCLUDED.{col}
+                    RETURNING id, {col}
+                    '''
+                ),
+                misses,
+                page_size=len(misses),
+                fetch=True,
+            )
+            curs.connection.commit()
+            for nid, name in res:
+                ret[name] = nid
+                cache.set(name, nid)
 
         return ret
 
+    def _warm_id_caches(self) -> None:
+        """
+        Prime the id caches with the most recent entities and keys.  This
+        is only tried once, a failure just leaves the caches to fill as ids
+        are resolved.
+        """
+        self._caches_warmed = True
+        for table, col, cache in (
+                ('entities', 'entity', self.ent_cache),
+                ('keys', 'key', self.key_cache)):
+            if cache.max_size <= 0:
+                continue
+
+            def _warm(conn):
+                with conn.cursor() as curs:
+                    curs.execute(
+                        f'SELECT id, {col} FROM {table} '
+                        'ORDER BY id DESC LIMIT %s',
+                        (cache.max_size,),
+                    )
+                    return curs.fetchall()
+
+            try:
+                rows = self.run(_warm)
+            except Exception as e:
+                logging.exception(f'Failed to warm the {table} id cache: {e}')
+            else:
+                # Insert oldest first so the newest are the last evicted
+                for nid, name in reversed(rows):
+                    cache.set(name, nid)
+                logging.debug(f'Warmed the {table} cache with {len(cache)} ids')
+
+    def _iter_vals(
+            self,
+            metrics: Dict[str, Dict[str, Any]],
+            ) -> Iterator[Tuple[str, str, Any]]:
+        """
+        Yields (entity, key, value) for all the valid values in the metrics
+        """
+        for entity, keys in metrics.items():
+            for key, val in keys.items():
+                if val is not None:
+                    yield (entity, key, val)
+                else:
+                    logging.warning(
+                        f'Found an invalid value for {entity}::{key}, '
+                        'not inserting into db'
+                    )
+
     def vacuum(
             self,
             table: Optional[str]='',
@@ -140,23 +410,22 @@ class DB:
             logging.info(f'Would have run: {query}')
             return ret
 
-        cur_isolation = self.conn.isolation_level
+        def _vacuum(conn):
+            cur_isolation = conn.isolation_level
+            # VACUUM can't run in a transaction
+            conn.set_isolation_level(0)
+            try:
+                with conn.cursor() as curs:
+                    curs.execute(query)
+            finally:
+                conn.set_isolation_level(cur_isolation)
 
         logging.debug(f'Running VACUUM query: {query}')
         try:
-            self.conn.set_isolation_level(0)
-            curs = self.conn.cursor()
-            curs.execute(query)
-        except psycopg2.errors.AdminShutdown:
-            logging.error('The connection has been terminated, reconnecting')
-            self.conn = self._get_conn()
-            ret = False
+            self.run(_vacuum)
         except Exception as e:
-            # Log the exception and roll back
-            logging.exception('Failed to vacuum table: {}'.format(table))
+            logging.exception(f'Failed to vacuum table {table}: {e}')
             ret = False
-        finally:
-            self.conn.set_isolation_level(cur_isolation)
 
         return ret
 
@@ -166,50 +435,361 @@ class DB:
             roll_period: int,
             end_time: Optional[datetime]=None,  # Further back in time
             dry_run: Optional[bool]=False,  # Rollback the changes
+            mode: Optional[str]='python',
+            tier: Optional[str]=None,
             ):
         """
-        This will do a rollup for a time period and an aggregation period
+        This will do a rollup for a time period and an aggregation period.
+
+        In "python" mode, the rows for each entity and key are fetched,
+        compressed with _compress_vals and written back.  In "sql" mode,
+        the whole time period is rolled up inside the db, see _rollup_sql.
+
+        If a tier (the rollup's name) is given, how far each series has
+        been rolled up is checkpointed in the rollup_watermarks table, in
+        the same transaction as its rollup.  Each run then only touches
+        the time since the watermark, and an interrupted run picks up
+        where it stopped.  start_time is aligned down to a multiple of
+        roll_period so no bucket is split between runs.
         """
+        if mode not in self.ROLLUP_MODES:
+            raise InvalidConfigError(
+                f'Invalid rollup_mode "{mode}", must be one of: '
+                f'{", ".join(self.ROLLUP_MODES)}'
+            )
+
         # Go all the way back if nothing is specified for end time
         end_time = datetime(1970, 1, 1) if not end_time else end_time
+        if tier:
+            start_time = self.align_time(start_time, roll_period)
+        if mode == 'sql':
+            return self._rollup_sql(
+                start_time, roll_period, end_time, dry_run, tier)
+
         entity_ids = self._get_entities()
 
         for eid in entity_ids:
-            count = 0
-            key_ids = self._get_keys_for_ent(eid)
+            self.rollup_entity(
+                eid, start_time, roll_period, end_time, dry_run, tier)
+
+    @staticmethod
+    def align_time(dt: datetime, period: int) -> datetime:
+        """
+        Round the (UTC) time down to a multiple of period seconds since the
+        epoch
+        """
+        return dt - timedelta(
+            seconds=timegm(dt.timetuple()) % period,
+            microseconds=dt.microsecond,
+        )
+
+    def rollup_entity(
+            self,
+            eid: int,
+            start_time: datetime,
+            roll_period: int,
+            end_time: datetime,
+            dry_run: Optional[bool]=False,
+            tier: Optional[str]=None,
+            ) -> Tuple[int, int]:
+        """
+        Roll up all the keys for an entity, returning the number of keys
+        and how many of them failed.  A failure for one key is logged and
+        doesn't stop the rest.  See do_rollup for the tier.
+        """
+        count = 0
+        failed = 0
+        key_ids = self._get_keys_for_ent(eid)
+        watermarks = self._get_watermarks(tier, eid) if tier else {}
+        logging.debug(
+            f'Running {len(key_ids)} key rollups for ent id: {eid}'
+        )
+        for kid in key_ids:
+            count += 1
+            perc = (count / len(key_ids)) * 100
             logging.debug(
-                f'Running {len(key_ids)} key rollups for ent id: {eid}'
+                f'Running rollups for key id: {kid}; ~{perc:.01f}% '
+                f'complete for ent id {eid}'
+            )
+            try:
+                if not self._rollup_and_del(
+                        start_time, roll_period, eid, kid, end_time, dry_run,
+                        tier, watermarks.get(kid)):
+                    failed += 1
+            except Exception as e:
+                logging.exception(
+                    f'Failed the rollup for ent id {eid}, key id {kid}: {e}')
+                failed += 1
+
+        return len(key_ids), failed
+
+    def _rollup_sql(
+            self,
+            start_time: datetime,
+            roll_period: int,
+            end_time: datetime,
+            dry_run: bool,
+            tier: Optional[str]=None):
+        """
+        Roll up every series between end_time and start_time with a single
+        DELETE ... RETURNING feeding an INSERT ... SELECT ... GROUP BY per
+        month, so each statement stays within one tsd partition and each
+        month is its own transaction.
+
+        The values are averaged in buckets of roll_period seconds aligned
+        to the epoch, and stored at the last time in each bucket.  The
+        Python path starts a new bucket roll_period after the first row of
+        the previous one instead, which is the same grid as long as the
+        data is regular and starts on a bucket boundary.
+
+        With a tier, rows before their series' watermark are skipped and the
+        watermarks of the series rolled up in each month are moved to its
+        end, in the same statement.
+        """
+        query = dedent(
+            '''
+            WITH del AS (
+                DELETE FROM tsd
+                WHERE added >= %(lo)s AND added < %(hi)s
+                RETURNING entity_id, key_id, added, value
+            )
+            INSERT INTO tsd (entity_id, key_id, added, value)
+            SELECT entity_id, key_id, max(added), avg(value)
+            FROM del
+            GROUP BY
+                entity_id,
+                key_id,
+                floor(extract(epoch FROM added) / %(period)s)
+            '''
+        )
+        if tier:
+            query = dedent(
+                '''
+                WITH del AS (
+                    DELETE FROM tsd t
+                    WHERE added >= %(lo)s AND added < %(hi)s
+                        AND NOT EXISTS (
+                            SELECT 1 FROM rollup_watermarks w
+                            WHERE w.tier = %(tier)s
+                                AND w.entity_id = t.entity_id
+                                AND w.key_id = t.key_id
+                                AND w.rolled_to > t.added
+                        )
+                    RETURNING entity_id, key_id, added, value
+                ), ins AS (
+                    INSERT INTO tsd (entity_id, key_id, added, value)
+                    SELECT entity_id, key_id, max(added), avg(value)
+                    FROM del
+                    GROUP BY
+                        entity_id,
+                        key_id,
+                        floor(extract(epoch FROM added) / %(period)s)
+                    RETURNING entity_id, key_id
+                )
+                INSERT INTO rollup_watermarks
+                    (tier, entity_id, key_id, rolled_to)
+                SELECT DISTINCT %(tier)s, entity_id, key_id, %(hi)s
+                FROM ins
+                ON CONFLICT (tier, entity_id, key_id) DO UPDATE
+                SET rolled_to = GREATEST(
+                    rollup_watermarks.rolled_to, EXCLUDED.rolled_to)
+                '''
             )
-            for kid in key_ids:
-                count += 1
-                perc = (count / len(key_ids)) * 100
-                logging.debug(
-                    f'Running rollups for key id: {kid}; ~{perc:.01f}% '
-                    f'complete for ent id {eid}'
+
+        # Skip straight to the oldest data in the range
+        first = self.run(lambda conn: self._fetchall(
+            conn,
+            'SELECT min(added) FROM tsd WHERE added > %s AND added < %s',
+            (end_time, start_time),
+        ))[0][0]
+        if first is None:
+            logging.debug('Nothing to roll up')
+            return
+
+        def _rollup(conn, lo, hi):
+            with conn.cursor() as curs:
+                curs.execute(query, {
+                    'lo': lo,
+                    'hi': hi,
+                    'period': roll_period,
+                    'tier': tier,
+                })
+                count = curs.rowcount
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+            return count
+
+        for lo, hi in self._get_month_windows(first, start_time):
+            logging.debug(f'Running SQL rollup for {lo} -> {hi}')
+            try:
+                count = self.run(lambda conn: _rollup(conn, lo, hi))
+            except Exception as e:
+                logging.exception(f'Failed the rollup for {lo} -> {hi}: {e}')
+            else:
+                logging.info(
+                    f'Rolled up {lo} -> {hi} into {count} '
+                    f'{"series" if tier else "rows"} of {roll_period}s'
                 )
-                self._rollup_and_del(
-                    start_time, roll_period, eid, kid, end_time, dry_run)
 
+    def fill_tier(
+            self,
+            period: int,
+            end_time: datetime,
+            dry_run: Optional[bool]=False,
+            ) -> int:
+        """
+        Incrementally fill the tier of period seconds, in tsd_tiers, with the
+        count, sum, min, max and last value of every series per bucket of
+        period seconds aligned to the epoch.  The tier's partition,
+        tsd_tier_<period>, is created if needed.
+
+        Only the raw data since the last fill, up to end_time rounded down
+        to the period, is read.  This is done a month (partition) at a time,
+        with the fill recorded in tier_watermarks in the same transaction.
+        Returns the number of buckets written.
+
+        Rows added to tsd for times that have already been filled aren't
+        picked up, so end_time should leave time for late data, and the
+        tiers must be filled before the raw data is rolled up.
+        """
+        end_time = self.align_time(end_time, period)
+        if not self.query(
+                f'CREATE TABLE IF NOT EXISTS tsd_tier_{int(period)} '
+                f'PARTITION OF tsd_tiers FOR VALUES IN ({int(period)})',
+                dry_run=dry_run):
+            return 0
+
+        query = dedent(
+            '''
+            INSERT INTO tsd_tiers (
+                period, entity_id, key_id, bucket,
+                count, sum, min, max, last, last_added
+            )
+            SELECT
+                %(period)s,
+                entity_id,
+                key_id,
+                to_timestamp(
+                    floor(extract(epoch FROM added) / %(period)s) * %(period)s
+                ) AT TIME ZONE 'UTC',
+                count(*),
+                sum(value),
+                min(value),
+                max(value),
+                (array_agg(value ORDER BY added DESC))[1],
+                max(added)
+            FROM tsd
+            WHERE added >= %(lo)s AND added < %(hi)s
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (period, entity_id, key_id, bucket) DO UPDATE
+            SET
+                count = tsd_tiers.count + EXCLUDED.count,
+                sum = tsd_tiers.sum + EXCLUDED.sum,
+                min = LEAST(tsd_tiers.min, EXCLUDED.min),
+                max = GREATEST(tsd_tiers.max, EXCLUDED.max),
+                last = CASE
+                    WHEN EXCLUDED.last_added >= tsd_tiers.last_added
+                    THEN EXCLUDED.last ELSE tsd_tiers.last END,
+                last_added = GREATEST(
+                    tsd_tiers.last_added, EXCLUDED.last_added)
+            '''
+        )
+        wm_query = dedent(
+            '''
+            INSERT INTO tier_watermarks (period, filled_from, filled_to)
+            VALUES (%(period)s, %(lo)s, %(hi)s)
+            ON CONFLICT (period) DO UPDATE
+            SET filled_to = EXCLUDED.filled_to
+            '''
+        )
+
+        # Start where the last fill stopped, or at the oldest data
+        rows = self.run(lambda conn: self._fetchall(
+            conn,
+            'SELECT filled_to FROM tier_watermarks WHERE period = %s',
+            (period,),
+        ))
+        if rows:
+            first = rows[0][0]
+        else:
+            first = self.run(lambda conn: self._fetchall(
+                conn,
+                'SELECT min(added) FROM tsd WHERE added < %s',
+                (end_time,),
+            ))[0][0]
+        if first is None or first >= end_time:
+            logging.debug(f'Nothing to fill for the {period}s tier')
+            return 0
+
+        def _fill(conn, lo, hi):
+            args = {'period': period, 'lo': lo, 'hi': hi}
+            with conn.cursor() as curs:
+                curs.execute(query, args)
+                count = curs.rowcount
+                curs.execute(wm_query, args)
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+            return count
+
+        total = 0
+        for lo, hi in self._get_month_windows(first, end_time):
+            try:
+                count = self.run(lambda conn: _fill(conn, lo, hi))
+            except Exception as e:
+                # Stop here, so the next fill picks up from this window
+                logging.exception(
+                    f'Failed to fill the {period}s tier for {lo} -> {hi}: {e}')
+                break
+            logging.info(
+                f'Filled {count} buckets of the {period}s tier for '
+                f'{lo} -> {hi}'
+            )
+            total += count
+
+        return total
+
+    def _get_month_windows(
+            self,
+            first: datetime,
+            start_time: datetime) -> List[Tuple[datetime, datetime]]:
+        """
+        Split first -> start_time at month boundaries (the tsd partitions)
+        """
+        ret = []
+        lo = first
+        while lo < start_time:
+            if lo.month == 12:
+                hi = datetime(lo.year + 1, 1, 1)
+            else:
+                hi = datetime(lo.year, lo.month + 1, 1)
+            hi = min(hi, start_time)
+            ret.append((lo, hi))
+            lo = hi
+
+        return ret
 
     def mv_table_to_tblspace(self, table, tablespace, dry_run=False):
         """
         Move the specified table to a different tablespace
         """
         mv_query = f'ALTER TABLE {table} SET TABLESPACE {tablespace}'
-        try:
-            with self.conn.cursor() as curs:
+
+        def _move(conn):
+            with conn.cursor() as curs:
                 curs.execute(mv_query)
-                if dry_run:
-                    self.conn.rollback()
-        except psycopg2.errors.AdminShutdown:
-            logging.error('The connection has been terminated, reconnecting')
-            self.conn = self._get_conn()
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+
+        try:
+            self.run(_move)
         except Exception as e:
-            # Log the exception and roll back
             logging.exception(f'Failed to move {table} to {tablespace}: {e}')
-            self.conn.rollback()
-        else:
-            self.conn.commit()
 
     def _rollup_and_del(
             self,
@@ -218,17 +798,34 @@ class DB:
             ent_id: int,
             key_id: int,
             end_time: datetime,
-            dry_run: bool):
+            dry_run: bool,
+            tier: Optional[str]=None,
+            watermark: Optional[datetime]=None) -> bool:
+        """
+        Roll up a single series, returning whether it succeeded.  If there's
+        a watermark past end_time, only the rows from there on are rolled up
+        """
+        # Everything before the watermark has already been rolled up
+        lower_op = '>'
+        if watermark is not None and watermark > end_time:
+            end_time = watermark
+            lower_op = '>='
+        if end_time >= start_time:
+            return True
+
         sel_query = dedent(
-            '''
-            SELECT t.id, t.added, t.value
+            f'''
+            COPY (SELECT
+                t.id,
+                (extract(epoch FROM t.added) * 1000000)::bigint,
+                t.value
             FROM tsd t
             WHERE
                 entity_id = %s
                 AND key_id = %s
-                AND added > %s
+                AND added {lower_op} %s
                 AND added < %s
-            ORDER BY added
+            ORDER BY added) TO STDOUT (FORMAT binary)
             '''
         )
 
@@ -245,89 +842,190 @@ class DB:
         etime = end_time.strftime('%Y-%m-%d %H:%M:%S')
 
         # First, get all the items we need to work on
-        with self.conn.cursor() as curs:
-            curs.execute(sel_query, (ent_id, key_id, etime, stime))
-            to_compress = curs.fetchall()
-        self.conn.commit()
+        to_compress = self.run(lambda conn: self._copy_rollup_rows(
+            conn, sel_query, (ent_id, key_id, etime, stime)))
 
-        if not to_compress:
-            # If we have no metrics for the period, return
-            return
+        if not len(to_compress):
+            # If we have no metrics for the period, just move the watermark
+            if tier and not dry_run:
+                self.run(lambda conn: self._set_watermark(
+                    conn, tier, ent_id, key_id, start_time, True))
+            return True
 
-        new_vals = self._compress_vals(to_compress, roll_period)
+        new_vals = self._compress_rows(to_compress, roll_period)
         # modify new vals for db insertion
         new_vals = [(ent_id, key_id, d, v) for d, v in new_vals]
 
         # We'll do all this in a transaction
-        try:
-            with self.conn.cursor() as curs:
+        def _replace(conn):
+            with conn.cursor() as curs:
                 # First we'll delete
                 curs.execute(del_query.format(
-                    ', '.join([str(d[0]) for d in to_compress])))
+                    ', '.join(map(str, to_compress['id'].tolist()))))
                 # Now we add the new items
                 curs.executemany(ins_query, new_vals)
-                if dry_run:
-                    self.conn.rollback()
-        except psycopg2.errors.AdminShutdown:
-            logging.error('The connection has been terminated, reconnecting')
-            self.conn = self._get_conn()
+            if tier:
+                self._set_watermark(conn, tier, ent_id, key_id, start_time)
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+
+        try:
+            self.run(_replace)
         except Exception as e:
-            # Log the exception and roll back
-            logging.exception('Failed to insert metrics into the db')
-            try:
-                self.conn.rollback()
-            except Exception as e:
-                logging.exception('Error during rollback')
-                self._get_conn()
-                # Retry
-                return self._rollup_and_del(
-                    start_time,
-                    roll_period,
-                    ent_id,
-                    key_id,
-                    end_time,
-                    dry_run,
-                )
-        else:
-            self.conn.commit()
+            logging.exception(f'Failed to insert metrics into the db: {e}')
+            return False
+
+        return True
+
+    def _copy_rollup_rows(
+            self,
+            conn: psycopg2.extensions.connection,
+            query: str,
+            args: Sequence[Any]) -> np.ndarray:
+        """
+        Run a binary COPY ... TO STDOUT of (id, added, value) rows, with
+        added as epoch microseconds, and return them as a ROLLUP_ROW array.
+
+        The rows go straight from the COPY buffer to the array, rather than
+        through a python tuple, datetime and float per row
+        """
+        buf = BytesIO()
+        with conn.cursor() as curs:
+            curs.copy_expert(curs.mogrify(query, args).decode('utf-8'), buf)
+        data = buf.getbuffer()
+
+        # The header is the signature, 4 bytes of flags and the length of a
+        # header extension, and the data ends with a -1 field count
+        if bytes(data[:len(self.COPY_SIGNATURE)]) != self.COPY_SIGNATURE:
+            raise ValueError('Invalid binary COPY data')
+        pos = len(self.COPY_SIGNATURE) + 4
+        pos += 4 + int.from_bytes(data[pos:pos + 4], 'big')
+
+        return np.frombuffer(data[pos:len(data) - 2], self.ROLLUP_ROW)
+
+    def _get_watermarks(self, tier: str, eid: int) -> Dict[int, datetime]:
+        """
+        Returns the key id -> rolled_to watermarks for the entity
+        """
+        rows = self.run(lambda conn: self._fetchall(
+            conn,
+            'SELECT key_id, rolled_to FROM rollup_watermarks '
+            'WHERE tier = %s AND entity_id = %s',
+            (tier, eid),
+        ))
+
+        return dict(rows)
+
+    def _set_watermark(
+            self,
+            conn: psycopg2.extensions.connection,
+            tier: str,
+            eid: int,
+            kid: int,
+            rolled_to: datetime,
+            commit: Optional[bool]=False) -> None:
+        """
+        Record that the series has been rolled up to rolled_to.  This is
+        part of the caller's transaction, unless commit is set
+        """
+        with conn.cursor() as curs:
+            curs.execute(
+                dedent(
+                    '''
+                    INSERT INTO rollup_watermarks
+                        (tier, entity_id, key_id, rolled_to)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (tier, entity_id, key_id) DO UPDATE
+                    SET rolled_to = GREATEST(
+                        rollup_watermarks.rolled_to, EXCLUDED.rolled_to)
+                    '''
+                ),
+                (tier, eid, kid, rolled_to),
+            )
+        if commit:
+            conn.commit()
 
     def _compress_vals(
             self,
-            to_compress: List[Tuple[int, str, float]],
-            roll_period: int) -> List[Tuple[str, float]]:
-        td = timedelta(seconds=roll_period)
-        ret = []
+            to_compress: List[Tuple[int, datetime, float]],
+            roll_period: int) -> List[Tuple[datetime, float]]:
+        """
+        Roll up the (id, added, value) rows, ordered by added, returning the
+        last time in each bucket and its average.  See _compress_arrays
+        """
+        _, added, vals = zip(*to_compress)
+        ends, avgs = self._compress_arrays(
+            np.array(added, dtype='datetime64[us]').view(np.int64),
+            np.array(vals, dtype=np.float64),
+            roll_period,
+        )
 
-        cur_dt = to_compress[0][1]
-        last_add = to_compress[0][1]
-        cur_vals = []
-        for row in to_compress:
-            _, added, val = row
+        return [
+            (added[i], avg) for i, avg in zip(ends.tolist(), avgs.tolist())]
 
-            if added - td >= cur_dt:
-                # Need to rollup the vals and reset everything
-                new_val = sum(cur_vals) / len(cur_vals)
-                ret.append((last_add, new_val))
+    def _compress_rows(
+            self,
+            rows: np.ndarray,
+            roll_period: int) -> List[Tuple[datetime, float]]:
+        """
+        Roll up the ROLLUP_ROW array from _copy_rollup_rows.  See
+        _compress_arrays
+        """
+        added = rows['added'].astype(np.int64)
+        ends, avgs = self._compress_arrays(
+            added, rows['value'].astype(np.float64), roll_period)
 
-                cur_dt = added
-                cur_vals = [val]
-            else:
-                cur_vals.append(val)
+        return list(zip(
+            added[ends].astype('datetime64[us]').tolist(), avgs.tolist()))
 
-            last_add = added
+    @staticmethod
+    def _compress_arrays(
+            times: np.ndarray,
+            vals: np.ndarray,
+            roll_period: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Average the values into buckets of roll_period seconds, given their
+        times as sorted epoch microseconds.  A bucket starts at its first
+        row and holds every row less than roll_period after it.  Returns the
+        index of the last row in each bucket and the bucket averages.
 
-        if cur_vals:
-            # Add the remainder
-            new_val = sum(cur_vals) / len(cur_vals)
-            ret.append((last_add, new_val))
+        Regular data, the usual case, falls on a grid of roll_period from
+        the first row, which takes one pass to bucket and is checked with a
+        searchsorted() from each bucket start.  Otherwise, jump[i] is the
+        start of the bucket after one starting at row i, so the starts are
+        0, jump[0], jump[jump[0]], ...  They're found by doubling: given the
+        first k starts and jump applied k times, the next k starts are the
+        jumps from those, and jump[jump] is jump applied 2k times.  Either
+        way, that's a few numpy steps with no python loop per bucket.  The
+        buckets are then summed with add.reduceat()
+        """
+        num_rows = len(times)
+        period_us = roll_period * 1_000_000
+        starts = np.flatnonzero(
+            np.diff((times - times[0]) // period_us, prepend=-1))
+        nxt = np.searchsorted(times, times[starts] + period_us, side='left')
+        if not np.array_equal(nxt[:-1], starts[1:]) or nxt[-1] != num_rows:
+            # Row num_rows is past the end, and jumps to itself
+            jump = np.append(
+                np.searchsorted(times, times + period_us, side='left'),
+                num_rows,
+            )
+            starts = np.zeros(1, dtype=np.intp)
+            while starts[-1] < num_rows:
+                starts = np.concatenate((starts, jump[starts]))
+                jump = jump[jump]
+            starts = starts[:np.searchsorted(starts, num_rows)]
 
-        return ret
+        ends = np.append(starts[1:], num_rows)
+        avgs = np.add.reduceat(vals, starts) / (ends - starts)
+
+        return ends - 1, avgs
 
     def _get_entities(self) -> List[int]:
         query = 'SELECT id FROM entities'
-        with self.conn.cursor() as curs:
-            curs.execute(query)
-            ret = curs.fetchall()
+        ret = self.run(lambda conn: self._fetchall(conn, query))
 
         return [e[0] for e in ret]
 
@@ -341,19 +1039,27 @@ class DB:
                 AND k.id = t.key_id
             '''
         )
-        with self.conn.cursor() as curs:
-            curs.execute(query, (ent,))
-            ret = curs.fetchall()
+        ret = self.run(lambda conn: self._fetchall(conn, query, (ent,)))
 
         return [k[0] for k in ret]
 
     def _get_num_keys(self) -> int:
         query = 'SELECT count(*) FROM keys'
+        res = self.run(lambda conn: self._fetchall(conn, query))
 
-        with self.conn.cursor() as curs:
-            curs.execute(query)
-            res = curs.fetchone()
-            return int(res[0])
+        return int(res[0][0])
+
+    def _fetchall(
+            self,
+            conn: psycopg2.extensions.connection,
+            query: str,
+            args: Tuple[Any]=None) -> List[Tuple[Any]]:
+        with conn.cursor() as curs:
+            curs.execute(query, args)
+            ret = curs.fetchall()
+        conn.commit()
+
+        return ret
 
     def _get_conn(self) -> psycopg2.extensions.connection:
         """
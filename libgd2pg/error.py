@@ -4,3 +4,15 @@ class InvalidConfigError(Exception):
 
 class InvalidDataError(Exception):
     pass
+
+class PayloadTooLargeError(Exception):
+    pass
+
+class UnsupportedEncodingError(Exception):
+    pass
+
+class BackpressureError(Exception):
+    pass
+
+class PoolTimeoutError(Exception):
+    pass
@@ -1,8 +1,16 @@
 from flask import Flask, request, Response
 from flask_httpauth import HTTPBasicAuth
-from typing import TYPE_CHECKING
-import json
+from .error import (
+    BackpressureError,
+    PayloadTooLargeError,
+    UnsupportedEncodingError,
+)
+from .ingest import MSGPACK_TYPES, iter_json, iter_msgpack, open_body, slim
+from .stats import STATS
+from math import ceil
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List
 import logging
+import time
 
 
 if TYPE_CHECKING:
@@ -15,12 +23,53 @@ AUTH = HTTPBasicAuth()
 CONF = None
 INITIALIZED = False
 DM = None
+# The number of decoded data dicts to push to the DataManager at once
+PUSH_BATCH = 500
+
+
+def _iter_batches(data: Iterable[Dict]) -> Iterator[List[Dict]]:
+    """
+    Yield the fields that the DataManager uses, in batches of PUSH_BATCH
+    """
+    batch = []
+    for d in data:
+        batch.append(slim(d))
+        if len(batch) >= PUSH_BATCH:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
 
 
 def _handle_post() -> None:
-    raw_data = request.get_data()
-    data = json.loads(raw_data)
-    DM.push(data)
+    """
+    Decode (and decompress) the body as it's read, preparing it in batches
+    of PUSH_BATCH.  The body is JSON unless the Content-Type is msgpack.
+
+    The whole request is accepted or rejected at once, so a client that
+    retries after a 429 doesn't send any of its samples twice.
+    """
+    DM.check_capacity()
+    body, raw = open_body(
+        request.stream,
+        request.headers.get('Content-Encoding'),
+        CONF.getint('server', 'max_body_size', fallback=0),
+    )
+    parse = iter_msgpack if request.mimetype in MSGPACK_TYPES else iter_json
+    try:
+        DM.push_batches(_iter_batches(parse(body)))
+    finally:
+        STATS.incr('ingest.bytes_raw', raw.count)
+        STATS.incr('ingest.bytes_decoded', body.count)
+
+
+def _get_retry_after() -> int:
+    """
+    The buffer is emptied at the top of each minute, so that's when it's
+    worth trying again
+    """
+    return max(ceil(60 - time.time() % 60), 1)
 
 
 @AUTH.verify_password
@@ -38,6 +87,19 @@ def index() -> Response:
     else:
         try:
             _handle_post()
+        except BackpressureError as e:
+            logging.warning(f'Rejected request: {e}')
+            return Response(
+                'Too Many Requests\n',
+                status=429,
+                headers={'Retry-After': str(_get_retry_after())},
+            )
+        except PayloadTooLargeError as e:
+            logging.error(f'Rejected request: {e}')
+            return Response('Payload Too Large\n', status=413)
+        except UnsupportedEncodingError as e:
+            logging.error(f'Rejected request: {e}')
+            return Response('Unsupported Media Type\n', status=415)
         except Exception:
             logging.exception('Error in POST handling')
             return Response('Invalid Request\n', status=400)
@@ -0,0 +1,280 @@
+from .error import (
+    InvalidDataError,
+    PayloadTooLargeError,
+    UnsupportedEncodingError,
+)
+from codecs import getincrementaldecoder
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The fields of the collectd data that the DataManager actually uses
+KEEP_FIELDS = (
+    'host',
+    'plugin',
+    'plugin_instance',
+    'type',
+    'type_instance',
+    'dsnames',
+    'dstypes',
+    'values',
+)
+CHUNK_SIZE = 64 * 1024
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+WS = ' \t\r\n'
+
+
+class CountingReader:
+    """
+    Wraps a stream, counting the bytes read from it
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size: int=-1) -> bytes:
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+
+class LimitedReader(CountingReader):
+    """
+    Raises a PayloadTooLargeError once more than max_size bytes have been
+    read from the stream.  A max_size of 0 is unlimited.
+    """
+
+    def __init__(self, stream: BinaryIO, max_size: int):
+        super().__init__(stream)
+        self.max_size = max_size
+
+    def read(self, size: int=-1) -> bytes:
+        data = super().read(size)
+        if self.max_size and self.count > self.max_size:
+            raise PayloadTooLargeError(
+                f'The request body is larger than {self.max_size} bytes')
+        return data
+
+
+class ZlibReader:
+    """
+    Decompresses a gzip or deflate stream as it's read.  The output of
+    each read is capped at the requested size, so a small, highly
+    compressed input can't be expanded all at once.
+    """
+
+    def __init__(self, stream: BinaryIO, encoding: str):
+        self.stream = stream
+        if encoding == 'deflate':
+            # This should be zlib wrapped, but some clients send raw deflate
+            self._wbits = zlib.MAX_WBITS
+        else:
+            self._wbits = zlib.MAX_WBITS | 16
+        self._dec = zlib.decompressobj(self._wbits)
+        self._started = False
+
+    def read(self, size: int=-1) -> bytes:
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+
+        while not self._dec.eof:
+            data = self._dec.unconsumed_tail
+            if not data:
+                data = self.stream.read(CHUNK_SIZE)
+                if not data:
+                    return self._dec.flush()
+
+            try:
+                out = self._dec.decompress(data, size)
+            except zlib.error:
+                if self._started or self._wbits != zlib.MAX_WBITS:
+                    raise InvalidDataError('Invalid compressed data')
+                # Try again as raw deflate
+                self._wbits = -zlib.MAX_WBITS
+                self._dec = zlib.decompressobj(self._wbits)
+                out = self._dec.decompress(data, size)
+
+            self._started = True
+            if out:
+                return out
+
+        return b''
+
+
+def open_body(
+        stream: BinaryIO,
+        encoding: Optional[str]=None,
+        max_size: int=0,
+        ) -> Tuple[LimitedReader, CountingReader]:
+    """
+    Returns a reader for the decoded body, given the Content-Encoding, and
+    a counter of the raw bytes read.  The decoded reader raises a
+    PayloadTooLargeError once more than max_size bytes have been decoded.
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    raw = CountingReader(stream)
+
+    if encoding == 'identity':
+        body = raw
+    elif encoding in ('gzip', 'x-gzip', 'deflate'):
+        body = ZlibReader(raw, 'deflate' if encoding == 'deflate' else 'gzip')
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedEncodingError(
+                'zstd encoding requires the zstandard module')
+        body = zstandard.ZstdDecompressor().stream_reader(
+            raw, read_size=CHUNK_SIZE)
+    else:
+        raise UnsupportedEncodingError(f'Unsupported encoding: {encoding}')
+
+    return LimitedReader(body, max_size), raw
+
+
+def slim(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a copy of the data dict with only the fields we use
+    """
+    return {k: data[k] for k in KEEP_FIELDS if k in data}
+
+
+def iter_json(
+        stream: BinaryIO,
+        chunk_size: int=CHUNK_SIZE,
+        ) -> Iterator[Dict[str, Any]]:
+    """
+    Incrementally decode a JSON array of objects, or a single object, from
+    the stream, yielding one object at a time.  Only the current chunk and
+    the object being decoded are held in memory, rather than the whole
+    body plus the whole decoded list.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = None
+
+    def fill() -> bool:
+        # Read another chunk into the buffer, dropping what's been consumed
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            buf = buf[pos:] + utf8.decode(b'', True)
+        else:
+            buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        return True
+
+    def next_char() -> str:
+        # Skip any whitespace and return the next char, or '' at the end
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in WS:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                return ''
+
+    c = next_char()
+    if c == '[':
+        in_array = True
+        pos += 1
+        if next_char() == ']':
+            pos += 1
+            c = ''
+        else:
+            c = ','
+    elif c == '{':
+        in_array = False
+    elif c == '':
+        return
+    else:
+        raise InvalidDataError(f'Expected a JSON array or object, got: {c}')
+
+    while c:
+        if next_char() != '{':
+            raise InvalidDataError(
+                f'Expected a JSON object at: {buf[pos:pos + 20]!r}')
+
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                # Most likely we just need more data
+                if not fill():
+                    raise InvalidDataError(f'Invalid JSON: {e}')
+            else:
+                pos = end
+                break
+
+        yield obj
+
+        if not in_array:
+            c = next_char()
+            if c:
+                raise InvalidDataError(f'Trailing data after the JSON: {c}')
+            break
+
+        c = next_char()
+        pos += 1
+        if c == ']':
+            c = ''
+        elif c != ',':
+            raise InvalidDataError(f'Expected "," or "]" in the JSON, got: {c}')
+
+    if in_array and next_char():
+        raise InvalidDataError('Trailing data after the JSON array')
+
+
+def iter_msgpack(
+        stream: BinaryIO,
+        chunk_size: int=CHUNK_SIZE,
+        ) -> Iterator[Dict[str, Any]]:
+    """
+    Incrementally decode a msgpack array of maps, or a single map, from the
+    stream, yielding one map at a time, the same as iter_json
+    """
+    if msgpack is None:
+        raise UnsupportedEncodingError(
+            'msgpack bodies require the msgpack module')
+
+    unpacker = msgpack.Unpacker(stream, raw=False, read_size=chunk_size)
+    try:
+        try:
+            num = unpacker.read_array_header()
+        except msgpack.OutOfData:
+            return
+        except ValueError:
+            # Not an array, which leaves the object to be unpacked below
+            num = 1
+
+        for _ in range(num):
+            obj = unpacker.unpack()
+            if not isinstance(obj, dict):
+                raise InvalidDataError(
+                    f'Expected a msgpack map, got: {type(obj).__name__}')
+            yield obj
+
+        try:
+            unpacker.unpack()
+        except msgpack.OutOfData:
+            pass
+        else:
+            raise InvalidDataError('Trailing data after the msgpack')
+    except (msgpack.UnpackException, ValueError) as e:
+        raise InvalidDataError(f'Invalid msgpack: {e}')
@@ -0,0 +1,194 @@
+from .cache import LRUCache
+from .error import InvalidConfigError
+from fnmatch import translate
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+import logging
+import re
+
+if TYPE_CHECKING:
+    from .config import GDConfig
+
+
+class Rollup(NamedTuple):
+    """
+    A single compiled rollup.  This is computed as func(data), or
+    func(data, pct) for percentiles, and stored as <metric name>.<suffix>
+    """
+    suffix: str
+    func: Callable[..., Any]
+    pct: Optional[int]
+
+
+class OverrideRule(NamedTuple):
+    pattern: str
+    regex: 're.Pattern'
+    rollups: Tuple[Rollup]
+
+
+class RollupPlan:
+    """
+    The rollups to compute for each metric, compiled once from the config.
+
+    By default, the rollups come from the "rollups_<type>" option for the
+    metric's type.  These can be overridden by metric name in the
+    [rollup_overrides] section, where each value is "<pattern> -> <rollup
+    list>" and the pattern is a shell style glob, or a regex if prefixed
+    with "~".  The pattern is in the value, rather than the key, so the
+    config parser doesn't lowercase it.  The first matching rule, in config
+    order, wins.  An empty rollup list means the metric isn't stored at all.
+
+    Rules are indexed by the literal first segment of the metric name
+    they match (e.g. "cpu" for "cpu.*.wait"), so only the rules that can
+    possibly match are tried, and the result is cached per metric name.
+    """
+    PCT_RE = re.compile(r'pct\((\d+)\)', re.I)
+    OVERRIDE_SECT = 'rollup_overrides'
+    # The literal first segment of a glob or a "^" anchored regex
+    GLOB_SEG_RE = re.compile(r'([^*?\[\].]+)\.')
+    REGEX_SEG_RE = re.compile(r'\^([\w-]+)\\\.')
+    # Cached value for names without an override
+    NO_OVERRIDE = False
+
+    def __init__(
+            self,
+            config: 'GDConfig',
+            resolver: Callable[[str], Callable[..., Any]],
+            cache_size: Optional[int]=100000):
+        """
+        resolver returns the function to call for a rollup name, like
+        "avg" or "pct"
+        """
+        self.resolver = resolver
+        self.type_rollups: Dict[str, Tuple[Rollup]] = {}
+        for opt in config['main']:
+            if opt.startswith('rollups_'):
+                self.type_rollups[opt[len('rollups_'):]] = self.compile(
+                    config.getlist('main', opt))
+
+        self.rules: List[OverrideRule] = []
+        self._index: Dict[str, List[int]] = {}
+        self._generic: List[int] = []
+        if config.has_section(self.OVERRIDE_SECT):
+            defaults = config.defaults()
+            for name, val in config.items(self.OVERRIDE_SECT, raw=True):
+                if name in defaults:
+                    continue
+                pattern, sep, rollups = (val or '').rpartition('->')
+                pattern = pattern.strip()
+                if not sep or not pattern:
+                    raise InvalidConfigError(
+                        f'Invalid rollup override "{name}", must be '
+                        f'"<pattern> -> <rollups>"'
+                    )
+                self._add_rule(
+                    pattern, [r.strip() for r in rollups.split(',')])
+
+        self._cache = LRUCache(cache_size)
+
+    def compile(self, rollups: List[str]) -> Tuple[Rollup]:
+        """
+        Compile a list of rollup names, like "avg" or "pct(95)"
+        """
+        ret = []
+        for rollup in rollups:
+            if not rollup:
+                continue
+
+            pct = None
+            suffix = rollup
+            m = self.PCT_RE.match(rollup)
+            if m:
+                # We have a percentile to manage here
+                pct = int(m.group(1))
+                rollup = 'pct'
+                suffix = 'p{}'.format(pct)
+
+            try:
+                func = self.resolver(rollup)
+            except AttributeError:
+                raise InvalidConfigError(f'Invalid rollup: {rollup}')
+
+            ret.append(Rollup(suffix, func, pct))
+
+        return tuple(ret)
+
+    def get(self, metric_name: str, mtype: str) -> Optional[Tuple[Rollup]]:
+        """
+        Returns the rollups for the metric, or None if there are none
+        defined for its type
+        """
+        if self.rules:
+            rollups = self._cache.get(metric_name)
+            if rollups is None:
+                rollups = self._match(metric_name)
+                self._cache.set(metric_name, rollups)
+
+            if rollups is not self.NO_OVERRIDE:
+                return rollups
+
+        return self.type_rollups.get(mtype)
+
+    def _add_rule(self, pattern: str, rollups: List[str]) -> None:
+        if pattern.startswith('~'):
+            regex = re.compile(pattern[1:], re.I)
+            m = self.REGEX_SEG_RE.match(pattern[1:])
+            if self._has_top_alt(pattern[1:]):
+                # This could match more than one first segment
+                m = None
+        else:
+            regex = re.compile(translate(pattern), re.I)
+            m = self.GLOB_SEG_RE.match(pattern)
+
+        idx = len(self.rules)
+        self.rules.append(OverrideRule(pattern, regex, self.compile(rollups)))
+        if m:
+            self._index.setdefault(m.group(1).lower(), []).append(idx)
+        else:
+            self._generic.append(idx)
+        logging.debug(f'Added rollup override: {pattern} -> {rollups}')
+
+    def _has_top_alt(self, regex: str) -> bool:
+        """
+        Returns whether there's a "|" outside of any group in the regex
+        """
+        depth = 0
+        escaped = False
+        for c in regex:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == '|' and depth == 0:
+                return True
+
+        return False
+
+    def _match(self, metric_name: str) -> Union[Tuple[Rollup], bool]:
+        """
+        Return the rollups for the first matching rule, or NO_OVERRIDE
+        """
+        seg = metric_name.split('.', 1)[0].lower()
+        idxs = self._index.get(seg, [])
+        if self._generic:
+            idxs = sorted(idxs + self._generic)
+
+        for idx in idxs:
+            rule = self.rules[idx]
+            if rule.regex.match(metric_name):
+                return rule.rollups
+
+        return self.NO_OVERRIDE
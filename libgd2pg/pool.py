@@ -0,0 +1,218 @@
+from .error import PoolTimeoutError
+from .stats import STATS
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+from typing import Callable, Iterator, Optional
+import logging
+import psycopg2
+import psycopg2.extensions
+import time
+
+Connection = psycopg2.extensions.connection
+
+# Errors which may mean the connection itself is broken, see is_conn_lost()
+CONN_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# The server shutting down or not accepting connections, on top of the
+# connection exceptions in class 08
+CONN_LOST_CODES = ('57P01', '57P02', '57P03')
+
+
+def is_conn_lost(
+        err: Exception,
+        conn: Optional[Connection]=None) -> bool:
+    """
+    Returns whether the error means the connection is gone, rather than
+    just the statement failing, e.g. QueryCanceled on a statement_timeout,
+    which is also an OperationalError.  Without a conn, the connection
+    couldn't be made at all.
+    """
+    if not isinstance(err, CONN_ERRORS):
+        return False
+    if conn is None or conn.closed:
+        return True
+    code = err.pgcode or ''
+
+    return code.startswith('08') or code in CONN_LOST_CODES
+
+
+class ConnPool:
+    """
+    A thread safe pool of up to max_size db connections, created by factory
+    as they're needed.
+
+    Connections that have been idle for longer than check_interval are
+    checked with a "SELECT 1" before they're handed out, and broken ones
+    are replaced.  If every connection is in use, get() waits up to
+    timeout seconds for one to be returned.  The time spent waiting, how
+    often that happens (saturation) and the pool usage are reported in the
+    stats as pool.*
+    """
+
+    def __init__(
+            self,
+            factory: Callable[[], Connection],
+            max_size: Optional[int]=4,
+            check_interval: Optional[float]=30.0,
+            timeout: Optional[float]=30.0):
+        self.factory = factory
+        self.max_size = max(max_size, 1)
+        self.check_interval = check_interval
+        self.timeout = timeout
+        # Idle connections and when they were last returned
+        self._idle = deque()
+        self._size = 0
+        self._cond = Condition()
+        # Connect right away, so a bad config fails at startup
+        self.put(self._connect())
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def in_use(self) -> int:
+        return self._size - len(self._idle)
+
+    def get(self) -> Connection:
+        """
+        Returns a healthy connection, which must be given back with put()
+        """
+        start = time.perf_counter()
+        with self._cond:
+            if not self._idle and self._size >= self.max_size:
+                STATS.incr('pool.saturated')
+            while not self._idle and self._size >= self.max_size:
+                remaining = self.timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    raise PoolTimeoutError(
+                        f'No db connection available after {self.timeout}s, '
+                        f'all {self._size} are in use'
+                    )
+                self._cond.wait(remaining)
+
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                conn, last_used = None, None
+                # Reserve the slot while connecting outside the lock
+                self._size += 1
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        STATS.incr('pool.wait_ms', wait_ms)
+        STATS.max('pool.wait_ms.max', wait_ms)
+
+        if conn is not None and not self._is_healthy(conn, last_used):
+            self._discard(conn, reserve=True)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self.factory()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        self._update_stats()
+
+        return conn
+
+    def put(self, conn: Connection, discard: Optional[bool]=False) -> None:
+        """
+        Return a connection to the pool, rolling back anything uncommitted.
+        Broken connections, or any with discard set, are closed instead.
+        """
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != \
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception as e:
+                logging.warning(f'Discarding a db connection: {e}')
+                discard = True
+
+        if discard or conn.closed:
+            self._discard(conn)
+        else:
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+        self._update_stats()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """
+        Borrow a connection for the duration of the block.  If the block
+        fails because the connection was lost, the connection is discarded.
+        """
+        conn = self.get()
+        try:
+            yield conn
+        except CONN_ERRORS as e:
+            self.put(conn, discard=is_conn_lost(e, conn))
+            raise
+        except BaseException:
+            self.put(conn)
+            raise
+        else:
+            self.put(conn)
+
+    def close(self) -> None:
+        """
+        Close all the idle connections
+        """
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+    def _connect(self) -> Connection:
+        conn = self.factory()
+        with self._cond:
+            self._size += 1
+        return conn
+
+    def _discard(
+            self,
+            conn: Connection,
+            reserve: Optional[bool]=False) -> None:
+        """
+        Close a connection and free up its slot, unless reserve is set, in
+        which case the slot is kept for a replacement
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+        STATS.incr('pool.discarded')
+        if not reserve:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    def _is_healthy(self, conn: Connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SELECT 1')
+            conn.rollback()
+        except Exception as e:
+            logging.warning(f'Replacing a broken db connection: {e}')
+            return False
+
+        return True
+
+    def _update_stats(self) -> None:
+        STATS.gauge('pool.size', self._size)
+        STATS.gauge('pool.in_use', self.in_use)
@@ -0,0 +1,109 @@
+from .config import GDConfig
+from .db import DB
+from collections import defaultdict
+from datetime import datetime
+from io import StringIO
+from multiprocessing import get_context
+from typing import Dict, NamedTuple, Optional, Tuple
+import logging
+import os
+
+# The DB for each rollup worker process
+WORKER_DB = None
+
+
+class EntityResult(NamedTuple):
+    """
+    The outcome of rolling up one entity in a worker
+    """
+    pid: int
+    eid: int
+    keys: int
+    failed: int
+    error: Optional[str]
+
+
+def parallel_rollup(
+        db: DB,
+        start_time: datetime,
+        roll_period: int,
+        end_time: Optional[datetime]=None,
+        dry_run: Optional[bool]=False,
+        jobs: Optional[int]=2,
+        tier: Optional[str]=None,
+        ) -> Dict[int, Dict[str, int]]:
+    """
+    The same as db.do_rollup() in "python" mode, but with the entities
+    spread over a pool of worker processes, each with its own DB.
+
+    A failure for a key, or a whole entity, is logged and counted without
+    stopping the run.  Progress is logged as each entity completes, and the
+    per worker totals are returned as
+    {pid: {entities, keys, failed, failed_entities}}, where failed counts
+    the keys that failed and failed_entities the entities that failed as a
+    whole.
+    """
+    end_time = datetime(1970, 1, 1) if not end_time else end_time
+    if tier:
+        start_time = db.align_time(start_time, roll_period)
+    entity_ids = db._get_entities()
+    # The workers build their own DB from a copy of the config.  Use spawn
+    # so they don't inherit the parent's connections.
+    conf = StringIO()
+    db.config.write(conf)
+
+    workers = defaultdict(lambda: {
+        'entities': 0,
+        'keys': 0,
+        'failed': 0,
+        'failed_entities': 0,
+    })
+    total = len(entity_ids)
+    with get_context('spawn').Pool(
+            jobs, _worker_init, (conf.getvalue(),)) as pool:
+        results = pool.imap_unordered(
+            _worker_rollup,
+            [(eid, start_time, roll_period, end_time, dry_run, tier)
+                for eid in entity_ids],
+        )
+        for done, res in enumerate(results, 1):
+            stats = workers[res.pid]
+            stats['entities'] += 1
+            stats['keys'] += res.keys
+            stats['failed'] += res.failed
+            if res.error:
+                stats['failed_entities'] += 1
+                logging.error(
+                    f'Worker {res.pid} failed the rollup for ent id '
+                    f'{res.eid}: {res.error}'
+                )
+            logging.info(
+                f'{done}/{total} entities rolled up ({done / total:.1%}); '
+                f'worker {res.pid}: {stats["entities"]} entities, '
+                f'{stats["keys"]} keys, {stats["failed"]} failed, '
+                f'{stats["failed_entities"]} failed entities'
+            )
+
+    return dict(workers)
+
+
+def _worker_init(conf_str: str) -> None:
+    global WORKER_DB
+
+    config = GDConfig()
+    config.read_string(conf_str)
+    WORKER_DB = DB(config)
+
+
+def _worker_rollup(
+        args: Tuple[int, datetime, int, datetime, bool, Optional[str]],
+        ) -> EntityResult:
+    eid, start_time, roll_period, end_time, dry_run, tier = args
+    try:
+        keys, failed = WORKER_DB.rollup_entity(
+            eid, start_time, roll_period, end_time, dry_run, tier)
+    except Exception as e:
+        logging.exception(f'Failed the rollup for ent id {eid}')
+        return EntityResult(os.getpid(), eid, 0, 0, str(e))
+
+    return EntityResult(os.getpid(), eid, keys, failed, None)
@@ -0,0 +1,243 @@
+from array import array
+from math import ceil, floor, log
+from numpy import concatenate, cumsum, frombuffer
+from typing import Iterator, Optional, Tuple, Union
+
+
+class Bins:
+    """
+    The counts for a contiguous range of bucket indexes, starting at offset.
+    The counts start out a byte each and are widened as they overflow, so
+    a sketch of a few samples a minute stays small.
+    """
+    __slots__ = ('counts', 'offset')
+    TYPECODES = ('B', 'H', 'I', 'Q')
+
+    def __init__(self):
+        self.counts = array(self.TYPECODES[0])
+        self.offset = 0
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        """
+        Yields the (index, count) of the non-empty buckets, lowest first
+        """
+        for i, cnt in enumerate(self.counts):
+            if cnt:
+                yield self.offset + i, cnt
+
+    @property
+    def max_idx(self) -> int:
+        return self.offset + len(self.counts) - 1
+
+    def add(self, idx: int, cnt: Optional[int]=1) -> bool:
+        """
+        Count cnt samples in the bucket idx, returning whether the range of
+        buckets had to grow for it
+        """
+        i = idx - self.offset
+        grew = not 0 <= i < len(self.counts)
+        if grew:
+            i = self._extend(idx)
+
+        while True:
+            try:
+                self.counts[i] += cnt
+                return grew
+            except OverflowError:
+                self._widen()
+
+    def fold_low(self, num: int) -> None:
+        """
+        Fold the lowest num buckets into the one above them
+        """
+        total = sum(self.counts[:num + 1])
+        del self.counts[:num]
+        self.offset += num
+        self.counts[0] = 0
+        self.add(self.offset, total)
+
+    def fold_high(self, num: int) -> None:
+        """
+        Fold the highest num buckets into the one below them
+        """
+        total = sum(self.counts[-num - 1:])
+        del self.counts[-num:]
+        self.counts[-1] = 0
+        self.add(self.max_idx, total)
+
+    def _extend(self, idx: int) -> int:
+        """
+        Grow the range to take in idx, returning its position
+        """
+        counts = self.counts
+        if not counts:
+            self.offset = idx
+            counts.append(0)
+        elif idx < self.offset:
+            counts[:0] = array(counts.typecode, bytes(
+                (self.offset - idx) * counts.itemsize))
+            self.offset = idx
+        else:
+            counts.frombytes(bytes((idx - self.max_idx) * counts.itemsize))
+
+        return idx - self.offset
+
+    def _widen(self) -> None:
+        typecode = self.TYPECODES[
+            self.TYPECODES.index(self.counts.typecode) + 1]
+        self.counts = array(typecode, self.counts)
+
+
+class DDSketch:
+    """
+    A mergeable, fixed memory quantile sketch with a relative error guarantee
+    (Masson, Rim & Lee, "DDSketch: A Fast and Fully-Mergeable Quantile Sketch
+    with Relative-Error Guarantees", VLDB 2019).
+
+    Values are counted in logarithmically sized buckets, so every sample is
+    known to within rel_acc * |sample|.  Quantiles are interpolated between
+    the two samples nearest the rank, as numpy.percentile does, so they are
+    within rel_acc * max(|lower sample|, |upper sample|) of the numpy
+    result.
+
+    The buckets are kept in contiguous arrays spanning the lowest to the
+    highest bucket, at most max_bins of them between the positive and the
+    negative values.  If a series spans a wider range of values than that
+    allows (e.g. 1e-3 to 1e6 at 1% needs ~1040 bins), the buckets for the
+    lowest values are collapsed together, which only degrades the accuracy
+    of the lowest quantiles.
+
+    The count, sum, min and max are tracked exactly.
+    """
+    __slots__ = (
+        'rel_acc', 'max_bins', 'gamma', '_mult', 'pos', 'neg',
+        'zero_count', 'count', 'sum', 'min', 'max',
+    )
+    # Values closer to zero than this are counted as zero
+    MIN_VAL = 1e-9
+
+    def __init__(
+            self,
+            rel_acc: Optional[float]=0.01,
+            max_bins: Optional[int]=1024):
+        if not 0 < rel_acc < 1:
+            raise ValueError(f'rel_acc must be between 0 and 1: {rel_acc}')
+
+        self.rel_acc = rel_acc
+        self.max_bins = max_bins
+        self.gamma = (1 + rel_acc) / (1 - rel_acc)
+        self._mult = 1 / log(self.gamma)
+        self.pos = Bins()
+        self.neg = Bins()
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, val: Union[int, float]) -> None:
+        grew = False
+        if val > self.MIN_VAL:
+            grew = self.pos.add(ceil(log(val) * self._mult))
+        elif val < -self.MIN_VAL:
+            grew = self.neg.add(ceil(log(-val) * self._mult))
+        else:
+            self.zero_count += 1
+
+        self.count += 1
+        self.sum += val
+        if self.min is None or val < self.min:
+            self.min = val
+        if self.max is None or val > self.max:
+            self.max = val
+
+        if grew and len(self.pos) + len(self.neg) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other: 'DDSketch') -> None:
+        """
+        Merge another sketch, with the same relative accuracy, into this one
+        """
+        if other.gamma != self.gamma:
+            raise ValueError('Cannot merge sketches with different accuracies')
+
+        for idx, cnt in other.pos:
+            self.pos.add(idx, cnt)
+        for idx, cnt in other.neg:
+            self.neg.add(idx, cnt)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+        if len(self.pos) + len(self.neg) > self.max_bins:
+            self._collapse()
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Returns the approximate value at quantile q, where 0 <= q <= 1.  Like
+        numpy.percentile, this linearly interpolates between the two samples
+        closest to the rank q * (count - 1).
+        """
+        if self.count == 0:
+            return None
+
+        # The cumulative counts from the lowest value to the highest.  That's
+        # the most negative values first, then zero, then the positive values
+        seen = cumsum(concatenate((
+            frombuffer(self.neg.counts, self.neg.counts.typecode)[::-1],
+            (self.zero_count,),
+            frombuffer(self.pos.counts, self.pos.counts.typecode),
+        )))
+        rank = q * (self.count - 1)
+        lo_rank = floor(rank)
+        lo, hi = seen.searchsorted((lo_rank, lo_rank + 1), side='right')
+        lo_val = self._get_val(lo)
+        if rank == lo_rank:
+            return self._clamp(lo_val)
+        if hi >= len(seen):
+            return self.max
+
+        return self._clamp(
+            lo_val + (self._get_val(hi) - lo_val) * (rank - lo_rank))
+
+    def _get_val(self, pos: int) -> float:
+        """
+        Returns the value of the bucket at pos in the cumulative counts
+        """
+        num_neg = len(self.neg)
+        if pos < num_neg:
+            return -self._bucket_val(self.neg.max_idx - pos)
+        if pos == num_neg:
+            return 0.0
+        return self._bucket_val(self.pos.offset + pos - num_neg - 1)
+
+    def _bucket_val(self, idx: int) -> float:
+        # This is the point with equal relative distance to both bucket edges
+        return 2 * self.gamma ** idx / (self.gamma + 1)
+
+    def _clamp(self, val: float) -> float:
+        return min(max(val, self.min), self.max)
+
+    def _collapse(self) -> None:
+        """
+        Fold the buckets for the lowest values together until we're back to
+        max_bins buckets.  The lowest values are the largest negative
+        buckets, then the smallest positive ones, so the positive buckets
+        are only folded once the negative ones are down to one.
+        """
+        excess = len(self.pos) + len(self.neg) - self.max_bins
+        num = min(excess, len(self.neg) - 1)
+        if num > 0:
+            self.neg.fold_high(num)
+            excess -= num
+
+        num = min(excess, len(self.pos) - 1)
+        if num > 0:
+            self.pos.fold_low(num)
@@ -0,0 +1,245 @@
+from .error import InvalidConfigError
+from datetime import datetime
+from threading import Lock
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+import json
+import logging
+import os
+import struct
+import zlib
+
+SpoolRecord = Tuple[datetime, Dict[str, Dict[str, Any]]]
+
+
+class Spool:
+    """
+    A durable, append-only file of metric batches that couldn't be written
+    to the db, to be replayed in order later.
+
+    Each record is the payload length and its crc32, followed by the batch
+    as JSON.  The offset of the next record to replay is kept, with its
+    crc32, in a header at the start of the file, which is rewritten in
+    place as records are replayed.  As it's in the same file, compacting
+    the spool swaps in the new records and their offset at once.  The spool
+    is truncated once everything in it has been replayed.
+
+    A record that can't be replayed can be moved aside with reject() to
+    "<path>.rejected", which is a spool too, to be inspected or replayed.
+
+    The spool never grows past max_bytes.  Records that don't fit are
+    refused.
+    """
+    HEADER = struct.Struct('>II')
+    FILE_HEADER = struct.Struct('>4sQI')
+    MAGIC = b'GDSP'
+
+    def __init__(self, path: str, max_bytes: Optional[int]=1024 ** 3):
+        self.path = path
+        self.rejected_path = f'{path}.rejected'
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._fh = self._open(path)
+        self.offset = self._read_offset()
+        self._recover()
+        logging.info(
+            f'Opened the spool at {path} with {self.pending} bytes to replay')
+
+    @property
+    def size(self) -> int:
+        return os.fstat(self._fh.fileno()).st_size
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of bytes left to replay
+        """
+        return self.size - self.offset
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+
+    def append(
+            self,
+            dt: datetime,
+            metrics: Dict[str, Dict[str, Any]]) -> bool:
+        """
+        Durably append a batch, returning False if there isn't room for it
+        """
+        payload = json.dumps(
+            {'dt': dt.isoformat(), 'metrics': metrics},
+            separators=(',', ':'),
+            default=float,
+        ).encode('utf-8')
+        record = self.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._lock:
+            if self.size + len(record) > self.max_bytes and self.offset:
+                # Reclaim the space taken by what's already been replayed
+                self._compact()
+            if self.size + len(record) > self.max_bytes:
+                return False
+
+            self._fh.seek(0, os.SEEK_END)
+            self._fh.write(record)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+        return True
+
+    def peek(self) -> Optional[Tuple[SpoolRecord, int]]:
+        """
+        Returns the oldest batch that hasn't been replayed, and the offset
+        of the next one to pass to commit(), or None if there aren't any.
+        A truncated or corrupt record ends the spool and is discarded.
+        """
+        with self._lock:
+            self._fh.seek(self.offset)
+            payload = self._read_record()
+            if payload is None:
+                self._discard(self.offset)
+                return None
+            if not payload:
+                return None
+
+            data = json.loads(payload)
+
+            return (
+                (datetime.fromisoformat(data['dt']), data['metrics']),
+                self.offset + self.HEADER.size + len(payload),
+            )
+
+    def commit(self, offset: int) -> None:
+        """
+        Mark everything before offset as replayed
+        """
+        with self._lock:
+            self._commit(offset)
+
+    def reject(self, offset: int) -> None:
+        """
+        Move the oldest batch, which ends at offset, to the rejected file
+        and mark it as replayed
+        """
+        with self._lock:
+            self._fh.seek(self.offset)
+            record = self._fh.read(offset - self.offset)
+            with self._open(self.rejected_path) as fh:
+                if not fh.read(1):
+                    fh.write(self._pack_offset(self.FILE_HEADER.size))
+                fh.seek(0, os.SEEK_END)
+                fh.write(record)
+                fh.flush()
+                os.fsync(fh.fileno())
+            logging.error(
+                f'Moved the spool record at {self.offset} in {self.path} to '
+                f'{self.rejected_path}'
+            )
+            self._commit(offset)
+
+    def _commit(self, offset: int) -> None:
+        # Must be called with the lock held
+        if offset >= self.size:
+            # Everything has been replayed, so start over
+            self._fh.truncate(self.FILE_HEADER.size)
+            offset = self.FILE_HEADER.size
+        self._write_offset(offset)
+
+    def _open(self, path: str) -> BinaryIO:
+        # Not in append mode, the offset is rewritten in place
+        return os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+
+    def _recover(self) -> None:
+        """
+        Check the records left to replay and discard everything from the
+        first truncated or corrupt one, e.g. from a crash mid-write, so new
+        records aren't appended behind it
+        """
+        size = self.size
+        pos = self.offset
+        self._fh.seek(pos)
+        while pos < size:
+            payload = self._read_record()
+            if not payload:
+                self._discard(pos)
+                break
+            pos += self.HEADER.size + len(payload)
+
+    def _read_record(self) -> Optional[bytes]:
+        """
+        Reads the record at the current position, returning its payload,
+        b'' at the end of the spool or None if it's truncated or corrupt
+        """
+        header = self._fh.read(self.HEADER.size)
+        if not header:
+            return b''
+        if len(header) != self.HEADER.size:
+            return None
+
+        length, crc = self.HEADER.unpack(header)
+        payload = self._fh.read(length)
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            return None
+
+        return payload
+
+    def _discard(self, offset: int) -> None:
+        logging.error(
+            f'Discarding a corrupt spool record at {offset} in {self.path}')
+        self._fh.truncate(offset)
+        os.fsync(self._fh.fileno())
+
+    def _compact(self) -> None:
+        """
+        Rewrite the spool with only the records left to replay.  Must be
+        called with the lock held.
+        """
+        tmp_path = f'{self.path}.tmp'
+        self._fh.seek(self.offset)
+        with open(tmp_path, 'wb') as fh:
+            fh.write(self._pack_offset(self.FILE_HEADER.size))
+            while True:
+                chunk = self._fh.read(1024 * 1024)
+                if not chunk:
+                    break
+                fh.write(chunk)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        os.replace(tmp_path, self.path)
+        self._fh.close()
+        self._fh = self._open(self.path)
+        self.offset = self.FILE_HEADER.size
+
+    def _read_offset(self) -> int:
+        self._fh.seek(0)
+        header = self._fh.read(self.FILE_HEADER.size)
+        if len(header) < self.FILE_HEADER.size:
+            # A new spool, or one that crashed while it was created
+            self._fh.truncate(0)
+            self._write_offset(self.FILE_HEADER.size)
+            return self.offset
+
+        magic, offset, crc = self.FILE_HEADER.unpack(header)
+        if magic != self.MAGIC:
+            raise InvalidConfigError(f'{self.path} is not a spool file')
+        if zlib.crc32(struct.pack('>Q', offset)) != crc:
+            # Replaying some batches twice beats losing them
+            logging.error(
+                f'The replay offset in {self.path} is corrupt, replaying '
+                'the whole spool'
+            )
+            return self.FILE_HEADER.size
+
+        return min(max(offset, self.FILE_HEADER.size), self.size)
+
+    def _write_offset(self, offset: int) -> None:
+        self._fh.seek(0)
+        self._fh.write(self._pack_offset(offset))
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self.offset = offset
+
+    def _pack_offset(self, offset: int) -> bytes:
+        return self.FILE_HEADER.pack(
+            self.MAGIC, offset, zlib.crc32(struct.pack('>Q', offset)))
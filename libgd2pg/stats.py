@@ -0,0 +1,57 @@
+from threading import Lock
+from typing import Dict, Union
+
+
+class Stats:
+    """
+    A thread safe registry of gdata2pg's own internal metrics.  These are
+    collected each minute and inserted along with everything else, under
+    the entity configured by "stats_entity".
+
+    Counters and maxes are reset every time they are collected, gauges
+    keep their last value.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._maxes = {}
+        self._gauges = {}
+
+    def incr(self, name: str, val: Union[int, float]=1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + val
+
+    def max(self, name: str, val: Union[int, float]) -> None:
+        with self._lock:
+            if val > self._maxes.get(name, val - 1):
+                self._maxes[name] = val
+
+    def gauge(self, name: str, val: Union[int, float]) -> None:
+        with self._lock:
+            self._gauges[name] = val
+
+    def get(self, name: str) -> Union[int, float, None]:
+        with self._lock:
+            for store in (self._counters, self._maxes, self._gauges):
+                if name in store:
+                    return store[name]
+
+        return None
+
+    def get_reset(self) -> Dict[str, Union[int, float]]:
+        """
+        Returns all the current values, resetting the counters and maxes
+        """
+        with self._lock:
+            ret = dict(self._gauges)
+            ret.update(self._maxes)
+            ret.update(self._counters)
+            self._counters = {name: 0 for name in self._counters}
+            self._maxes = {}
+
+        return ret
+
+
+# Singleton Stats instance
+STATS = Stats()
@@ -1,26 +1,27 @@
 import logging
 import time
+from datetime import datetime
 from threading import Thread, Timer, Event
 from typing import TYPE_CHECKING, Optional
 
 if TYPE_CHECKING:
     from .datamanager import DataManager
-    from .db import DB
+    from .writer import DBWriter
 
 class InsTimer(Thread):
     """
-    This just manages the data collection and db insert functionality at
-    the given intervals
+    This just manages the data collection at the given intervals, handing
+    the metrics off to the DBWriter to be inserted
     """
     
     def __init__(
             self,
             dm: 'DataManager',
-            db: 'DB',
+            writer: 'DBWriter',
             name: Optional[str]='InsTime'):
         super().__init__(name=name)
         self.dm = dm
-        self.db = db
+        self.writer = writer
         self.daemon = True
         self._stop_ev = Event()
 
@@ -40,19 +41,15 @@ class InsTimer(Thread):
     def _do_work(self) -> None:
         logging.debug('Doing work')
         metrics = None
-        res = None
+        # The time these metrics are for, regardless of when they're written
+        dt = datetime.utcnow()
         try:
             metrics = self.dm.get_metrics_reset()
         except Exception as e:
             logging.exception('Error getting metrics')
 
         if metrics:
-            try:
-                res = self.db.insert_metrics(metrics)
-            except Exception as e:
-                logging.exception('Error inserting metrics into db')
-
-        logging.debug(f'Insert result: {res}')
+            self.writer.submit(metrics, dt)
 
         if self._stop_ev.is_set():
             logging.info('Work completed, closing thread')
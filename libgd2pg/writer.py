@@ -0,0 +1,266 @@
+from .stats import STATS
+from collections import deque
+from datetime import datetime
+from threading import Condition, Event, Thread
+from typing import TYPE_CHECKING, Any, Dict, NamedTuple, Optional
+import logging
+import time
+
+from .spool import Spool
+
+if TYPE_CHECKING:
+    from .config import GDConfig
+    from .db import DB
+
+
+class Batch(NamedTuple):
+    """
+    A minute's metrics waiting to be written.  dt is when they were
+    aggregated, so a delayed write still lands on the right minute.
+    """
+    dt: datetime
+    metrics: Dict[str, Dict[str, Any]]
+    queued: float
+    attempts: int
+
+
+class DBWriter(Thread):
+    """
+    Writes the aggregated metrics to the db from a bounded queue, so a slow
+    or failed insert doesn't hold up the aggregation each minute.
+
+    Failed writes are retried with exponential backoff, up to max_retries
+    times.  If the queue is full when a new batch is submitted, the oldest
+    batch is dropped.  The queue depth, the age of the oldest queued batch
+    and the drops are reported in the stats as writer.*
+
+    With a Spool, a batch that fails to write is spooled to disk at once,
+    rather than retried from memory, as is anything that would otherwise be
+    dropped.  The spool is replayed, in order, after each successful write
+    and every replay_interval seconds while idle, backing off the same way
+    while the db is still down.  A spooled batch that fails max_replays
+    times while the db is taking other writes is rejected, i.e. moved aside,
+    so the batches behind it can drain.
+    """
+
+    def __init__(
+            self,
+            db: 'DB',
+            max_queue: Optional[int]=60,
+            max_retries: Optional[int]=10,
+            backoff: Optional[float]=1.0,
+            max_backoff: Optional[float]=60.0,
+            spool: Optional[Spool]=None,
+            replay_interval: Optional[float]=30.0,
+            max_replays: Optional[int]=5,
+            name: Optional[str]='DBWriter'):
+        super().__init__(name=name)
+        self.db = db
+        self.max_queue = max(max_queue, 1)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spool = spool
+        self.replay_interval = replay_interval
+        self.max_replays = max_replays
+        self.daemon = True
+        self._queue = deque()
+        self._cond = Condition()
+        self._stop_ev = Event()
+        # Consecutive failures, for the backoff
+        self._failures = 0
+        # Failed replays of the oldest spooled batch while the db was up
+        self._replay_failures = 0
+
+    @classmethod
+    def from_config(cls, config: 'GDConfig', db: 'DB') -> 'DBWriter':
+        spool = None
+        spool_path = config['main'].get('spool_path', '')
+        if spool_path:
+            spool = Spool(
+                spool_path,
+                config['main'].getint('spool_max_mb', 1024) * 1024 * 1024,
+            )
+
+        return cls(
+            db,
+            config['main'].getint('write_queue_size', 60),
+            config['main'].getint('write_max_retries', 10),
+            config['main'].getfloat('write_backoff', 1.0),
+            config['main'].getfloat('write_max_backoff', 60.0),
+            spool,
+            config['main'].getfloat('spool_replay_interval', 30.0),
+            config['main'].getint('spool_max_replays', 5),
+        )
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def submit(
+            self,
+            metrics: Dict[str, Dict[str, Any]],
+            dt: Optional[datetime]=None) -> None:
+        """
+        Queue the metrics to be written for the given time, which defaults
+        to now
+        """
+        dt = datetime.utcnow() if dt is None else dt
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                dropped = self._queue.popleft()
+                self._drop(dropped, 'the write queue is full')
+            self._queue.append(Batch(dt, metrics, time.time(), 0))
+            self._update_stats()
+            self._cond.notify()
+
+    def stop(self) -> None:
+        """
+        Stop once whatever is queued has been written, with no more retries
+        """
+        logging.info('Setting the stop event in the db writer')
+        self._stop_ev.set()
+        with self._cond:
+            self._cond.notify()
+
+    def run(self) -> None:
+        logging.debug('DB writer thread started')
+        while True:
+            with self._cond:
+                if not self._queue and not self._stop_ev.is_set():
+                    # Wake up to replay the spool, if there's anything in it
+                    self._cond.wait(
+                        self.replay_interval if self._spooled() else None)
+                if self._queue:
+                    batch = self._queue.popleft()
+                elif self._stop_ev.is_set():
+                    break
+                else:
+                    batch = None
+
+            if batch is None:
+                self._replay()
+            elif self._write(batch):
+                self._replay()
+            else:
+                self._retry(batch)
+
+        if self.spool:
+            self.spool.close()
+        logging.info('DB writer stopped')
+
+    def _write(self, batch: Batch) -> bool:
+        start = time.time()
+        try:
+            ret = self.db.insert_metrics(batch.metrics, batch.dt)
+        except Exception:
+            logging.exception('Error inserting metrics into db')
+            ret = False
+
+        STATS.gauge('writer.write_ms', (time.time() - start) * 1000)
+        logging.debug(f'Insert result: {ret}')
+        if ret:
+            self._failures = 0
+            STATS.incr('writer.batches_written')
+        else:
+            self._failures += 1
+            STATS.incr('writer.write_errors')
+
+        with self._cond:
+            self._update_stats()
+
+        return ret
+
+    def _retry(self, batch: Batch) -> None:
+        """
+        Put a failed batch back at the head of the queue, after a backoff,
+        or drop it if it's out of retries
+        """
+        batch = batch._replace(attempts=batch.attempts + 1)
+        if self.spool:
+            self._drop(batch, 'the write failed')
+            self._backoff()
+            return
+        if self._stop_ev.is_set():
+            self._drop(batch, 'the writer is stopping')
+            return
+        if batch.attempts > self.max_retries:
+            self._drop(batch, f'the write failed {batch.attempts} times')
+            return
+
+        delay = min(
+            self.backoff * 2 ** (batch.attempts - 1), self.max_backoff)
+        logging.warning(
+            f'Write of the metrics for {batch.dt} failed, retrying in '
+            f'{delay:.1f}s'
+        )
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                # This is the oldest batch
+                self._drop(batch, 'the write queue is full')
+                return
+            self._queue.appendleft(batch)
+            self._update_stats()
+
+        self._stop_ev.wait(delay)
+
+    def _replay(self) -> None:
+        """
+        Write the spooled batches, oldest first, until the spool is empty
+        or a write fails
+        """
+        while self.spool and self.spool.pending and \
+                not self._stop_ev.is_set():
+            rec = self.spool.peek()
+            if rec is None:
+                break
+            (dt, metrics), next_offset = rec
+            # A failure only counts against the batch if the last write
+            # worked, otherwise the db is probably just down
+            db_up = not self._failures
+            if not self._write(Batch(dt, metrics, 0, 0)):
+                logging.warning(
+                    f'Replay of the spooled metrics for {dt} failed')
+                self._replay_failures += db_up
+                if self.max_replays and \
+                        self._replay_failures >= self.max_replays:
+                    self.spool.reject(next_offset)
+                    self._replay_failures = 0
+                    STATS.incr('spool.batches_rejected')
+                    continue
+                self._backoff()
+                break
+            self._replay_failures = 0
+            self.spool.commit(next_offset)
+            STATS.incr('spool.batches_replayed')
+            logging.info(f'Replayed the spooled metrics for {dt}')
+
+        if self.spool:
+            STATS.gauge('spool.pending_bytes', self.spool.pending)
+
+    def _backoff(self) -> None:
+        delay = min(
+            self.backoff * 2 ** max(self._failures - 1, 0), self.max_backoff)
+        self._stop_ev.wait(delay)
+
+    def _spooled(self) -> bool:
+        return bool(self.spool and self.spool.pending)
+
+    def _drop(self, batch: Batch, reason: str) -> None:
+        if self.spool:
+            if self.spool.append(batch.dt, batch.metrics):
+                logging.warning(f'Spooled the metrics for {batch.dt}, {reason}')
+                STATS.incr('spool.batches_spooled')
+                STATS.gauge('spool.pending_bytes', self.spool.pending)
+                return
+            reason += ' and the spool is full'
+
+        logging.error(f'Dropping the metrics for {batch.dt}, {reason}')
+        STATS.incr('writer.batches_dropped')
+
+    def _update_stats(self) -> None:
+        # Must be called with the condition held
+        STATS.gauge('writer.queue_depth', len(self._queue))
+        STATS.gauge(
+            'writer.lag_s',
+            time.time() - self._queue[0].queued if self._queue else 0,
+        )
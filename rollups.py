@@ -8,6 +8,7 @@ from dateparser import parse as dparse
 from datetime import datetime, timedelta, date
 from libgd2pg.db import DB
 from libgd2pg.config import GDConfig
+from libgd2pg.rollup import parallel_rollup
 
 
 PART_TPL = '{table}_{year}{month}'
@@ -58,6 +59,10 @@ def get_args():
         help='Sleep until this time to run the vacuum [default: %(default)s]')
     p.add_argument('-F', '--force-partition-only', default=False,
         action='store_true', help='Force the partition creation and exit')
+    p.add_argument('-j', '--jobs', default=1, type=int,
+        help='Spread the rollups over this many worker processes, each with '
+        'its own db connection ("python" rollup_mode only) '
+        '[default: %(default)s]')
     p.add_argument('-D', '--debug', action='store_true', default=False,
         help='Add debug output [default: %(default)s]')
 
@@ -74,15 +79,43 @@ def setup_logging(args):
     )
 
 
+def fill_tiers(db, conf, args):
+    """
+    Fill a tier for each rollup_period, before the raw data is rolled up
+    """
+    delay = conf['rollups'].getint('tier_delay', 3600)
+    end = datetime.utcnow() - timedelta(seconds=delay)
+    periods = sorted(set(
+        conf[roll].getint('rollup_period')
+        for roll in conf['rollups'].getlist('rollups')
+    ))
+    for period in periods:
+        logging.debug(f'Filling the {period}s tier up to {end}')
+        db.fill_tier(period, end, args.dry_run)
+
+
 def do_rollups(db, conf, args):
+    watermarks = conf['rollups'].getboolean('use_watermarks', False)
     for roll in conf['rollups'].getlist('rollups'):
         start = dparse(conf[roll]['start_time'])
         end = conf[roll]['end_time']
         if end:
             end = dparse(end)
         period = conf[roll].getint('rollup_period')
-        logging.debug('Running rollup for {}'.format(roll))
-        db.do_rollup(start, period, end, args.dry_run)
+        mode = conf[roll].get('rollup_mode', 'python')
+        tier = roll if watermarks else None
+        logging.debug('Running rollup for {} in {} mode'.format(roll, mode))
+        if args.jobs > 1 and mode == 'python':
+            workers = parallel_rollup(
+                db, start, period, end, args.dry_run, args.jobs, tier)
+            failed = sum(w['failed'] for w in workers.values())
+            if failed:
+                logging.error(f'{failed} series failed the {roll} rollup')
+            failed = sum(w['failed_entities'] for w in workers.values())
+            if failed:
+                logging.error(f'{failed} entities failed the {roll} rollup')
+        else:
+            db.do_rollup(start, period, end, args.dry_run, mode, tier)
 
 
 def do_partition(base_tbl, db, conf, args):
@@ -185,6 +218,8 @@ def main():
         do_partition('weblogs', db, conf, args)
 
     if not args.force_partition_only:
+        if conf['rollups'].getboolean('use_tiers', False):
+            fill_tiers(db, conf, args)
         do_rollups(db, conf, args)
 
     # Now, try and cleanup disk space
@@ -3,11 +3,13 @@
 import logging
 import sys
 from argparse import ArgumentParser
+from libgd2pg.collectd_net import udp_listener
 from libgd2pg.config import GDConfig
 from libgd2pg.datamanager import dm
 from libgd2pg.db import DB
 from libgd2pg.flask import APP, flask_init
 from libgd2pg.timer import InsTimer
+from libgd2pg.writer import DBWriter
 
 
 def get_args():
@@ -30,6 +32,47 @@ def setup_logging(args):
     )
 
 
+def run_server(config):
+    """
+    Run the ingest server until it's stopped.  This is a single process, so
+    that there is only one DataManager and InsTimer, with the requests
+    handled by a pool of threads.
+    """
+    server = config.get('server', 'server', fallback='waitress')
+    host, port = config.get(
+        'server', 'listen', fallback='127.0.0.1:5000').rsplit(':', 1)
+    port = int(port)
+    threads = config.getint('server', 'threads', fallback=8)
+    conn_limit = config.getint('server', 'connection_limit', fallback=100)
+
+    if server == 'waitress':
+        try:
+            from waitress import serve
+        except ImportError:
+            logging.warning(
+                'waitress is not installed, falling back to the flask '
+                'development server'
+            )
+            server = 'flask'
+
+    if server == 'waitress':
+        logging.info(
+            f'Starting waitress on {host}:{port} with {threads} threads and '
+            f'a limit of {conn_limit} connections'
+        )
+        serve(
+            APP,
+            host=host,
+            port=port,
+            threads=threads,
+            connection_limit=conn_limit,
+            ident='gdata2pg',
+        )
+    else:
+        logging.info(f'Starting the flask development server on {host}:{port}')
+        APP.run(host=host, port=port, threaded=True)
+
+
 def main():
     args = get_args()
     setup_logging(args)
@@ -40,14 +83,24 @@ def main():
     # Initialize everything with the config
     dmgr = dm(config)
     db = DB(config)
-    timer = InsTimer(dmgr, db)
+    writer = DBWriter.from_config(config, db)
+    writer.start()
+    timer = InsTimer(dmgr, writer)
     timer.start()
+    udp = udp_listener(config, dmgr)
+    if udp:
+        udp.start()
     flask_init(config, dmgr)
 
-    APP.run()
+    run_server(config)
 
+    if udp:
+        udp.stop()
     timer.stop()
     timer.join(3.0)
+    writer.stop()
+    writer.join(30.0)
+    dmgr.close()
 
     return 0
 
@@ -0,0 +1,392 @@
+"""
+Benchmarks for the hot paths.  These are skipped unless GD2PG_BENCH is set:
+
+    GD2PG_BENCH=1 python -m pytest -s tests/test_bench.py
+"""
+from libgd2pg.config import GDConfig
+from collections import defaultdict
+from datetime import datetime, timedelta
+from io import BytesIO
+from libgd2pg.datamanager import DataManager, DataTup
+from libgd2pg.db import DB
+from libgd2pg.ingest import iter_json, iter_msgpack, slim
+from tests.test_db import copy_data
+from tests.test_ingest import SAMPLE
+from unittest.mock import MagicMock
+import gc
+import json
+import os
+import random
+import time
+import tracemalloc
+import unittest
+
+CONF_FILE = os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'gdata2pg.ini.default',
+)
+BENCH = os.environ.get('GD2PG_BENCH')
+
+
+@unittest.skipUnless(BENCH, 'Set GD2PG_BENCH=1 to run the benchmarks')
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        self.config = GDConfig()
+        self.config.read(CONF_FILE)
+        self.rand = random.Random(42)
+
+    def _get_dm(self, **opts) -> DataManager:
+        for k, v in opts.items():
+            self.config['main'][k] = v
+        return DataManager(self.config)
+
+    def _get_dtups(self, num_metrics, num_samples, mtype='gauge'):
+        return [
+            DataTup(f'metric{i}', mtype, self.rand.lognormvariate(5, 2))
+            for _ in range(num_samples)
+            for i in range(num_metrics)
+        ]
+
+    def _report(self, title, header, rows):
+        print(f'\n{title}')
+        print(' | '.join(header))
+        for row in rows:
+            print(' | '.join(str(c) for c in row))
+
+    def test_pct_engines(self):
+        """
+        Exact numpy percentiles vs. the DDSketch engine for the gauge rollups
+        """
+        num_metrics = 100
+        rows = []
+        for num_samples in (6, 60, 600, 6000):
+            dtups = self._get_dtups(num_metrics, num_samples)
+            results = {}
+            for engine in ('exact', 'sketch'):
+                dmg = self._get_dm(pct_engine=engine)
+
+                start = time.perf_counter()
+                agg = {}
+                for dtup in dtups:
+                    dmg._add_dtup(agg, dtup)
+                push_time = time.perf_counter() - start
+
+                # Measure the memory held by the accumulators separately,
+                # including the per sample objects they keep
+                tracemalloc.start()
+                mem_agg = {}
+                for dtup in dtups:
+                    dmg._add_dtup(mem_agg, dtup._replace(value=dtup.value + 0))
+                mem, _ = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                del mem_agg
+
+                start = time.perf_counter()
+                results[engine] = dmg._get_comp_metrics(agg)
+                comp_time = time.perf_counter() - start
+
+                rows.append((
+                    num_samples,
+                    engine,
+                    f'{push_time * 1000:.1f}',
+                    f'{comp_time * 1000:.1f}',
+                    f'{mem / 1024:.0f}',
+                ))
+
+            max_err = max(
+                abs(v - results['exact'][k]) / abs(results['exact'][k])
+                for k, v in results['sketch'].items()
+                if results['exact'][k]
+            )
+            rows.append((num_samples, 'max rel err', f'{max_err:.4f}', '', ''))
+
+        self._report(
+            f'pct engines, {num_metrics} metrics',
+            ('samples', 'engine', 'add ms', 'rollup ms', 'mem KiB'),
+            rows,
+        )
+
+    def test_metric_storage(self):
+        """
+        Per sample DataTup lists vs. the MetricBuf arrays
+        """
+        num_metrics = 1000
+        rows = []
+        for num_samples in (6, 60, 600):
+            dtups = self._get_dtups(num_metrics, num_samples)
+            for storage in ('DataTup list', 'MetricBuf'):
+                dmg = self._get_dm()
+
+                def build():
+                    agg = defaultdict(list)
+                    for dtup in dtups:
+                        # Copy each DataTup since the real ones are created
+                        # per sample
+                        dtup = dtup._replace(value=dtup.value + 0)
+                        if storage == 'MetricBuf':
+                            dmg._add_dtup(agg, dtup)
+                        else:
+                            agg[dtup.name].append(dtup)
+                    return agg
+
+                start = time.perf_counter()
+                agg = build()
+                add_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                gc.collect()
+                gc_time = time.perf_counter() - start
+                del agg
+
+                tracemalloc.start()
+                agg = build()
+                mem, _ = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                del agg
+
+                rows.append((
+                    num_samples,
+                    storage,
+                    f'{add_time * 1000:.1f}',
+                    f'{gc_time * 1000:.1f}',
+                    f'{mem / 1024:.0f}',
+                ))
+
+        self._report(
+            f'metric storage, {num_metrics} metrics',
+            ('samples', 'storage', 'add ms', 'full gc ms', 'mem KiB'),
+            rows,
+        )
+
+    def test_multi_pct(self):
+        """
+        One numpy.percentile call per pct(N) vs. the batched, vectorized
+        percentiles for the default rollups_counter
+        """
+        rows = []
+        for num_metrics, num_samples in ((400, 6), (400, 60), (4000, 6)):
+            dmg = self._get_dm()
+            agg = {}
+            for dtup in self._get_dtups(num_metrics, num_samples, 'counter'):
+                dmg._add_dtup(agg, dtup._replace(value=int(dtup.value)))
+
+            def per_pct():
+                # The path before the percentiles were batched
+                ret = {}
+                for name, buf in agg.items():
+                    for rollup in dmg.plan.get(name, buf.type):
+                        key = f'{name}.{rollup.suffix}'
+                        if rollup.pct is None:
+                            ret[key] = rollup.func(buf)
+                        else:
+                            ret[key] = rollup.func(buf, rollup.pct)
+                return ret
+
+            times = {}
+            results = {}
+            for path, func in (
+                    ('per pct', per_pct),
+                    ('vectorized', lambda: dmg._get_comp_metrics(agg))):
+                start = time.perf_counter()
+                for _ in range(5):
+                    results[path] = func()
+                times[path] = (time.perf_counter() - start) / 5
+
+            self.assertEqual(results['per pct'], results['vectorized'])
+            rows.append((
+                num_metrics,
+                num_samples,
+                f'{times["per pct"] * 1000:.1f}',
+                f'{times["vectorized"] * 1000:.1f}',
+                f'{times["per pct"] / times["vectorized"]:.1f}x',
+            ))
+
+        self._report(
+            'multi percentile, rollups_counter: '
+            f'{self.config["main"]["rollups_counter"]}',
+            ('metrics', 'samples', 'per pct ms', 'vectorized ms', 'speedup'),
+            rows,
+        )
+
+    def _get_payload(self, num_dicts, packer=None):
+        data = []
+        for i in range(num_dicts):
+            d = dict(SAMPLE[i % len(SAMPLE)])
+            d['host'] = f'host{i % 200}'
+            d['values'] = [self.rand.randint(0, 2 ** 40) for _ in d['values']]
+            data.append(d)
+        if packer:
+            return packer(data)
+        return json.dumps(data).encode('utf-8')
+
+    def test_json_ingest(self):
+        """
+        json.loads of the whole body vs. the streaming iter_json
+        """
+        rows = []
+        for num_dicts in (1000, 10000, 50000):
+            raw = self._get_payload(num_dicts)
+            mbytes = len(raw) / 1024 / 1024
+
+            def whole():
+                # The old path: the raw bytes and the whole decoded list
+                return [slim(d) for d in json.loads(BytesIO(raw).read())]
+
+            def streaming():
+                # Batches are handed to push() and released as we go
+                count = 0
+                batch = []
+                for d in iter_json(BytesIO(raw)):
+                    batch.append(slim(d))
+                    if len(batch) >= 500:
+                        count += len(batch)
+                        batch = []
+                return count + len(batch)
+
+            for path, func in (('json.loads', whole), ('iter_json', streaming)):
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+
+                tracemalloc.start()
+                func()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                rows.append((
+                    f'{mbytes:.1f}',
+                    path,
+                    f'{mbytes / elapsed:.1f}',
+                    f'{peak / 1024 / 1024:.1f}',
+                ))
+
+        self._report(
+            'JSON ingest, per request',
+            ('body MiB', 'parser', 'MiB/s', 'peak MiB'),
+            rows,
+        )
+
+    def test_msgpack_ingest(self):
+        """
+        Bytes on the wire and decode time for JSON vs. msgpack bodies
+        """
+        try:
+            import msgpack
+        except ImportError:
+            self.skipTest('msgpack is not installed')
+
+        rows = []
+        for num_dicts in (1000, 10000, 50000):
+            for fmt, packer, parse in (
+                    ('json', None, iter_json),
+                    ('msgpack', msgpack.packb, iter_msgpack)):
+                # The same seed, so both formats get the same values
+                self.rand.seed(num_dicts)
+                raw = self._get_payload(num_dicts, packer)
+
+                start = time.perf_counter()
+                count = sum(1 for d in parse(BytesIO(raw)) if slim(d))
+                elapsed = time.perf_counter() - start
+                self.assertEqual(count, num_dicts)
+
+                rows.append((
+                    num_dicts,
+                    fmt,
+                    f'{len(raw) / 1024:.0f}',
+                    f'{elapsed * 1000:.1f}',
+                    f'{num_dicts / elapsed:.0f}',
+                ))
+
+        self._report(
+            'Ingest format, per request',
+            ('dicts', 'format', 'body KiB', 'decode ms', 'dicts/s'),
+            rows,
+        )
+
+    def test_compress(self):
+        """
+        The row at a time rollup loop vs. reading the binary COPY output
+        into arrays for _compress_arrays, for a series of 10 second samples.
+        This leaves out the db, where fetching the rows as tuples of
+        datetimes is also about twice as slow as the binary COPY.
+        """
+        db = DB.__new__(DB)
+        conn = MagicMock()
+        curs = conn.cursor.return_value.__enter__.return_value
+        epoch = datetime(1970, 1, 1)
+        rows = []
+        for num_rows in (1000, 10000, 100000, 1000000):
+            start_dt = datetime(2020, 3, 1)
+            # As they're fetched, with the times as datetimes for the loop
+            # and as epoch usecs for the arrays
+            dt_rows = []
+            us_rows = []
+            for i in range(num_rows):
+                added = start_dt + timedelta(seconds=10 * i)
+                val = self.rand.lognormvariate(5, 2)
+                dt_rows.append((i, added, val))
+                us_rows.append(
+                    (i, (added - epoch) // timedelta(microseconds=1), val))
+            data = copy_data(us_rows)
+            curs.copy_expert.side_effect = \
+                lambda query, buf: buf.write(data)
+
+            for period in (300, 1800):
+                def loop():
+                    # The old path: timedelta math and a list per bucket
+                    td = timedelta(seconds=period)
+                    ret = []
+                    cur_dt = last_add = dt_rows[0][1]
+                    cur_vals = []
+                    for _, added, val in dt_rows:
+                        if added - td >= cur_dt:
+                            ret.append(
+                                (last_add, sum(cur_vals) / len(cur_vals)))
+                            cur_dt = added
+                            cur_vals = [val]
+                        else:
+                            cur_vals.append(val)
+                        last_add = added
+                    ret.append((last_add, sum(cur_vals) / len(cur_vals)))
+                    return ret
+
+                def arrays():
+                    return db._compress_rows(
+                        db._copy_rollup_rows(conn, 'COPY', ()), period)
+
+                times = {}
+                results = {}
+                for path, func in (('loop', loop), ('arrays', arrays)):
+                    # The best of 3, as the smaller series are quick
+                    times[path] = float('inf')
+                    for _ in range(3):
+                        start = time.perf_counter()
+                        results[path] = func()
+                        times[path] = min(
+                            times[path], time.perf_counter() - start)
+
+                self.assertEqual(len(results['loop']), len(results['arrays']))
+                for (d1, v1), (d2, v2) in zip(
+                        results['loop'], results['arrays']):
+                    self.assertEqual(d1, d2)
+                    self.assertAlmostEqual(v1, v2)
+
+                for path in ('loop', 'arrays'):
+                    rows.append((
+                        num_rows,
+                        period,
+                        path,
+                        f'{times[path] * 1000:.1f}',
+                        f'{times["loop"] / times[path]:.1f}x',
+                    ))
+
+        self._report(
+            'Rollup compression, per series',
+            ('rows', 'period', 'path', 'ms', 'speedup'),
+            rows,
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
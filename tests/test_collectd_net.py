@@ -0,0 +1,126 @@
+from libgd2pg.collectd_net import UDPListener, load_types_db, parse_packet
+from libgd2pg.error import InvalidDataError
+from libgd2pg.stats import STATS
+from unittest.mock import MagicMock
+import socket
+import struct
+import tempfile
+import time
+import unittest
+
+
+def _str_part(ptype, val):
+    data = val.encode('utf-8') + b'\0'
+    return struct.pack('>HH', ptype, len(data) + 4) + data
+
+
+def _vals_part(vals):
+    fmts = {0: '>Q', 1: '<d', 2: '>q', 3: '>Q'}
+    data = struct.pack('>H', len(vals))
+    data += bytes(ds for ds, _ in vals)
+    for ds, val in vals:
+        data += struct.pack(fmts[ds], val)
+    return struct.pack('>HH', 6, len(data) + 4) + data
+
+
+# What collectd's network plugin sends for the same data as SAMPLE in
+# test_ingest: an interface derive pair, then a df gauge reusing the host
+PACKET = b''.join([
+    _str_part(0, 'jay-vm'),
+    struct.pack('>HHQ', 8, 12, 1583003789 << 30),
+    struct.pack('>HHQ', 9, 12, 10 << 30),
+    _str_part(2, 'interface'),
+    _str_part(3, 'enp0s3'),
+    _str_part(4, 'if_dropped'),
+    _str_part(5, ''),
+    _vals_part([(2, 196), (2, 0)]),
+    _str_part(2, 'df'),
+    _str_part(3, 'root'),
+    _str_part(4, 'df_complex'),
+    _str_part(5, 'used'),
+    _vals_part([(1, 45761314816.0)]),
+])
+
+
+class TestCollectdNet(unittest.TestCase):
+    def test_parse_packet(self):
+        vals = parse_packet(PACKET, {'if_dropped': ['rx', 'tx']})
+
+        self.assertEqual(vals, [
+            {
+                'host': 'jay-vm',
+                'plugin': 'interface',
+                'plugin_instance': 'enp0s3',
+                'type': 'if_dropped',
+                'type_instance': '',
+                'dsnames': ['rx', 'tx'],
+                'dstypes': ['derive', 'derive'],
+                'values': [196, 0],
+            },
+            {
+                'host': 'jay-vm',
+                'plugin': 'df',
+                'plugin_instance': 'root',
+                'type': 'df_complex',
+                'type_instance': 'used',
+                'dsnames': ['value'],
+                'dstypes': ['gauge'],
+                'values': [45761314816.0],
+            },
+        ])
+
+        # Without a types.db, multiple values are named by index
+        self.assertEqual(parse_packet(PACKET)[0]['dsnames'], ['0', '1'])
+
+    def test_parse_invalid(self):
+        for data in (
+                PACKET[:-3],
+                PACKET + b'\0',
+                struct.pack('>HH', 0, 2),
+                struct.pack('>HHHB', 6, 15, 1, 5) + b'\0' * 8,
+                struct.pack('>HH', 0x0210, 4)):
+            with self.assertRaises(InvalidDataError):
+                parse_packet(data)
+
+    def test_load_types_db(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.db') as fh:
+            fh.write(
+                '# comment\n'
+                'if_dropped\t\trx:DERIVE:0:U, tx:DERIVE:0:U\n'
+                'df_complex\t\tvalue:GAUGE:0:U\n'
+            )
+            fh.flush()
+            types = load_types_db([fh.name])
+
+        self.assertEqual(types, {
+            'if_dropped': ['rx', 'tx'],
+            'df_complex': ['value'],
+        })
+
+    def test_listener(self):
+        dm = MagicMock()
+        STATS.get_reset()
+        listener = UDPListener(dm, '127.0.0.1:0', rcvbuf=1024 * 1024)
+        listener.start()
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.sendto(PACKET, listener.address)
+            sock.sendto(b'garbage', listener.address)
+            sock.close()
+
+            deadline = time.time() + 5
+            while STATS.get('udp.packets') != 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            listener.stop()
+            listener.join(3.0)
+
+        self.assertEqual(STATS.get('udp.packets'), 2)
+        self.assertEqual(STATS.get('udp.packets_invalid'), 1)
+        self.assertEqual(STATS.get('udp.values'), 2)
+        dm.push.assert_called_once()
+        self.assertEqual(len(dm.push.call_args[0][0]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
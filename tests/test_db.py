@@ -1,8 +1,12 @@
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 from libgd2pg.config import GDConfig
 from unittest.mock import MagicMock, patch
 from libgd2pg.db import DB
+from libgd2pg.error import InvalidConfigError
+from psycopg2.extras import execute_values
+import numpy as np
 import os
+import psycopg2
 import unittest
 
 CONF_FILE = os.path.join(
@@ -10,14 +14,46 @@ CONF_FILE = os.path.join(
     '..',
     'gdata2pg.ini.default',
 )
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), '..', 'tsd.sql')
+# A libpq connection string for the tests that need a real db, e.g.
+# "host=localhost dbname=test user=test".  They create and drop their own
+# schema in it.
+TEST_DSN = os.environ.get('GD2PG_TEST_DSN')
+
+
+def copy_data(rows):
+    """
+    Returns the (id, added, value) rows as Postgres' binary COPY output,
+    with added as epoch microseconds
+    """
+    arr = np.zeros(len(rows), DB.ROLLUP_ROW)
+    arr['num_fields'] = 3
+    for field in ('id_len', 'added_len', 'value_len'):
+        arr[field] = 8
+    if rows:
+        arr['id'], arr['added'], arr['value'] = zip(*rows)
+
+    return (
+        DB.COPY_SIGNATURE + bytes(8) + arr.tobytes() + b'\xff\xff')
+
 
 class TestDB(unittest.TestCase):
     def setUp(self):
         self.config = GDConfig()
         self.config.read(CONF_FILE)
-        mock = MagicMock(return_value=MagicMock())
-        with patch.object(DB, '_get_conn', mock):
-            self.db = DB(self.config)
+        self.db = self._get_db()
+
+    def _get_db(self):
+        # Every connection from the pool is this mock
+        self.conn = MagicMock(closed=0)
+        patcher = patch.object(
+            DB, '_get_conn', MagicMock(return_value=self.conn))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return DB(self.config)
+
+    def _get_curs(self, db):
+        return self.conn.cursor.return_value.__enter__.return_value
 
     def test_compress(self):
         test_data = [
@@ -65,3 +101,415 @@ class TestDB(unittest.TestCase):
         ret = self.db._compress_vals(test_data, 1800)
 
         self.assertEqual(ret, expected)
+
+    def test_compress_arrays(self):
+        sec = 1_000_000
+        # A bucket holds everything less than the period after its first
+        # row, however many rows share a time or how big the gaps are
+        times = np.array([0, 0, 299 * sec, 300 * sec, 300 * sec, 1000 * sec,
+            1299 * sec + 999999, 1300 * sec])
+        vals = np.array([1, 2, 3, 4, 6, 7, 9, 11], dtype=np.float64)
+        ends, avgs = self.db._compress_arrays(times, vals, 300)
+        self.assertEqual(ends.tolist(), [2, 4, 6, 7])
+        self.assertEqual(avgs.tolist(), [2.0, 5.0, 8.0, 11.0])
+
+        ends, avgs = self.db._compress_arrays(times[:1], vals[:1], 300)
+        self.assertEqual((ends.tolist(), avgs.tolist()), ([0], [1.0]))
+
+        # Regular minutely rows, and the same with gaps that move the
+        # buckets off the grid, against a bucket at a time walk
+        rng = np.random.default_rng(0)
+        regular = np.arange(7, 2000) * 60 * sec
+        for times in (regular, np.sort(rng.choice(regular, 800, False))):
+            vals = rng.uniform(0, 100, len(times))
+            ends, avgs = self.db._compress_arrays(times, vals, 300)
+            start = 0
+            for end, avg in zip(ends.tolist(), avgs.tolist()):
+                self.assertEqual(
+                    end + 1,
+                    np.searchsorted(times, times[start] + 300 * sec))
+                self.assertAlmostEqual(avg, vals[start:end + 1].mean())
+                start = end + 1
+            self.assertEqual(start, len(times))
+
+    def test_copy_rollup_rows(self):
+        db = self._get_db()
+        curs = self._get_curs(db)
+        rows = [(5, 1586509200000000, 1.5), (9, 1586509210000000, -2.0)]
+        curs.copy_expert.side_effect = \
+            lambda query, buf: buf.write(copy_data(rows))
+        curs.mogrify.return_value = b'COPY (SELECT 1) TO STDOUT'
+
+        arr = db._copy_rollup_rows(self.conn, 'COPY (SELECT %s)', (1,))
+        self.assertEqual(
+            list(zip(arr['id'].tolist(), arr['added'].tolist(),
+                arr['value'].tolist())),
+            rows,
+        )
+
+        curs.copy_expert.side_effect = \
+            lambda query, buf: buf.write(copy_data([]))
+        self.assertEqual(
+            len(db._copy_rollup_rows(self.conn, 'COPY (SELECT 1)', ())), 0)
+
+        curs.copy_expert.side_effect = lambda query, buf: buf.write(b'1\t2\n')
+        with self.assertRaises(ValueError):
+            db._copy_rollup_rows(self.conn, 'COPY (SELECT 1)', ())
+
+    def test_insert_copy(self):
+        self.config['main']['insert_mode'] = 'copy'
+        db = self._get_db()
+        curs = self._get_curs(db)
+        db.ent_cache.set('host1', 1)
+        db.ent_cache.set('host2', 2)
+        db.key_cache.set('a.avg', 10)
+        db.key_cache.set('b.avg', 11)
+        self.conn.commit.reset_mock()
+
+        metrics = {
+            'host1': {'a.avg': 1.5, 'b.avg': None},
+            'host2': {'a.avg': 2, 'b.avg': 3.25},
+        }
+        ret = db.insert_metrics(
+            metrics, dt.strptime('2020-03-20 10:00:12', self.db.DT_TF))
+
+        self.assertTrue(ret)
+        query, buf = curs.copy_expert.call_args[0]
+        self.assertTrue(query.startswith('COPY tsd'))
+        self.assertEqual(
+            buf.getvalue(),
+            '1\t10\t2020-03-20 10:00:00\t1.5\n'
+            '2\t10\t2020-03-20 10:00:00\t2.0\n'
+            '2\t11\t2020-03-20 10:00:00\t3.25\n',
+        )
+        self.conn.commit.assert_called_once()
+
+    def test_invalid_insert_mode(self):
+        self.config['main']['insert_mode'] = 'bogus'
+        with self.assertRaises(InvalidConfigError):
+            self._get_db()
+
+    def test_resolve_ids(self):
+        db = self._get_db()
+        curs = self._get_curs(db)
+        db.key_cache.set('a.avg', 10)
+
+        with patch('libgd2pg.db.execute_values') as ev:
+            ev.return_value = [(11, 'b.avg'), (12, 'c.avg')]
+            ret = db._resolve_ids(
+                curs, 'keys', 'key', ['a.avg', 'b.avg', 'c.avg'],
+                db.key_cache)
+
+            # Only the unknown names are resolved, in a single query
+            ev.assert_called_once()
+            self.assertEqual(ev.call_args[0][2], [('b.avg',), ('c.avg',)])
+
+        self.assertEqual(ret, {'a.avg': 10, 'b.avg': 11, 'c.avg': 12})
+        self.assertEqual(db.key_cache.hits, 1)
+        self.assertEqual(db.key_cache.misses, 2)
+
+        # Everything should now come from the cache
+        with patch('libgd2pg.db.execute_values') as ev:
+            db._resolve_ids(
+                curs, 'keys', 'key', ['b.avg', 'c.avg'], db.key_cache)
+            ev.assert_not_called()
+        self.assertEqual(db.key_cache.hits, 3)
+
+    def test_retry(self):
+        self.config['main']['db_retry_backoff'] = '0'
+        db = self._get_db()
+        curs = self._get_curs(db)
+        db._warm_id_caches()
+        db.ent_cache.set('host1', 1)
+        db.key_cache.set('a.avg', 10)
+        curs.execute.reset_mock()
+        DB._get_conn.reset_mock()
+        DB._get_conn.side_effect = self._reconnect
+        # The first connection is terminated mid-insert
+        results = [psycopg2.errors.AdminShutdown('terminated'), None]
+        curs.execute.side_effect = lambda *args: self._execute(results)
+
+        self.assertTrue(db.insert_metrics({'host1': {'a.avg': 1.5}}))
+        self.assertEqual(curs.execute.call_count, 2)
+        # The broken connection was replaced
+        self.assertEqual(DB._get_conn.call_count, 1)
+        self.assertEqual(db.pool.size, 1)
+
+        # Only so many times
+        results = [psycopg2.InterfaceError('closed')] * (db.retries + 1)
+        self.assertFalse(db.insert_metrics({'host1': {'a.avg': 1.5}}))
+        self.assertEqual(curs.execute.call_count, 2 + db.retries + 1)
+
+        # A failed statement on a healthy connection isn't retried and the
+        # connection is kept
+        curs.execute.reset_mock()
+        self.conn.close.reset_mock()
+        curs.execute.side_effect = psycopg2.errors.QueryCanceled('timeout')
+        with self.assertRaises(psycopg2.errors.QueryCanceled):
+            db.run(lambda conn: conn.cursor().__enter__().execute('SELECT'))
+        self.assertEqual(curs.execute.call_count, 1)
+        self.conn.close.assert_not_called()
+        self.assertEqual(db.pool.size, 1)
+
+    def test_warm_id_caches(self):
+        # Nothing is read until the first insert
+        db = self._get_db()
+        curs = self._get_curs(db)
+        curs.execute.assert_not_called()
+
+        curs.fetchall.side_effect = [
+            [(2, 'host2'), (1, 'host1')],
+            [(10, 'a.avg')],
+        ]
+        self.assertTrue(db.insert_metrics({'host1': {'a.avg': 1.5}}))
+        self.assertIn('FROM entities', curs.execute.call_args_list[0][0][0])
+        self.assertIn('FROM keys', curs.execute.call_args_list[1][0][0])
+        self.assertEqual(db.ent_cache.get('host2'), 2)
+        self.assertEqual(db.key_cache.get('a.avg'), 10)
+        # The cached ids were used for the insert
+        self.assertEqual(curs.execute.call_count, 3)
+
+        # Only once
+        curs.execute.reset_mock()
+        self.assertTrue(db.insert_metrics({'host1': {'a.avg': 1.5}}))
+        self.assertEqual(curs.execute.call_count, 1)
+
+    def _reconnect(self, *args):
+        self.conn.closed = 0
+        return self.conn
+
+    def _execute(self, results):
+        ret = results.pop(0)
+        if isinstance(ret, Exception):
+            # psycopg2 marks the connection closed when the server drops it
+            self.conn.closed = 2
+            raise ret
+        return ret
+
+    def test_rollup_sql(self):
+        db = self._get_db()
+        curs = self._get_curs(db)
+        curs.execute.reset_mock()
+        # The oldest row in the range
+        curs.fetchall.return_value = [(dt(2020, 2, 20, 10, 0),)]
+
+        db.do_rollup(
+            dt(2020, 4, 10), 300, dt(2020, 1, 1), mode='sql')
+
+        # One statement per month, each in its own transaction
+        params = [
+            (c[0][1]['lo'], c[0][1]['hi'], c[0][1]['period'])
+            for c in curs.execute.call_args_list[1:]
+        ]
+        self.assertEqual(params, [
+            (dt(2020, 2, 20, 10, 0), dt(2020, 3, 1), 300),
+            (dt(2020, 3, 1), dt(2020, 4, 1), 300),
+            (dt(2020, 4, 1), dt(2020, 4, 10), 300),
+        ])
+        self.assertIn('GROUP BY', curs.execute.call_args[0][0])
+
+        with self.assertRaises(InvalidConfigError):
+            db.do_rollup(dt(2020, 4, 10), 300, mode='bogus')
+
+    def test_fill_tier(self):
+        db = self._get_db()
+        curs = self._get_curs(db)
+        curs.execute.reset_mock()
+        curs.rowcount = 10
+        # Never filled, so it starts at the oldest data
+        fetch = [[], [(dt(2020, 2, 20, 10, 0, 7),)]]
+        with patch.object(db, '_fetchall', side_effect=fetch):
+            count = db.fill_tier(1800, dt(2020, 3, 10, 10, 59))
+
+        self.assertEqual(count, 20)
+        create = curs.execute.call_args_list[0][0][0]
+        self.assertIn('tsd_tier_1800 PARTITION OF tsd_tiers', create)
+        # The fill and its watermark for each month, up to the end rounded
+        # down to the period
+        calls = curs.execute.call_args_list[1:]
+        self.assertEqual(len(calls), 4)
+        self.assertIn('INSERT INTO tsd_tiers', calls[0][0][0])
+        self.assertIn('INSERT INTO tier_watermarks', calls[1][0][0])
+        self.assertEqual(
+            [(c[0][1]['lo'], c[0][1]['hi']) for c in calls[::2]],
+            [
+                (dt(2020, 2, 20, 10, 0, 7), dt(2020, 3, 1)),
+                (dt(2020, 3, 1), dt(2020, 3, 10, 10, 30)),
+            ],
+        )
+
+        # Nothing new since the last fill
+        curs.execute.reset_mock()
+        with patch.object(
+                db, '_fetchall', return_value=[(dt(2020, 3, 10, 10, 30),)]):
+            self.assertEqual(db.fill_tier(1800, dt(2020, 3, 10, 10, 59)), 0)
+        self.assertEqual(curs.execute.call_count, 1)
+
+    def test_month_windows(self):
+        self.assertEqual(
+            self.db._get_month_windows(
+                dt(2019, 12, 31, 23, 59), dt(2020, 1, 1, 0, 1)),
+            [
+                (dt(2019, 12, 31, 23, 59), dt(2020, 1, 1)),
+                (dt(2020, 1, 1), dt(2020, 1, 1, 0, 1)),
+            ],
+        )
+
+    def test_rollup_entity(self):
+        db = self._get_db()
+        # One key fails outright and one fails to write, the rest go on
+        with patch.object(db, '_get_keys_for_ent', return_value=[1, 2, 3, 4]):
+            with patch.object(
+                    db,
+                    '_rollup_and_del',
+                    side_effect=[True, Exception('bad'), False, True]) as rad:
+                ret = db.rollup_entity(
+                    7, dt(2020, 4, 10), 300, dt(2020, 1, 1))
+
+        self.assertEqual(ret, (4, 2))
+        self.assertEqual(rad.call_count, 4)
+
+    def test_watermarks(self):
+        self.assertEqual(
+            DB.align_time(dt(2020, 4, 10, 10, 7, 30, 5), 300),
+            dt(2020, 4, 10, 10, 5),
+        )
+
+        db = self._get_db()
+        curs = self._get_curs(db)
+        curs.execute.reset_mock()
+        # The times are selected as epoch microseconds
+        curs.copy_expert.side_effect = lambda query, buf: buf.write(copy_data([
+            (1, 1586509200000000, 1),
+            (2, 1586509260000000, 3),
+        ]))
+        # Everything up to 9:00 has been rolled up already
+        with patch.multiple(
+                db, _get_entities=MagicMock(return_value=[7]),
+                _get_keys_for_ent=MagicMock(return_value=[3])):
+            with patch.object(
+                    db,
+                    '_get_watermarks',
+                    return_value={3: dt(2020, 4, 10, 9, 0)}) as gw:
+                db.do_rollup(
+                    dt(2020, 4, 10, 10, 2), 300, dt(2020, 1, 1), tier='1_week')
+        gw.assert_called_once()
+
+        sel, args = curs.mogrify.call_args[0]
+        self.assertIn('added >= %s', sel)
+        self.assertEqual(
+            args, (7, 3, '2020-04-10 09:00:00', '2020-04-10 10:00:00'))
+        # The watermark is moved to the aligned start time in the same
+        # transaction as the rollup
+        self.assertEqual(
+            curs.executemany.call_args[0][1],
+            [(7, 3, dt(2020, 4, 10, 9, 1), 2.0)])
+        query, args = curs.execute.call_args[0]
+        self.assertIn('INSERT INTO rollup_watermarks', query)
+        self.assertEqual(args[0], '1_week')
+        self.assertEqual(args[-1], dt(2020, 4, 10, 10, 0))
+        self.conn.commit.assert_called()
+
+        # A series that's already rolled up past the start is skipped
+        curs.copy_expert.reset_mock()
+        curs.execute.reset_mock()
+        self.assertTrue(db._rollup_and_del(
+            dt(2020, 4, 10), 300, 1, 3, dt(2020, 1, 1), False, '1_week',
+            dt(2020, 4, 10)))
+        curs.execute.assert_not_called()
+        curs.copy_expert.assert_not_called()
+
+
+@unittest.skipUnless(TEST_DSN, 'Set GD2PG_TEST_DSN to run the db tests')
+class TestDBPostgres(unittest.TestCase):
+    SCHEMA = f'gd2pg_test_{os.getpid()}'
+
+    def setUp(self):
+        self.config = GDConfig()
+        self.config.read(CONF_FILE)
+        admin = psycopg2.connect(TEST_DSN)
+        admin.autocommit = True
+        self.addCleanup(admin.close)
+        with admin.cursor() as curs:
+            curs.execute(f'CREATE SCHEMA {self.SCHEMA}')
+        self.addCleanup(
+            admin.cursor().execute, f'DROP SCHEMA {self.SCHEMA} CASCADE')
+
+        # Every connection only sees the test schema
+        patcher = patch.object(DB, '_get_conn', lambda db: psycopg2.connect(
+            TEST_DSN, options=f'-c search_path={self.SCHEMA}'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = DB(self.config)
+        self.addCleanup(self.db.pool.close)
+        self.db.run(self._load)
+
+    def _load(self, conn):
+        with conn.cursor() as curs:
+            curs.execute(open(SCHEMA_FILE).read())
+            curs.execute(
+                "INSERT INTO entities (entity) VALUES ('host1') RETURNING id")
+            eid = curs.fetchone()[0]
+            execute_values(
+                curs,
+                'INSERT INTO keys (key) VALUES %s RETURNING id',
+                [(f'key{k}',) for k in range(3)],
+            )
+            self.series = [(eid, kid) for kid, in curs.fetchall()]
+        conn.commit()
+
+    def _get_rows(self):
+        """
+        The test_compress fixtures, plus a minutely series with random
+        values that crosses a month boundary
+        """
+        series1, series2, series3 = self.series
+        rows = [
+            series1 + (dt(2020, 3, 20, 10, i), i % 5 + 1) for i in range(11)
+        ]
+        rows += [
+            series2 + (dt(2020, 3, 20, 10, i * 5), val)
+            for i, val in enumerate((1, 2, 3, 4, 5, 6, 6, 7, 8))
+        ]
+        rng = np.random.default_rng(0)
+        rows += [
+            series3 + (dt(2020, 3, 31, 22) + timedelta(minutes=i), val)
+            for i, val in enumerate(rng.uniform(0, 100, 240).tolist())
+        ]
+        return rows
+
+    def _rollup(self, roll_period, mode, tier):
+        """
+        Loads the rows and returns them after the rollup
+        """
+        def load(conn):
+            with conn.cursor() as curs:
+                curs.execute('TRUNCATE tsd, rollup_watermarks')
+                execute_values(
+                    curs,
+                    'INSERT INTO tsd (entity_id, key_id, added, value) '
+                    'VALUES %s',
+                    self._get_rows(),
+                )
+            conn.commit()
+
+        self.db.run(load)
+        self.db.do_rollup(
+            dt(2020, 4, 2), roll_period, dt(2020, 3, 1), mode=mode, tier=tier)
+        return self.db.run(lambda conn: self.db._fetchall(
+            conn,
+            'SELECT key_id, added, value FROM tsd ORDER BY key_id, added',
+        ))
+
+    def test_rollup_modes(self):
+        # The data is regular and starts on a bucket boundary, so the python
+        # and sql rollups give the same rows
+        for roll_period, tier in ((300, None), (1800, None), (300, '5_min')):
+            with self.subTest(roll_period=roll_period, tier=tier):
+                python = self._rollup(roll_period, 'python', tier)
+                sql = self._rollup(roll_period, 'sql', tier)
+                self.assertLess(len(sql), len(self._get_rows()))
+                self.assertEqual(
+                    [row[:2] for row in python], [row[:2] for row in sql])
+                np.testing.assert_allclose(
+                    [row[2] for row in python], [row[2] for row in sql])
@@ -1,7 +1,9 @@
+from concurrent.futures.process import BrokenProcessPool
 from libgd2pg.config import GDConfig
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import libgd2pg.datamanager as dmgr
 import os
+import threading
 import unittest
 
 CONF_FILE = os.path.join(
@@ -10,6 +12,60 @@ CONF_FILE = os.path.join(
     'gdata2pg.ini.default',
 )
 
+SAMPLE_DATA = [
+    {
+        'values': [196, 0],
+        'dstypes': ['derive', 'derive'],
+        'dsnames': ['rx', 'tx'],
+        'host': 'host1',
+        'plugin': 'interface',
+        'plugin_instance': 'enp0s3',
+        'type': 'if_dropped',
+        'type_instance': '',
+    },
+    {
+        'values': [226, 3],
+        'dstypes': ['derive', 'derive'],
+        'dsnames': ['rx', 'tx'],
+        'host': 'host1',
+        'plugin': 'interface',
+        'plugin_instance': 'enp0s3',
+        'type': 'if_dropped',
+        'type_instance': '',
+    },
+    {
+        'values': [45761314816],
+        'dstypes': ['gauge'],
+        'dsnames': ['value'],
+        'host': 'host1',
+        'plugin': 'df',
+        'plugin_instance': 'root',
+        'type': 'df_complex',
+        'type_instance': 'used',
+    },
+    {
+        'values': [45761318912],
+        'dstypes': ['gauge'],
+        'dsnames': ['value'],
+        'host': 'host1',
+        'plugin': 'df',
+        'plugin_instance': 'root',
+        'type': 'df_complex',
+        'type_instance': 'used',
+    },
+    {
+        'values': [12],
+        'dstypes': ['gauge'],
+        'dsnames': ['value'],
+        'host': 'host2',
+        'plugin': 'load',
+        'plugin_instance': '',
+        'type': 'load',
+        'type_instance': '',
+    },
+]
+
+
 class TestDM(unittest.TestCase):
     def setUp(self):
         self.config = GDConfig()
@@ -143,6 +199,32 @@ class TestDM(unittest.TestCase):
         )
         self._reset_dm()
 
+    def test_name_cache(self):
+        self.config['main']['name_cache_size'] = '2'
+        self.config['main']['stats_entity'] = 'gdata2pg'
+        self._reset_dm()
+        dmgr.STATS.get_reset()
+        dmg = dmgr.dm()
+
+        first = dmg._get_metrics(SAMPLE_DATA[0])
+        second = dmg._get_metrics(SAMPLE_DATA[1])
+        self.assertEqual([d.name for d in first], [d.name for d in second])
+        self.assertIs(first[0].name, second[0].name)
+        self.assertEqual(dmg.name_cache.hits, 1)
+        self.assertEqual(dmg.name_cache.misses, 1)
+
+        # Only the 2 most recently used names are kept
+        dmg._get_metrics(SAMPLE_DATA[2])
+        dmg._get_metrics(SAMPLE_DATA[4])
+        self.assertEqual(len(dmg.name_cache), 2)
+        self.assertEqual(dmg.name_cache.evictions, 1)
+
+        ret = dmg.get_metrics_reset()
+        self.assertEqual(ret['gdata2pg']['name_cache.hits'], 1)
+        self.assertEqual(ret['gdata2pg']['name_cache.misses'], 3)
+        self.config['main']['stats_entity'] = ''
+        self._reset_dm()
+
     def test_priv_comp_sum(self):
         dmg = dmgr.dm()
 
@@ -210,6 +292,245 @@ class TestDM(unittest.TestCase):
 
         self._reset_dm()
 
+    def test_incremental_push(self):
+        dmg = dmgr.dm()
+        dmg.push(SAMPLE_DATA)
+        expected = dmg.get_metrics()
+
+        self.config['main']['agg_mode'] = 'incremental'
+        self._reset_dm()
+        dmg = dmgr.dm()
+        dmg.push(SAMPLE_DATA)
+
+        # Names are computed at push time
+        self.assertEqual(
+            sorted(dmg.ent_map['host1'].keys()),
+            [
+                'df.root.df_complex.used',
+                'interface.enp0s3.if_dropped.rx',
+                'interface.enp0s3.if_dropped.tx',
+            ],
+        )
+        self.assertEqual(dmg.get_metrics(), expected)
+        self._reset_dm()
+
+    def test_invalid_value(self):
+        bad = dict(SAMPLE_DATA[4], values=['abc'])
+        for engine in ('exact', 'sketch'):
+            self.config['main']['agg_mode'] = 'incremental'
+            self.config['main']['pct_engine'] = engine
+            self._reset_dm()
+            dmg = dmgr.dm()
+            with self.assertRaises(dmgr.InvalidDataError):
+                dmg._get_metrics(bad)
+
+            # The bad sample is skipped and the rest are kept
+            dmg.push([bad] + SAMPLE_DATA[:4])
+            self.assertEqual(list(dmg.ent_map.keys()), ['host1'])
+
+            # A failure while the shard is locked doesn't leave it locked
+            with patch.object(dmg, '_add_dtup', side_effect=TypeError()):
+                with self.assertRaises(TypeError):
+                    dmg.push(SAMPLE_DATA[4])
+            t = threading.Thread(target=dmg.get_metrics_reset)
+            t.start()
+            t.join(5)
+            self.assertFalse(t.is_alive())
+
+        self.config['main']['agg_mode'] = 'batch'
+        self.config['main']['pct_engine'] = 'exact'
+        self._reset_dm()
+
+    def test_sketch_engine(self):
+        self.config['main']['pct_engine'] = 'sketch'
+        self._reset_dm()
+        dmg = dmgr.dm()
+        agg_dtups = {}
+        for name in ('a', 'b'):
+            for dtup in self._test_dtups['d1' if name == 'a' else 'd2']:
+                dmg._add_dtup(agg_dtups, dtup)
+        self.assertIsInstance(agg_dtups['b'], dmgr.SketchAcc)
+
+        ret = dmg._get_comp_metrics(agg_dtups)
+        expected = {
+            'a.sumb': 3.1,
+            'b.avg': 4.25,
+            'b.p50': 3.5,
+            'b.p90': 7.5,
+            'b.p95': 8.25,
+            'b.p99': 8.85,
+        }
+        self.assertListEqual(list(ret.keys()), list(expected.keys()))
+        for k, v in ret.items():
+            self.assertAlmostEqual(v, expected[k], delta=abs(v) * 0.01)
+
+        self._reset_dm()
+
+    def test_get_metrics_reset(self):
+        # The stats are only inserted when asked for
+        dmg = dmgr.dm()
+        dmg.push(SAMPLE_DATA[:4])
+        self.assertEqual(list(dmg.get_metrics_reset().keys()), ['host1'])
+
+        self.config['main']['stats_entity'] = 'gdata2pg'
+        self._reset_dm()
+        dmg = dmgr.dm()
+        dmg.push(SAMPLE_DATA[:4])
+        real_comp = dmg._get_comp_metrics
+
+        # Pushing from another thread while the metrics are computed must
+        # not block on the lock
+        def comp_and_push(agg_dtups):
+            t = threading.Thread(target=dmg.push, args=(SAMPLE_DATA[4],))
+            t.start()
+            t.join(5)
+            self.assertFalse(t.is_alive())
+            return real_comp(agg_dtups)
+
+        with patch.object(dmg, '_get_comp_metrics', comp_and_push):
+            ret = dmg.get_metrics_reset()
+
+        self.assertEqual(list(ret.keys()), ['host1', 'gdata2pg'])
+        self.assertIn('push.lock_wait_ms', ret['gdata2pg'])
+        # The data pushed during the aggregation is in the new map
+        self.assertEqual(list(dmg.ent_map.keys()), ['host2'])
+        self.config['main']['stats_entity'] = ''
+        self._reset_dm()
+
+    def test_sharded_push(self):
+        self.config['main']['shards'] = '4'
+        self._reset_dm()
+        dmg = dmgr.dm()
+
+        def push(host_num):
+            for i in range(50):
+                dmg.push({'host': f'host{host_num}', 'plugin': f'p{i}'})
+
+        threads = [
+            threading.Thread(target=push, args=(i,)) for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(dmg._shards), 4)
+        # Every host lives in exactly one shard
+        self.assertEqual(sum(len(shard) for shard in dmg._shards), 16)
+        ent_map = dmg.ent_map
+        self.assertEqual(len(ent_map), 16)
+        for data in ent_map.values():
+            self.assertEqual([d['plugin'] for d in data],
+                [f'p{i}' for i in range(50)])
+
+        dmg.get_metrics_reset()
+        self.assertEqual(dmg.ent_map, {})
+        self._reset_dm()
+
+    def test_parallel_get_metrics(self):
+        data = [
+            dict(d, host=f'{d["host"]}-{i}')
+            for i in range(20)
+            for d in SAMPLE_DATA
+        ]
+        dmg = dmgr.dm()
+        dmg.push(data)
+        expected = dmg.get_metrics()
+
+        for pool in ('thread', 'process'):
+            self.config['main']['agg_workers'] = '2'
+            self.config['main']['agg_pool'] = pool
+            self._reset_dm()
+            dmg = dmgr.dm()
+            dmg.push(data)
+            try:
+                ret = dmg.get_metrics()
+                self.assertIsNotNone(dmg._pool)
+            finally:
+                dmg.close()
+
+            self.assertEqual(list(ret.keys()), list(expected.keys()))
+            self.assertEqual(ret, expected)
+
+        self._reset_dm()
+
+    def test_broken_pool(self):
+        data = [
+            dict(d, host=f'{d["host"]}-{i}')
+            for i in range(5)
+            for d in SAMPLE_DATA
+        ]
+        dmg = dmgr.dm()
+        dmg.push(data)
+        expected = dmg.get_metrics()
+
+        self.config['main']['agg_workers'] = '2'
+        self._reset_dm()
+        dmg = dmgr.dm()
+        dmg.push(data)
+        # A worker was killed
+        pool = dmg._pool = MagicMock()
+        pool.map.side_effect = BrokenProcessPool('killed')
+
+        # The minute is computed serially and the pool is replaced next time
+        self.assertEqual(dmg.get_metrics(), expected)
+        pool.shutdown.assert_called_once()
+        self.assertIsNone(dmg._pool)
+
+        self.config['main']['agg_workers'] = '0'
+        self._reset_dm()
+
+    def test_backpressure(self):
+        # SAMPLE_DATA[:2] is 4 samples and SAMPLE_DATA[2:4] is 2 more
+        self.config['main']['max_buffered_samples'] = '5'
+        self._reset_dm()
+        dmgr.STATS.get_reset()
+        dmg = dmgr.dm()
+        dmg.push(SAMPLE_DATA[:2])
+        dmg.check_capacity()
+        with self.assertRaises(dmgr.BackpressureError):
+            dmg.push(SAMPLE_DATA[2:4])
+        self.assertEqual(dmg.buffered, 4)
+        self.assertEqual(dmgr.STATS.get('push.rejected'), 2)
+        dmg.push(SAMPLE_DATA[2])
+        with self.assertRaises(dmgr.BackpressureError):
+            dmg.check_capacity()
+
+        # The flush empties the buffer
+        dmg.get_metrics_reset()
+        self.assertEqual(dmg.buffered, 0)
+        dmg.push(SAMPLE_DATA[2:4])
+
+        self.config['main']['overload_policy'] = 'drop'
+        self._reset_dm()
+        dmg = dmgr.dm()
+        dmg.push(SAMPLE_DATA[:2])
+        dmg.push(SAMPLE_DATA[2:4])
+        dmg.check_capacity()
+        self.assertEqual(dmg.buffered, 4)
+        self.assertEqual(len(dmg.ent_map['host1']), 2)
+        self.assertEqual(dmgr.STATS.get('push.dropped'), 2)
+
+        self.config['main']['overload_policy'] = 'block'
+        with self.assertRaises(dmgr.InvalidConfigError):
+            self._reset_dm()
+        self.config['main']['max_buffered_samples'] = '0'
+        self.config['main']['overload_policy'] = 'reject'
+        self._reset_dm()
+
+    def test_metric_buf(self):
+        # Large counters must not lose precision
+        buf = dmgr.MetricBuf('counter', [2 ** 63 + 1, 2 ** 63 + 5])
+        self.assertEqual(buf.values.typecode, 'Q')
+        self.assertEqual(buf.max() - buf.min(), 4)
+        self.assertEqual(buf.sum(), 2 ** 64 + 6)
+
+        # A float in an integer buffer converts it to doubles
+        buf = dmgr.MetricBuf('derive', [1, 2])
+        buf.add(3.5)
+        self.assertEqual(buf.values.typecode, 'd')
+        self.assertEqual(list(buf.values), [1, 2, 3.5])
+        self.assertAlmostEqual(buf.percentile(50), 2)
+
     def test_priv_get_agg_dtups(self):
         # TODO
         pass
@@ -0,0 +1,128 @@
+from base64 import b64encode
+from libgd2pg.config import GDConfig
+from libgd2pg.datamanager import DataManager
+from libgd2pg.error import BackpressureError
+from tests.test_ingest import SAMPLE
+from unittest.mock import MagicMock, patch
+import gzip
+import json
+import libgd2pg.flask as gdflask
+import os
+import unittest
+
+CONF_FILE = os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'gdata2pg.ini.default',
+)
+
+
+class TestFlask(unittest.TestCase):
+    def setUp(self):
+        self.config = GDConfig()
+        self.config.read(CONF_FILE)
+        self.pushed = []
+        self.dm = MagicMock()
+        self.dm.push_batches.side_effect = lambda batches: self.pushed.extend(
+            d for batch in batches for d in batch)
+        gdflask.flask_init(self.config, self.dm)
+        self.client = gdflask.APP.test_client()
+        self.auth = {
+            'Authorization': 'Basic {}'.format(
+                b64encode(b'admin:admin').decode('ascii')),
+        }
+
+    def _post(self, body, **headers):
+        headers.update(self.auth)
+        return self.client.post('/', data=body, headers=headers)
+
+    def _pushed(self):
+        return self.pushed
+
+    def test_auth(self):
+        self.assertEqual(self.client.get('/').status_code, 401)
+        resp = self.client.get('/', headers=self.auth)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_post(self):
+        resp = self._post(json.dumps(SAMPLE))
+
+        self.assertEqual(resp.status_code, 200)
+        pushed = self._pushed()
+        self.assertEqual(len(pushed), 2)
+        # Only the fields we use are pushed
+        self.assertNotIn('time', pushed[0])
+        self.assertEqual(pushed[1]['values'], SAMPLE[1]['values'])
+
+    def test_post_gzip(self):
+        resp = self._post(
+            gzip.compress(json.dumps(SAMPLE).encode('utf-8')),
+            **{'Content-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self._pushed()), 2)
+
+    def test_post_msgpack(self):
+        msgpack = self._msgpack()
+        resp = self._post(
+            msgpack.packb(SAMPLE), **{'Content-Type': 'application/msgpack'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self._pushed()[1]['host'], SAMPLE[1]['host'])
+
+        # msgpack isn't JSON
+        resp = self._post(msgpack.packb(SAMPLE))
+        self.assertEqual(resp.status_code, 400)
+
+    def _msgpack(self):
+        try:
+            import msgpack
+        except ImportError:
+            self.skipTest('msgpack is not installed')
+        return msgpack
+
+    def test_post_limits(self):
+        self.config['server']['max_body_size'] = '100'
+        resp = self._post(json.dumps(SAMPLE))
+        self.assertEqual(resp.status_code, 413)
+
+        resp = self._post(json.dumps(SAMPLE), **{'Content-Encoding': 'br'})
+        self.assertEqual(resp.status_code, 415)
+
+    def test_post_backpressure(self):
+        self.dm.check_capacity.side_effect = BackpressureError('full')
+        resp = self._post(json.dumps(SAMPLE))
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertTrue(1 <= int(resp.headers['Retry-After']) <= 60)
+        self.dm.push_batches.assert_not_called()
+
+    def test_post_backpressure_mid_body(self):
+        # SAMPLE is 2 samples then 1, so with a batch per dict, the third
+        # batch of SAMPLE * 2 crosses the limit after two were read
+        self.config['main']['max_buffered_samples'] = '4'
+        dmg = DataManager(self.config)
+        gdflask.flask_init(self.config, dmg)
+        self.assertEqual(self._post(json.dumps(SAMPLE[1:])).status_code, 200)
+        self.assertEqual(dmg.buffered, 1)
+
+        with patch.object(gdflask, 'PUSH_BATCH', 1):
+            resp = self._post(json.dumps(SAMPLE * 2))
+        self.assertEqual(resp.status_code, 429)
+        # None of the rejected request was kept, so the retry is safe
+        self.assertEqual(dmg.buffered, 1)
+        self.assertEqual(len(dmg.ent_map[SAMPLE[1]['host']]), 1)
+
+        dmg.get_metrics_reset()
+        with patch.object(gdflask, 'PUSH_BATCH', 1):
+            resp = self._post(json.dumps(SAMPLE))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(dmg.buffered, 3)
+
+    def test_post_invalid(self):
+        resp = self._post('[{"host": ')
+        self.assertEqual(resp.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+from io import BytesIO
+from libgd2pg.error import (
+    InvalidDataError,
+    PayloadTooLargeError,
+    UnsupportedEncodingError,
+)
+from libgd2pg.ingest import iter_json, iter_msgpack, open_body, slim
+import gzip
+import json
+import unittest
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SAMPLE = [
+    {
+        'values': [196, 0],
+        'dstypes': ['derive', 'derive'],
+        'dsnames': ['rx', 'tx'],
+        'time': 1583003789.529,
+        'interval': 10.0,
+        'host': 'jay-vm',
+        'plugin': 'interface',
+        'plugin_instance': 'enp0s3',
+        'type': 'if_dropped',
+        'type_instance': '',
+    },
+    {
+        'values': [45761314816],
+        'dstypes': ['gauge'],
+        'dsnames': ['value'],
+        'time': 1583003789.529,
+        'interval': 10.0,
+        'host': 'jay-vm é中',
+        'plugin': 'df',
+        'plugin_instance': 'root',
+        'type': 'df_complex',
+        'type_instance': 'used',
+    },
+]
+
+
+class TestIngest(unittest.TestCase):
+    def _parse(self, raw, chunk_size=65536):
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        return list(iter_json(BytesIO(raw), chunk_size))
+
+    def test_iter_json(self):
+        raw = json.dumps(SAMPLE, indent=4)
+        # Every chunk size should split the objects, numbers and multi-byte
+        # chars at different points
+        for chunk_size in (1, 2, 3, 7, 64, 65536):
+            self.assertEqual(self._parse(raw, chunk_size), SAMPLE)
+
+    def test_single_object(self):
+        self.assertEqual(
+            self._parse(json.dumps(SAMPLE[0]), 5), [SAMPLE[0]])
+
+    def test_empty(self):
+        self.assertEqual(self._parse(''), [])
+        self.assertEqual(self._parse(' [ ] '), [])
+
+    def test_invalid(self):
+        for raw in (
+                '[{"host": "a"}',
+                '[{"host": "a"} {"host": "b"}]',
+                '[{"host": "a"}] x',
+                '[1, 2]',
+                '"foo"',
+                '[{"host": "a"'):
+            with self.assertRaises(InvalidDataError, msg=raw):
+                self._parse(raw, 4)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_iter_msgpack(self):
+        def parse(obj, chunk_size=65536):
+            raw = obj if isinstance(obj, bytes) else msgpack.packb(obj)
+            return list(iter_msgpack(BytesIO(raw), chunk_size))
+
+        for chunk_size in (1, 3, 64, 65536):
+            self.assertEqual(parse(SAMPLE, chunk_size), SAMPLE)
+        self.assertEqual(parse(SAMPLE[0], 5), [SAMPLE[0]])
+        self.assertEqual(parse(b''), [])
+        self.assertEqual(parse([]), [])
+
+        for raw in (
+                msgpack.packb(SAMPLE)[:-5],
+                msgpack.packb(SAMPLE) + msgpack.packb(1),
+                msgpack.packb([1, 2]),
+                msgpack.packb('foo'),
+                b'\xc1'):
+            with self.assertRaises(InvalidDataError, msg=raw):
+                parse(raw, 4)
+
+    def test_open_body(self):
+        raw = json.dumps(SAMPLE).encode('utf-8')
+        comp = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        encoded = {
+            None: raw,
+            'identity': raw,
+            'gzip': gzip.compress(raw),
+            'deflate': zlib.compress(raw),
+        }
+        # Raw deflate, without the zlib header, is accepted too
+        encoded[' Deflate '] = comp.compress(raw) + comp.flush()
+        if zstandard is not None:
+            encoded['zstd'] = zstandard.ZstdCompressor().compress(raw)
+
+        for encoding, data in encoded.items():
+            body, counter = open_body(BytesIO(data), encoding)
+            self.assertEqual(list(iter_json(body, 7)), SAMPLE, msg=encoding)
+            self.assertEqual(counter.count, len(data))
+            self.assertEqual(body.count, len(raw))
+
+    def test_open_body_limits(self):
+        # A small, highly compressed body can't expand past the limit
+        data = gzip.compress(b'[' + b' ' * 10000000 + b']')
+        body, _ = open_body(BytesIO(data), 'gzip', 100000)
+        with self.assertRaises(PayloadTooLargeError):
+            while body.read(65536):
+                pass
+        self.assertLess(body.count, 200000)
+
+        with self.assertRaises(UnsupportedEncodingError):
+            open_body(BytesIO(data), 'br')
+
+        body, _ = open_body(BytesIO(b'not gzip'), 'gzip')
+        with self.assertRaises(InvalidDataError):
+            body.read()
+
+    def test_slim(self):
+        self.assertEqual(
+            sorted(slim(SAMPLE[0]).keys()),
+            sorted([
+                'host', 'plugin', 'plugin_instance', 'type',
+                'type_instance', 'dsnames', 'dstypes', 'values',
+            ]),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
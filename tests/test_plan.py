@@ -0,0 +1,105 @@
+from libgd2pg.config import GDConfig
+from libgd2pg.error import InvalidConfigError
+from libgd2pg.plan import RollupPlan
+import os
+import unittest
+
+CONF_FILE = os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'gdata2pg.ini.default',
+)
+
+
+class TestRollupPlan(unittest.TestCase):
+    def setUp(self):
+        self.config = GDConfig()
+        self.config.read(CONF_FILE)
+        self.config['rollup_overrides'] = {
+            'df': 'df.*.df_complex.* -> avg',
+            'cpu_idle': '~^cpu\\.\\d+\\.(idle|wait)$ -> avg, pct(95)',
+            'dropped': '*.dropped ->',
+            'cpu': 'cpu.* -> sum',
+        }
+
+    def _get_plan(self):
+        return RollupPlan(self.config, lambda rollup: rollup)
+
+    def _suffixes(self, rollups):
+        return [r.suffix for r in rollups]
+
+    def test_type_rollups(self):
+        plan = self._get_plan()
+
+        self.assertEqual(
+            plan.get('load.shortterm', 'gauge'),
+            plan.type_rollups['gauge'],
+        )
+        self.assertEqual(
+            self._suffixes(plan.type_rollups['counter']),
+            ['sumb', 'avg', 'p50', 'p90', 'p95', 'p99'],
+        )
+        self.assertEqual(
+            [(r.func, r.pct) for r in plan.type_rollups['counter'][2:]],
+            [('pct', 50), ('pct', 90), ('pct', 95), ('pct', 99)],
+        )
+        self.assertIsNone(plan.get('load.shortterm', 'bogus'))
+
+    def test_overrides(self):
+        plan = self._get_plan()
+        for name, expected in (
+                ('df.root.df_complex.used', ['avg']),
+                ('DF.root.df_complex.used', ['avg']),
+                ('cpu.4.wait', ['avg', 'p95']),
+                # The regex rule is listed before the glob, so it wins
+                ('cpu.4.user', ['sum']),
+                ('interface.dropped', []),
+                ('memory.used', ['avg', 'p50', 'p90', 'p95', 'p99'])):
+            self.assertEqual(
+                self._suffixes(plan.get(name, 'gauge')), expected, name)
+
+        # Only the rules that can match the first segment are indexed
+        self.assertEqual(plan._index, {'df': [0], 'cpu': [1, 3]})
+        self.assertEqual(plan._generic, [2])
+
+        # The matches are cached
+        plan.get('cpu.4.wait', 'gauge')
+        self.assertEqual(plan._cache.hits, 1)
+
+    def test_alternation_not_indexed(self):
+        self.config['rollup_overrides'] = {'alt': '~^cpu\\.0|^df\\. -> avg'}
+        plan = self._get_plan()
+
+        self.assertEqual(plan._generic, [0])
+        self.assertEqual(
+            self._suffixes(plan.get('df.root.used', 'gauge')), ['avg'])
+
+    def test_pattern_case(self):
+        # Patterns keep their case, so \\D isn't turned into \\d, and may
+        # hold characters that aren't allowed in a key
+        self.config['rollup_overrides'] = {
+            'named': '~^cpu\\.\\D+$ -> avg',
+            'colon': '[ab]:*=x -> sum',
+        }
+        plan = self._get_plan()
+        self.assertEqual(
+            self._suffixes(plan.get('cpu.total', 'gauge')), ['avg'])
+        self.assertEqual(
+            self._suffixes(plan.get('CPU.total', 'gauge')), ['avg'])
+        self.assertNotEqual(
+            self._suffixes(plan.get('cpu.0', 'gauge')), ['avg'])
+        self.assertEqual(
+            self._suffixes(plan.get('a:1=x', 'gauge')), ['sum'])
+
+        self.config['rollup_overrides'] = {'df.*': 'avg'}
+        with self.assertRaises(InvalidConfigError):
+            self._get_plan()
+
+    def test_invalid_rollup(self):
+        self.config['main']['rollups_gauge'] = 'avg, bogus'
+        with self.assertRaises(InvalidConfigError):
+            RollupPlan(self.config, lambda rollup: getattr(self, rollup))
+
+
+if __name__ == '__main__':
+    unittest.main()
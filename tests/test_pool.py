@@ -0,0 +1,108 @@
+from libgd2pg.error import PoolTimeoutError
+from libgd2pg.pool import ConnPool, is_conn_lost
+from libgd2pg.stats import STATS
+from unittest.mock import MagicMock
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import threading
+import unittest
+
+
+class TestConnPool(unittest.TestCase):
+    def setUp(self):
+        STATS.get_reset()
+        self.conns = []
+
+    def _factory(self):
+        conn = MagicMock(closed=0)
+        conn.get_transaction_status.return_value = \
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.conns.append(conn)
+        return conn
+
+    def test_get_put(self):
+        pool = ConnPool(self._factory, 2)
+        # The first connection is made right away
+        self.assertEqual(len(self.conns), 1)
+
+        c1 = pool.get()
+        c2 = pool.get()
+        self.assertIsNot(c1, c2)
+        self.assertEqual(pool.in_use, 2)
+        pool.put(c1)
+        self.assertIs(pool.get(), c1)
+
+        # Uncommitted work is rolled back when returned
+        c1.get_transaction_status.return_value = \
+            psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        pool.put(c1)
+        c1.rollback.assert_called_once()
+        pool.put(c2)
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(pool.in_use, 0)
+
+    def test_saturation(self):
+        pool = ConnPool(self._factory, 1, timeout=0.05)
+        conn = pool.get()
+        with self.assertRaises(PoolTimeoutError):
+            pool.get()
+        self.assertEqual(STATS.get('pool.saturated'), 1)
+
+        # A waiting get() is handed the connection when it's returned
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.get()))
+        pool.timeout = 5
+        t.start()
+        pool.put(conn)
+        t.join(5)
+        self.assertEqual(got, [conn])
+        self.assertGreater(STATS.get('pool.wait_ms.max'), 0)
+
+    def test_connection_errors(self):
+        pool = ConnPool(self._factory, 2)
+        with self.assertRaises(psycopg2.OperationalError):
+            with pool.connection() as conn:
+                conn.closed = 2
+                raise psycopg2.OperationalError('terminated')
+
+        # The broken connection was discarded and replaced
+        conn.close.assert_called_once()
+        self.assertEqual(pool.size, 0)
+        with pool.connection() as new_conn:
+            self.assertIsNot(new_conn, conn)
+
+        # Other errors just roll back, including OperationalErrors that
+        # don't mean the connection is gone
+        with self.assertRaises(ValueError):
+            with pool.connection() as conn:
+                raise ValueError()
+        with self.assertRaises(psycopg2.OperationalError):
+            with pool.connection() as conn:
+                raise psycopg2.errors.QueryCanceled('statement timeout')
+        conn.close.assert_not_called()
+        self.assertEqual(pool.size, 1)
+
+    def test_is_conn_lost(self):
+        conn = self._factory()
+        self.assertTrue(is_conn_lost(psycopg2.OperationalError(), None))
+        self.assertFalse(is_conn_lost(psycopg2.OperationalError(), conn))
+        self.assertFalse(is_conn_lost(ValueError(), None))
+        conn.closed = 2
+        self.assertTrue(is_conn_lost(psycopg2.InterfaceError(), conn))
+
+    def test_health_check(self):
+        pool = ConnPool(self._factory, 2, check_interval=0)
+        conn = self.conns[0]
+        curs = conn.cursor.return_value.__enter__.return_value
+        curs.execute.side_effect = psycopg2.OperationalError('gone')
+
+        new_conn = pool.get()
+        self.assertIsNot(new_conn, conn)
+        conn.close.assert_called_once()
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(STATS.get('pool.discarded'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
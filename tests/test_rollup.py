@@ -0,0 +1,57 @@
+from datetime import datetime as dt
+from unittest.mock import MagicMock, patch
+import libgd2pg.rollup as rollup
+import os
+import unittest
+
+
+class TestRollup(unittest.TestCase):
+    def test_worker_rollup(self):
+        db = MagicMock()
+        db.rollup_entity.return_value = (10, 1)
+        args = (7, dt(2020, 4, 10), 300, dt(2020, 1, 1), False, '1_week')
+
+        with patch.object(rollup, 'WORKER_DB', db):
+            res = rollup._worker_rollup(args)
+            self.assertEqual(res, rollup.EntityResult(
+                os.getpid(), 7, 10, 1, None))
+            db.rollup_entity.assert_called_once_with(*args)
+
+            # A failure for the whole entity is reported, not raised
+            db.rollup_entity.side_effect = Exception('connection refused')
+            res = rollup._worker_rollup(args)
+            self.assertEqual(res.error, 'connection refused')
+            self.assertEqual((res.eid, res.keys), (7, 0))
+
+    def test_parallel_rollup(self):
+        db = MagicMock()
+        db._get_entities.return_value = [7, 8, 9]
+        pid = os.getpid()
+        results = [
+            rollup.EntityResult(pid, 7, 10, 1, None),
+            rollup.EntityResult(pid, 8, 0, 0, 'connection refused'),
+            rollup.EntityResult(pid, 9, 5, 0, None),
+        ]
+        ctx = MagicMock()
+        pool = ctx.Pool.return_value.__enter__.return_value
+        pool.imap_unordered.return_value = iter(results)
+
+        with patch.object(rollup, 'get_context', return_value=ctx):
+            workers = rollup.parallel_rollup(
+                db, dt(2020, 4, 10), 300, dt(2020, 1, 1), jobs=2)
+
+        # The entity that failed as a whole is counted too
+        self.assertEqual(workers, {
+            pid: {
+                'entities': 3,
+                'keys': 15,
+                'failed': 1,
+                'failed_entities': 1,
+            },
+        })
+        self.assertEqual(
+            [a[0] for a in pool.imap_unordered.call_args[0][1]], [7, 8, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+from libgd2pg.sketch import DDSketch
+from numpy import percentile
+import random
+import tracemalloc
+import unittest
+
+
+class TestDDSketch(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(42)
+        self.vals = [rand.lognormvariate(5, 2) for _ in range(10000)]
+        self.vals += [-v for v in self.vals[:1000]] + [0] * 100
+
+    def _check_quantiles(self, sketch, vals):
+        vals = sorted(vals)
+        for q in (0, 0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 1):
+            rank = q * (len(vals) - 1)
+            lo = vals[int(rank)]
+            hi = vals[min(int(rank) + 1, len(vals) - 1)]
+            exact = percentile(vals, q * 100)
+            approx = sketch.quantile(q)
+            self.assertLessEqual(
+                abs(approx - exact),
+                sketch.rel_acc * max(abs(lo), abs(hi)) + 1e-9,
+                f'q: {q}',
+            )
+
+    def test_quantile(self):
+        # The values need ~1400 buckets
+        sketch = DDSketch(0.01, max_bins=2048)
+        for v in self.vals:
+            sketch.add(v)
+
+        self._check_quantiles(sketch, self.vals)
+        self.assertEqual(sketch.count, len(self.vals))
+        self.assertAlmostEqual(sketch.sum, sum(self.vals))
+        self.assertEqual(sketch.min, min(self.vals))
+        self.assertEqual(sketch.max, max(self.vals))
+
+    def test_merge(self):
+        s1 = DDSketch(0.01, max_bins=2048)
+        s2 = DDSketch(0.01, max_bins=2048)
+        for i, v in enumerate(self.vals):
+            (s1 if i % 2 else s2).add(v)
+        s1.merge(s2)
+
+        self._check_quantiles(s1, self.vals)
+        self.assertEqual(s1.count, len(self.vals))
+
+        with self.assertRaises(ValueError):
+            s1.merge(DDSketch(0.02))
+
+    def test_max_bins(self):
+        sketch = DDSketch(0.01, max_bins=100)
+        for v in range(1, 100000):
+            sketch.add(v)
+
+        self.assertLessEqual(len(sketch.pos), 100)
+        # Only the lowest quantiles lose accuracy
+        self.assertAlmostEqual(sketch.quantile(0.99), 98999, delta=990)
+
+    def test_max_bins_neg(self):
+        # A single negative bucket can't absorb the excess, so the positive
+        # ones are folded
+        sketch = DDSketch(0.01, max_bins=100)
+        sketch.add(-5)
+        for v in range(1, 100000):
+            sketch.add(v)
+
+        self.assertEqual(len(sketch.neg), 1)
+        self.assertLessEqual(len(sketch.pos) + len(sketch.neg), 100)
+        self.assertEqual(sketch.quantile(0), -5)
+        self.assertAlmostEqual(sketch.quantile(0.99), 98998, delta=990)
+
+    def test_memory(self):
+        # However many samples and however wide their range, a sketch stays
+        # within max_bins buckets of a few bytes each
+        rand = random.Random(42)
+        tracemalloc.start()
+        sketch = DDSketch(0.01)
+        for _ in range(20000):
+            sketch.add(rand.lognormvariate(5, 4))
+            sketch.add(-rand.lognormvariate(5, 4))
+        mem, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertEqual(len(sketch.pos) + len(sketch.neg), 1024)
+        self.assertLess(mem, 4 * 1024)
+
+    def test_widen(self):
+        # The counts start at a byte each
+        sketch = DDSketch(0.01)
+        for _ in range(300):
+            sketch.add(5)
+        sketch.add(500)
+        self.assertEqual(sketch.pos.counts.typecode, 'H')
+        self.assertAlmostEqual(sketch.quantile(0.5), 5, delta=0.05)
+        self.assertAlmostEqual(sketch.quantile(1), 500, delta=5)
+
+        other = DDSketch(0.01)
+        other.merge(sketch)
+        other.merge(sketch)
+        self.assertEqual(other.count, 602)
+        self.assertAlmostEqual(other.quantile(0.99), 5, delta=0.05)
+
+    def test_interpolation(self):
+        sketch = DDSketch(0.01)
+        for v in (1, 3, 4, 9):
+            sketch.add(v)
+
+        for q, val in ((0.5, 3.5), (0.9, 7.5), (0.95, 8.25), (0.99, 8.85)):
+            self.assertAlmostEqual(sketch.quantile(q), val, delta=val * 0.01)
+
+    def test_empty(self):
+        self.assertIsNone(DDSketch().quantile(0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
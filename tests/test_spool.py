@@ -0,0 +1,162 @@
+from datetime import datetime
+from libgd2pg.error import InvalidConfigError
+from libgd2pg.spool import Spool
+import os
+import tempfile
+import unittest
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'spool')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _batch(self, i):
+        return datetime(2020, 3, 1, 0, i), {'host': {f'm{i}': i + 0.5}}
+
+    def test_replay(self):
+        spool = Spool(self.path)
+        self.assertIsNone(spool.peek())
+        for i in range(3):
+            self.assertTrue(spool.append(*self._batch(i)))
+
+        rec, offset = spool.peek()
+        self.assertEqual(rec, self._batch(0))
+        spool.commit(offset)
+        spool.close()
+
+        # The replay position survives a restart
+        spool = Spool(self.path)
+        for i in (1, 2):
+            rec, offset = spool.peek()
+            self.assertEqual(rec, self._batch(i))
+            spool.commit(offset)
+
+        self.assertIsNone(spool.peek())
+        # Once everything is replayed, the file is truncated
+        self.assertEqual(spool.size, Spool.FILE_HEADER.size)
+        self.assertEqual(spool.offset, Spool.FILE_HEADER.size)
+        spool.close()
+
+    def test_corrupt_tail(self):
+        spool = Spool(self.path)
+        spool.append(*self._batch(0))
+        spool.append(*self._batch(1))
+        spool.close()
+        # A crash mid-write leaves a partial record at the end
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(size - 3)
+
+        spool = Spool(self.path)
+        rec, offset = spool.peek()
+        self.assertEqual(rec, self._batch(0))
+        spool.commit(offset)
+        self.assertIsNone(spool.peek())
+        self.assertEqual(spool.pending, 0)
+        spool.close()
+
+    def test_append_after_corrupt_tail(self):
+        spool = Spool(self.path)
+        spool.append(*self._batch(0))
+        spool.append(*self._batch(1))
+        spool.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(size - 3)
+
+        # The torn record is dropped when the spool is opened, so the
+        # records appended after the restart aren't lost behind it
+        spool = Spool(self.path)
+        for i in range(2, 5):
+            self.assertTrue(spool.append(*self._batch(i)))
+        spool.close()
+
+        spool = Spool(self.path)
+        for i in (0, 2, 3, 4):
+            rec, offset = spool.peek()
+            self.assertEqual(rec, self._batch(i))
+            spool.commit(offset)
+        self.assertIsNone(spool.peek())
+        self.assertEqual(spool.pending, 0)
+        spool.close()
+
+    def test_max_bytes(self):
+        spool = Spool(self.path)
+        spool.append(*self._batch(0))
+        rec_size = spool.size
+        spool.close()
+
+        spool = Spool(self.path, rec_size * 2)
+        self.assertTrue(spool.append(*self._batch(1)))
+        self.assertFalse(spool.append(*self._batch(2)))
+
+        # Replaying a record makes room for another
+        _, offset = spool.peek()
+        spool.commit(offset)
+        self.assertTrue(spool.append(*self._batch(2)))
+        self.assertEqual(spool.offset, Spool.FILE_HEADER.size)
+        self.assertEqual(spool.peek()[0], self._batch(1))
+        spool.close()
+
+    def test_compact_restart(self):
+        spool = Spool(self.path)
+        spool.append(*self._batch(0))
+        rec_size = spool.size - Spool.FILE_HEADER.size
+        spool.append(*self._batch(1))
+        spool.commit(spool.peek()[1])
+        spool.close()
+
+        # Compacting swaps in the new file and its offset together, so a
+        # crash right after it doesn't leave a stale offset behind
+        spool = Spool(self.path, Spool.FILE_HEADER.size + rec_size * 2)
+        self.assertTrue(spool.append(*self._batch(2)))
+        self.assertEqual(spool.offset, Spool.FILE_HEADER.size)
+        spool._fh.close()
+
+        spool = Spool(self.path)
+        for i in (1, 2):
+            rec, offset = spool.peek()
+            self.assertEqual(rec, self._batch(i))
+            spool.commit(offset)
+        spool.close()
+
+    def test_corrupt_offset(self):
+        spool = Spool(self.path)
+        spool.append(*self._batch(0))
+        spool.append(*self._batch(1))
+        spool.commit(spool.peek()[1])
+        spool.close()
+        with open(self.path, 'r+b') as fh:
+            fh.seek(8)
+            fh.write(b'\xff')
+
+        # Replaying a batch twice beats losing any
+        spool = Spool(self.path)
+        self.assertEqual(spool.peek()[0], self._batch(0))
+        spool.close()
+
+        with open(self.path, 'r+b') as fh:
+            fh.write(b'junk')
+        with self.assertRaises(InvalidConfigError):
+            Spool(self.path)
+
+    def test_reject(self):
+        spool = Spool(self.path)
+        spool.append(*self._batch(0))
+        spool.append(*self._batch(1))
+        _, offset = spool.peek()
+        spool.reject(offset)
+
+        self.assertEqual(spool.peek()[0], self._batch(1))
+        spool.close()
+        rejected = Spool(spool.rejected_path)
+        self.assertEqual(rejected.peek()[0], self._batch(0))
+        rejected.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
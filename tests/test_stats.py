@@ -0,0 +1,23 @@
+from libgd2pg.stats import Stats
+import unittest
+
+
+class TestStats(unittest.TestCase):
+    def test_get_reset(self):
+        stats = Stats()
+        stats.incr('count')
+        stats.incr('count', 2)
+        stats.max('max', 3)
+        stats.max('max', 1)
+        stats.gauge('gauge', 7)
+
+        self.assertEqual(
+            stats.get_reset(),
+            {'count': 3, 'max': 3, 'gauge': 7},
+        )
+        # Counters are zeroed, maxes dropped and gauges kept
+        self.assertEqual(stats.get_reset(), {'count': 0, 'gauge': 7})
+
+
+if __name__ == '__main__':
+    unittest.main()
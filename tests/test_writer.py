@@ -0,0 +1,169 @@
+from datetime import datetime
+from libgd2pg.spool import Spool
+from libgd2pg.stats import STATS
+from libgd2pg.writer import DBWriter
+from unittest.mock import MagicMock
+import os
+import tempfile
+import threading
+import unittest
+
+
+class TestDBWriter(unittest.TestCase):
+    def setUp(self):
+        STATS.get_reset()
+        self.db = MagicMock()
+
+    def _dts(self):
+        return [c[0][1] for c in self.db.insert_metrics.call_args_list]
+
+    def test_write(self):
+        self.db.insert_metrics.return_value = True
+        writer = DBWriter(self.db)
+        writer.start()
+        dts = [datetime(2020, 3, 1, 0, i) for i in range(3)]
+        for i, dt in enumerate(dts):
+            writer.submit({'host': {'m': i}}, dt)
+        writer.stop()
+        writer.join(5)
+
+        self.assertFalse(writer.is_alive())
+        # Written in order, for the time they were aggregated
+        self.assertEqual(self._dts(), dts)
+        self.assertEqual(STATS.get('writer.batches_written'), 3)
+        self.assertEqual(STATS.get('writer.queue_depth'), 0)
+
+    def test_retry(self):
+        # Fail twice, then succeed
+        writer = DBWriter(self.db, backoff=0.01)
+        written = threading.Event()
+        self.db.insert_metrics.side_effect = self._side_effects(
+            [False, Exception('boom'), True], written)
+        writer.start()
+        writer.submit({'host': {'m': 1}}, datetime(2020, 3, 1))
+        self.assertTrue(written.wait(5))
+        writer.stop()
+        writer.join(5)
+
+        self.assertEqual(self.db.insert_metrics.call_count, 3)
+        self.assertEqual(STATS.get('writer.write_errors'), 2)
+        self.assertEqual(STATS.get('writer.batches_written'), 1)
+
+    def test_max_retries(self):
+        self.db.insert_metrics.return_value = False
+        writer = DBWriter(self.db, max_retries=2, backoff=0.01)
+        writer.submit({'host': {'m': 1}}, datetime(2020, 3, 1))
+        done = threading.Event()
+        self.db.insert_metrics.side_effect = self._side_effects(
+            [False] * 3, done)
+        writer.start()
+        self.assertTrue(done.wait(5))
+        writer.stop()
+        writer.join(5)
+
+        self.assertEqual(self.db.insert_metrics.call_count, 3)
+        self.assertEqual(STATS.get('writer.batches_dropped'), 1)
+
+    def test_stop(self):
+        # Queued batches are still written once stopped, but not retried
+        self.db.insert_metrics.return_value = False
+        writer = DBWriter(self.db, backoff=0.01)
+        writer.submit({'host': {'m': 1}}, datetime(2020, 3, 1))
+        writer.stop()
+        writer.start()
+        writer.join(5)
+
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(self.db.insert_metrics.call_count, 1)
+        self.assertEqual(STATS.get('writer.batches_dropped'), 1)
+
+    def test_full_queue(self):
+        # Nothing is written until the writer is started, so the oldest
+        # batches are dropped
+        self.db.insert_metrics.return_value = True
+        writer = DBWriter(self.db, max_queue=2)
+        dts = [datetime(2020, 3, 1, 0, i) for i in range(4)]
+        for dt in dts:
+            writer.submit({'host': {'m': 1}}, dt)
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(STATS.get('writer.batches_dropped'), 2)
+
+        writer.start()
+        writer.stop()
+        writer.join(5)
+        self.assertEqual(self._dts(), dts[2:])
+
+    def test_spool(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spool = Spool(os.path.join(tmpdir, 'spool'))
+            # The db is down for the first two batches, which are spooled,
+            # then they're replayed in order after the third is written
+            done = threading.Event()
+            self.db.insert_metrics.side_effect = self._side_effects(
+                [False, False, True, True, True], done)
+            writer = DBWriter(self.db, backoff=0.01, spool=spool)
+            dts = [datetime(2020, 3, 1, 0, i) for i in range(3)]
+            writer.start()
+            for dt in dts:
+                writer.submit({'host': {'m': 1.5}}, dt)
+            self.assertTrue(done.wait(5))
+            writer.stop()
+            writer.join(5)
+
+            self.assertEqual(self._dts(), dts + dts[:2])
+            self.assertEqual(STATS.get('spool.batches_spooled'), 2)
+            self.assertEqual(STATS.get('spool.batches_replayed'), 2)
+            self.assertEqual(
+                os.path.getsize(spool.path), Spool.FILE_HEADER.size)
+
+    def test_poison_record(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spool = Spool(os.path.join(tmpdir, 'spool'))
+            dts = [datetime(2020, 3, 1, 0, i) for i in range(4)]
+            # The first spooled batch never writes, the db takes the rest
+            for dt in dts[:2]:
+                spool.append(dt, {'host': {'m': 1.5}})
+            done = threading.Event()
+
+            def insert_metrics(metrics, dt):
+                if dt == dts[1]:
+                    done.set()
+                return dt != dts[0]
+
+            self.db.insert_metrics.side_effect = insert_metrics
+            writer = DBWriter(
+                self.db, backoff=0.01, spool=spool, max_replays=2)
+            writer.start()
+            for dt in dts[2:]:
+                writer.submit({'host': {'m': 1.5}}, dt)
+            self.assertTrue(done.wait(5))
+            writer.stop()
+            writer.join(5)
+
+            # It was moved aside after failing twice, so the next one drained
+            self.assertEqual(
+                self._dts(), [dts[2], dts[0], dts[3], dts[0], dts[1]])
+            self.assertEqual(STATS.get('spool.batches_rejected'), 1)
+            self.assertEqual(STATS.get('spool.batches_replayed'), 1)
+            self.assertEqual(
+                os.path.getsize(spool.path), Spool.FILE_HEADER.size)
+            rejected = Spool(spool.rejected_path)
+            self.assertEqual(rejected.peek()[0][0], dts[0])
+            rejected.close()
+
+    def _side_effects(self, results, done):
+        results = list(results)
+
+        def side_effect(*args):
+            ret = results.pop(0)
+            if not results:
+                done.set()
+            if isinstance(ret, Exception):
+                raise ret
+            return ret
+
+        return side_effect
+
+
+if __name__ == '__main__':
+    unittest.main()
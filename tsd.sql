@@ -16,6 +16,39 @@ CREATE TABLE IF NOT EXISTS tsd (
     value DOUBLE PRECISION NOT NULL
 );
 
+-- How far each series has been rolled up, per rollup (tier)
+CREATE TABLE IF NOT EXISTS rollup_watermarks (
+    tier VARCHAR(64) NOT NULL,
+    entity_id BIGINT REFERENCES entities(id) ON DELETE CASCADE,
+    key_id BIGINT REFERENCES keys(id) ON DELETE CASCADE,
+    rolled_to TIMESTAMP NOT NULL,
+    PRIMARY KEY (tier, entity_id, key_id)
+);
+
+-- The rollup tiers, one partition (tsd_tier_<period>) per tier, created as
+-- they're filled by rollups.py.  Each bucket of period seconds is aligned
+-- to the epoch.
+CREATE TABLE IF NOT EXISTS tsd_tiers (
+    period INTEGER NOT NULL,
+    entity_id BIGINT REFERENCES entities(id) ON DELETE CASCADE,
+    key_id BIGINT REFERENCES keys(id) ON DELETE CASCADE,
+    bucket TIMESTAMP NOT NULL,
+    count BIGINT NOT NULL,
+    sum DOUBLE PRECISION NOT NULL,
+    min DOUBLE PRECISION NOT NULL,
+    max DOUBLE PRECISION NOT NULL,
+    last DOUBLE PRECISION NOT NULL,
+    last_added TIMESTAMP NOT NULL,
+    PRIMARY KEY (period, entity_id, key_id, bucket)
+) PARTITION BY LIST (period);
+
+-- The raw data in tsd from filled_from up to filled_to is in each tier
+CREATE TABLE IF NOT EXISTS tier_watermarks (
+    period INTEGER PRIMARY KEY,
+    filled_from TIMESTAMP NOT NULL,
+    filled_to TIMESTAMP NOT NULL
+);
+
 CREATE INDEX IF NOT EXISTS tsd_added_idx ON tsd (added);
 CREATE INDEX IF NOT EXISTS tsd_eid_idx ON tsd (entity_id);
 CREATE INDEX IF NOT EXISTS tsd_kid_idx ON tsd (key_id);
@@ -69,6 +102,96 @@ BEGIN
 END
 $BODY$ LANGUAGE plpgsql;
 
+-- The coarsest tier that has been filled past t_from, with buckets no wider
+-- than max_interval seconds, or NULL if there isn't one.  The tiers are
+-- backfilled with everything in tsd when they're created.
+DROP FUNCTION IF EXISTS tier_period(timestamp, integer);
+CREATE OR REPLACE FUNCTION tier_period(
+    t_from TIMESTAMP,
+    max_interval INTEGER DEFAULT NULL
+) RETURNS INTEGER AS $BODY$
+    SELECT period FROM tier_watermarks
+    WHERE
+        filled_to > t_from
+        AND (max_interval IS NULL OR period <= max_interval)
+    ORDER BY period DESC
+    LIMIT 1;
+$BODY$ LANGUAGE sql STABLE;
+
+-- A series from the tier picked by tier_period(), with the time since the
+-- tier was last filled aggregated from tsd on the fly.  If no tier fits,
+-- the raw values are returned as buckets of one.  For example, in Grafana:
+--     SELECT bucket AS time, sum / count AS avg, max
+--     FROM tier_series('host1', 'cpu.0.idle', $__timeFrom()::timestamp,
+--         $__timeTo()::timestamp, $__interval_ms / 1000)
+DROP FUNCTION IF EXISTS tier_series(varchar, varchar, timestamp, timestamp, integer);
+CREATE OR REPLACE FUNCTION tier_series(
+    ent VARCHAR(1024),
+    series_key VARCHAR(1024),
+    t_from TIMESTAMP,
+    t_to TIMESTAMP,
+    max_interval INTEGER DEFAULT NULL
+) RETURNS TABLE(
+    bucket TIMESTAMP,
+    count BIGINT,
+    sum DOUBLE PRECISION,
+    min DOUBLE PRECISION,
+    max DOUBLE PRECISION,
+    last DOUBLE PRECISION
+) AS $BODY$
+#variable_conflict use_column
+DECLARE
+    tier INTEGER := tier_period(t_from, max_interval);
+    filled TIMESTAMP;
+    eid BIGINT;
+    kid BIGINT;
+BEGIN
+    SELECT id INTO eid FROM entities WHERE entity = ent;
+    SELECT id INTO kid FROM keys WHERE key = series_key;
+    IF tier IS NULL THEN
+        RETURN QUERY
+        SELECT t.added, 1::BIGINT, t.value, t.value, t.value, t.value
+        FROM tsd t
+        WHERE
+            t.entity_id = eid
+            AND t.key_id = kid
+            AND t.added >= t_from
+            AND t.added < t_to
+        ORDER BY t.added;
+        RETURN;
+    END IF;
+
+    SELECT filled_to INTO filled FROM tier_watermarks WHERE period = tier;
+    RETURN QUERY
+    SELECT r.bucket, r.count, r.sum, r.min, r.max, r.last
+    FROM tsd_tiers r
+    WHERE
+        r.period = tier
+        AND r.entity_id = eid
+        AND r.key_id = kid
+        AND r.bucket > t_from - make_interval(secs => tier)
+        AND r.bucket < LEAST(t_to, filled)
+    UNION ALL
+    SELECT
+        to_timestamp(
+            floor(extract(epoch FROM t.added) / tier) * tier
+        ) AT TIME ZONE 'UTC',
+        count(*),
+        sum(t.value),
+        min(t.value),
+        max(t.value),
+        (array_agg(t.value ORDER BY t.added DESC))[1]
+    FROM tsd t
+    WHERE
+        t.entity_id = eid
+        AND t.key_id = kid
+        AND t.added >= GREATEST(filled, t_from)
+        AND t.added < t_to
+    GROUP BY 1
+    ORDER BY 1;
+END
+$BODY$ LANGUAGE plpgsql STABLE;
+
 DROP TRIGGER IF EXISTS tsd_ts_upd on tsd;
 CREATE TRIGGER tsd_ts_upd AFTER INSERT ON tsd
     FOR EACH ROW EXECUTE PROCEDURE upd_added();